@@ -0,0 +1,257 @@
+"""
+Build benchmark of sphinxnotes-lilypond.
+
+A synthetic Sphinx project is generated with inline ``:lily:`` roles,
+``lily``/``lilyinclude``/``jianpu`` directives, transpositions and
+multi-track MIDI, then built several times:
+
+cold
+    From scratch.
+warm
+    Re-read all documents (``-E``), outputs of previous build are kept.
+edit
+    Incremental build after editing a single score.
+cache
+    From scratch, but with :confval:`lilypond_cache_dir` of previous builds.
+
+By default, deterministic stubs of LilyPond, TiMidity++ and FFmpeg (see
+``benchmarks/stubs/``) are used, the real tools can be benchmarked by
+``--toolchain real`` when they are installed.
+
+Usage::
+
+    python benchmarks/bench_build.py [--pages N] [--scores N] [--latency SEC]
+"""
+
+from __future__ import annotations
+import argparse
+import json
+import os
+from os import path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHDIR = path.dirname(path.abspath(__file__))
+STUBDIR = path.join(BENCHDIR, 'stubs')
+SRCDIR = path.join(path.dirname(BENCHDIR), 'src')
+
+PITCHES = ['c', 'd', 'e', 'f', 'g', 'a', 'b']
+
+
+def melody(seed: int, length: int = 8) -> str:
+    """Return a melody unique to the seed."""
+    notes = []
+    for i in range(length):
+        notes.append("%s'" % PITCHES[(seed + i * 3) % 7])
+        seed //= 7
+    return ' '.join(notes)
+
+
+def jianpu_melody(seed: int) -> str:
+    return ' '.join(str(1 + (seed + i) % 7) for i in range(8))
+
+
+def score(kind: str, seed: int) -> str:
+    """Return reStructuredText of a score of given kind."""
+    if kind == 'inline':
+        return 'Inline :lily:`{%s} \\midi{}` score.\n' % melody(seed, 4)
+    if kind == 'shared':
+        # Same score appears on every page.
+        return 'Shared :lily:`{%s}` score.\n' % melody(0, 4)
+    if kind == 'block':
+        return '.. lily::\n\n   \\score { { %s } \\layout{} \\midi{} }\n' % melody(seed)
+    if kind == 'transpose':
+        return (
+            '.. lily::\n   :transpose: c d\n\n   \\score { { %s } \\layout{} }\n'
+            % melody(seed)
+        )
+    if kind == 'include':
+        return '.. lilyinclude:: /_scores/score%d.ly\n' % (seed % 8)
+    if kind == 'jianpu':
+        return '.. jianpu::\n\n   1=C\n   4/4\n   %s\n' % jianpu_melody(seed)
+    if kind == 'multitrack':
+        return (
+            '.. lily::\n\n   \\score { <<\n'
+            '     \\new Staff { %s }\n     \\new Staff { %s }\n'
+            '     \\new Staff { %s }\n   >> \\layout{} \\midi{} }\n'
+            % (melody(seed), melody(seed + 1), melody(seed + 2))
+        )
+    raise ValueError(kind)
+
+
+KINDS = ['inline', 'shared', 'block', 'transpose', 'include', 'jianpu', 'multitrack']
+
+
+def generate(srcdir: str, pages: int, scores: int, toolchain: str, conf: list[str]):
+    os.makedirs(path.join(srcdir, '_scores'))
+    for i in range(8):
+        with open(path.join(srcdir, '_scores', 'score%d.ly' % i), 'w') as f:
+            f.write('\\score { { %s } \\layout{} \\midi{} }\n' % melody(100 + i))
+
+    lines = ["extensions = ['sphinxnotes.lilypond']"]
+    if toolchain == 'stub':
+        lines += [
+            'lilypond_lilypond_args = [%r]' % path.join(STUBDIR, 'lilypond'),
+            'lilypond_timidity_args = [%r]' % path.join(STUBDIR, 'timidity'),
+            'lilypond_ffmpeg_args = [%r]' % path.join(STUBDIR, 'ffmpeg'),
+        ]
+    lines += ['lilypond_cache_dir = %r' % path.join(srcdir, '..', 'cache')]
+    lines += conf
+    with open(path.join(srcdir, 'conf.py'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    with open(path.join(srcdir, 'index.rst'), 'w') as f:
+        f.write('Benchmark\n=========\n\n.. toctree::\n\n')
+        f.write(''.join('   page%d\n' % i for i in range(pages)))
+    for i in range(pages):
+        write_page(srcdir, i, scores)
+
+
+def write_page(srcdir: str, page: int, scores: int, edit: int | None = None):
+    """Write a page of scores, score of index *edit* is changed if given."""
+    with open(path.join(srcdir, 'page%d.rst' % page), 'w') as f:
+        f.write('Page %d\n========\n\n' % page)
+        for j in range(scores):
+            seed = page * scores + j + (100000 if j == edit else 0)
+            f.write(score(KINDS[j % len(KINDS)], seed) + '\n')
+
+
+def count_scores(pages: int, scores: int) -> int:
+    return pages * scores
+
+
+def build(workdir: str, args, extra: list[str]) -> dict:
+    logfn = path.join(workdir, 'stub.log')
+    if path.exists(logfn):
+        os.remove(logfn)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [SRCDIR, env.get('PYTHONPATH')]))
+    env['STUB_LOG'] = logfn
+    env['STUB_LATENCY'] = str(args.latency)
+    env['STUB_SCORE_LATENCY'] = str(args.score_latency)
+    cmd = [
+        sys.executable,
+        '-m',
+        'sphinx',
+        '-q',
+        '-b',
+        args.builder,
+        '-j',
+        str(args.jobs),
+        '-d',
+        path.join(workdir, 'doctrees'),
+        path.join(workdir, 'src'),
+        path.join(workdir, 'out'),
+        *extra,
+    ]
+    start = time.perf_counter()
+    p = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    if p.returncode != 0:
+        sys.exit('build failed:\n%s' % p.stderr.decode(errors='replace'))
+
+    events = []
+    if path.exists(logfn):
+        with open(logfn) as f:
+            events = [tuple(line.split()[:2]) for line in f]
+    return {
+        'time': elapsed,
+        'lilypond': events.count(('lilypond', 'start')),
+        'renders': events.count(('lilypond', 'render')),
+        'audios': events.count(('timidity', 'start')),
+    }
+
+
+def run(args, toolchain: str) -> dict[str, dict]:
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='sphinxnotes-lilypond-bench') as workdir:
+        srcdir = path.join(workdir, 'src')
+        generate(srcdir, args.pages, args.scores, toolchain, args.conf)
+        total = count_scores(args.pages, args.scores)
+
+        results['cold'] = build(workdir, args, [])
+        results['warm'] = build(workdir, args, ['-E'])
+        write_page(srcdir, 0, args.scores, edit=KINDS.index('block'))
+        results['edit'] = build(workdir, args, [])
+        shutil.rmtree(path.join(workdir, 'out'))
+        shutil.rmtree(path.join(workdir, 'doctrees'))
+        results['cache'] = build(workdir, args, [])
+
+        for r in results.values():
+            r['hit_rate'] = max(0.0, 1 - r['renders'] / total)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--scores', type=int, default=14, help='scores per page')
+    parser.add_argument(
+        '--latency', type=float, default=0.2, help='startup latency of stub tools'
+    )
+    parser.add_argument(
+        '--score-latency', type=float, default=0.02, help='latency per stub score'
+    )
+    parser.add_argument('--builder', default='html')
+    parser.add_argument('-j', '--jobs', default='1')
+    parser.add_argument(
+        '--toolchain',
+        default='stub',
+        help='comma separated list of "stub" and "real"',
+    )
+    parser.add_argument(
+        '-D',
+        dest='conf',
+        action='append',
+        default=[],
+        help='extra line of conf.py, for example "lilypond_workers = 4"',
+    )
+    parser.add_argument('--json', help='also write results to the JSON file')
+    args = parser.parse_args()
+
+    report = {}
+    for toolchain in args.toolchain.split(','):
+        if toolchain == 'real' and not all(
+            shutil.which(x) for x in ['lilypond', 'timidity']
+        ):
+            print('real: skipped, lilypond or timidity not found')
+            continue
+        results = run(args, toolchain)
+        report[toolchain] = results
+        print(
+            '%s: %d pages, %d scores, builder %s, -j %s'
+            % (
+                toolchain,
+                args.pages,
+                count_scores(args.pages, args.scores),
+                args.builder,
+                args.jobs,
+            )
+        )
+        print(
+            '  %-6s %9s %9s %8s %7s %9s'
+            % ('build', 'time', 'lilypond', 'renders', 'audios', 'hit rate')
+        )
+        for phase, r in results.items():
+            print(
+                '  %-6s %8.2fs %9d %8d %7d %8.1f%%'
+                % (
+                    phase,
+                    r['time'],
+                    r['lilypond'],
+                    r['renders'],
+                    r['audios'],
+                    r['hit_rate'] * 100,
+                )
+            )
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
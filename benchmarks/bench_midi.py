@@ -0,0 +1,93 @@
+"""
+Micro-benchmark of :func:`sphinxnotes.lilypond.midi.get_track_name` against
+the previous mido based implementation, on large multi-track MIDI files.
+
+Usage::
+
+    python benchmarks/bench_midi.py [--tracks N] [--notes N] [--repeat N]
+
+mido is required for generating the files and for the comparison.
+"""
+
+from __future__ import annotations
+import argparse
+import os
+from os import path
+import sys
+import tempfile
+import timeit
+
+import mido
+
+# Use the package in this source tree rather than the installed one.
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'src'))
+from sphinxnotes.lilypond.midi import get_track_name  # noqa: E402
+
+
+def get_track_name_mido(fn: str) -> str | None:
+    for track in mido.MidiFile(fn).tracks:
+        for msg in track:
+            if msg.type == 'track_name':
+                return msg.name.encode('latin-1').decode('utf-8')
+    return None
+
+
+def make_midi(fn: str, tracks: int, notes: int, name_track: int):
+    """
+    Write a MIDI file of *tracks* tracks, each with *notes* notes. Only the
+    track *name_track* has a track name, like what LilyPond produces when the
+    title is set in a later staff.
+    """
+    mid = mido.MidiFile(type=1)
+    for t in range(tracks):
+        track = mido.MidiTrack()
+        mid.tracks.append(track)
+        track.append(mido.MetaMessage('set_tempo', tempo=500000))
+        if t == name_track:
+            title = 'Track %d – 歌' % t
+            track.append(
+                mido.MetaMessage(
+                    'track_name', name=title.encode('utf-8').decode('latin-1')
+                )
+            )
+        for i in range(notes):
+            note = 48 + (i + t) % 24
+            track.append(mido.Message('note_on', note=note, velocity=64, time=0))
+            track.append(mido.Message('note_off', note=note, velocity=0, time=120))
+    mid.save(fn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tracks', type=int, default=16)
+    parser.add_argument('--notes', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cases = {
+            'name in first track': 0,
+            'name in last track': args.tracks - 1,
+            'no name': -1,
+        }
+        for case, name_track in cases.items():
+            fn = os.path.join(tmpdir, 'music.midi')
+            make_midi(fn, args.tracks, args.notes, name_track)
+            expected = get_track_name_mido(fn)
+            actual = get_track_name(fn)
+            assert actual == expected, (actual, expected)
+
+            print(
+                '%s (%d tracks, %d notes, %d KiB):'
+                % (case, args.tracks, args.notes, os.path.getsize(fn) // 1024)
+            )
+            for label, func in [
+                ('mido', get_track_name_mido),
+                ('streaming', get_track_name),
+            ]:
+                t = min(timeit.repeat(lambda: func(fn), number=1, repeat=args.repeat))
+                print('  %-10s %10.3f ms' % (label, t * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Stand-in server of :confval:`lilypond_cache_url`.
+
+Serves files of a directory by GET, and stores request bodies by PUT, which
+is all :class:`sphinxnotes.lilypond.cache.HTTPCache` needs.
+
+Usage::
+
+    python benchmarks/cache_server.py [--port PORT] DIR
+"""
+
+from __future__ import annotations
+import argparse
+import functools
+import os
+from os import path
+import tempfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Handler(SimpleHTTPRequestHandler):
+    def do_PUT(self):
+        fn = self.translate_path(self.path)
+        if path.isdir(fn) or not path.realpath(fn).startswith(
+            path.realpath(self.directory) + os.sep
+        ):
+            self.send_error(403)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        os.makedirs(path.dirname(fn), exist_ok=True)
+        fd, tmpfn = tempfile.mkstemp(prefix='.tmp-', dir=path.dirname(fn))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.rfile.read(length))
+        os.replace(tmpfn, fn)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('dir', help='directory of cache entries')
+    parser.add_argument('--bind', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    handler = functools.partial(Handler, directory=args.dir)
+    with ThreadingHTTPServer((args.bind, args.port), handler) as server:
+        print('serving %s at http://%s:%d/' % (args.dir, args.bind, args.port))
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Stress test of concurrent cache publication, as done by parallel writers of
+``sphinx-build -j``: N processes render overlapping signatures, guarded by
+:class:`sphinxnotes.lilypond.cache.Lock` and published by
+:func:`sphinxnotes.lilypond.cache.move`.
+
+Every signature must be rendered exactly once, and every published directory
+must be complete and not nested.
+
+Usage::
+
+    python benchmarks/stress_publish.py [--procs N] [--sigs N] [--files N]
+"""
+
+from __future__ import annotations
+import argparse
+import multiprocessing
+import os
+from os import path
+import random
+import sys
+import tempfile
+import time
+
+# Use the package in this source tree rather than the installed one.
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'src'))
+from sphinxnotes.lilypond import cache  # noqa: E402
+
+
+def render(stagedir: str, files: int) -> str:
+    """Pretend to be LilyPond: write files slowly to a new directory."""
+    outdir = tempfile.mkdtemp(dir=stagedir)
+    for i in range(files):
+        with open(path.join(outdir, 'music-%d.png' % i), 'wb') as f:
+            f.write(os.urandom(1024))
+        time.sleep(0.001)
+    return outdir
+
+
+def writer(workdir: str, sigs: list[str], files: int, seed: int):
+    builddir = path.join(workdir, '_lilypond')
+    lockdir = path.join(workdir, 'locks')
+    # Staged on another directory, like the default lilypond_builddir.
+    stagedir = tempfile.mkdtemp()
+    sigs = sigs.copy()
+    random.Random(seed).shuffle(sigs)
+    rendered = []
+    for sig in sigs:
+        outfn = path.join(builddir, sig)
+        if path.isdir(outfn):
+            continue
+        with cache.Lock(path.join(lockdir, sig)):
+            if path.isdir(outfn):
+                continue  # rendered by others while waiting
+            outdir = render(stagedir, files)
+            os.makedirs(builddir, exist_ok=True)
+            if cache.move(outdir, outfn):
+                rendered.append(sig)
+    os.rmdir(stagedir)
+    with open(path.join(workdir, 'rendered-%d' % seed), 'w') as f:
+        f.write('\n'.join(rendered))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--procs', type=int, default=8)
+    parser.add_argument('--sigs', type=int, default=200)
+    parser.add_argument('--files', type=int, default=5)
+    args = parser.parse_args()
+
+    sigs = ['%040x' % i for i in range(args.sigs)]
+    with tempfile.TemporaryDirectory() as workdir:
+        start = time.perf_counter()
+        procs = [
+            multiprocessing.Process(target=writer, args=(workdir, sigs, args.files, i))
+            for i in range(args.procs)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - start
+
+        errors = []
+        if any(p.exitcode != 0 for p in procs):
+            errors.append('some writers failed')
+        rendered = []
+        for i in range(args.procs):
+            fn = path.join(workdir, 'rendered-%d' % i)
+            if path.exists(fn):
+                with open(fn) as f:
+                    rendered += f.read().split()
+        if sorted(rendered) != sigs:
+            errors.append('%d renders for %d signatures' % (len(rendered), len(sigs)))
+        builddir = path.join(workdir, '_lilypond')
+        for sig in os.listdir(builddir):
+            names = os.listdir(path.join(builddir, sig))
+            if len(names) != args.files or not all(n.endswith('.png') for n in names):
+                errors.append('incomplete or nested entry: %s' % sig)
+
+        print(
+            '%d processes, %d signatures, %d renders in %.2fs'
+            % (args.procs, len(sigs), len(rendered), elapsed)
+        )
+        for e in errors:
+            print('FAILED: %s' % e)
+        sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
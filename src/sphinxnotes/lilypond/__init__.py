@@ -9,19 +9,26 @@ Sphinx extension for embedding LilyPond scores.
 :license: BSD, see LICENSE for details.
 """
 
+import os
+import json
+import time
 import shutil
 import posixpath
-import tempfile
 from os import path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from hashlib import sha1 as sha
 from abc import abstractmethod
 import re
+import textwrap
 
 from docutils import nodes
 from docutils.utils import unescape
 from docutils.parsers.rst import directives
 
 from sphinx.util import logging
+from sphinx.util.console import bold
+from sphinx.util.display import status_iterator
 from sphinx.util.osutil import ensuredir, relative_uri
 from sphinx.util.docutils import SphinxDirective
 from sphinx.config import Config
@@ -33,9 +40,12 @@ from sphinx.util.nodes import make_id
 
 
 from . import lilypond
+from . import cache
 from . import jianpu
 from . import meta
+from . import perf
 from . import static
+from . import svg
 
 
 logger = logging.getLogger(__name__)
@@ -43,6 +53,33 @@ logger = logging.getLogger(__name__)
 
 _CLS = 'sphinxnotes-lilypond'
 _LILYDIR = '_lilypond'
+_SIG_RE = re.compile(r'[0-9a-f]{40}')
+_STAGEDIR = '.staging'
+# Directories of jobs (see :func:`mkbuilddir`) and batches (see
+# :func:`lilypond.output_batch`), the number is ID of the owner process.
+_JOB_RE = re.compile(r'(?:[0-9a-f]{12}|batch)-(\d+)-.+')
+_DIRECTIVE_RE = re.compile(
+    r'^(\s*)\.\. (lily|lilyinclude|jianpu|jianpuinclude)::(?:\s+(.*?))?\s*$'
+)
+_OPTION_RE = re.compile(r'^:([\w-]+):(?:\s+(.*?))?\s*$')
+
+# Global score cache, available when :confval:`lilypond_cache_dir` or
+# :confval:`lilypond_cache_url` is set.
+_cache: cache.Backend | None = None
+
+# Local cache directory, which also holds audio and Jianpu caches and locks
+# of scores, all of them are evicted under :confval:`lilypond_cache_size`.
+_local_cache: cache.Cache | None = None
+
+# Signatures of scores that failed to pre-render in current build, and their
+# errors, so that visitors report them without rendering them again.
+_failures: dict[str, lilypond.Error] = {}
+
+# Glyphs used by SVG scores inlined into each page, and sizes in bytes of the
+# scores before and after inlining, see :func:`html_inline_svg_scores`.
+_svg_pages: dict[str, tuple[dict[str, str], list[int]]] = {}
+# Total sizes of all pages, reported at the end of build.
+_svg_sizes = [0, 0]
 
 
 class lily_inline_node(nodes.Inline, nodes.TextElement):
@@ -53,6 +90,27 @@ class lily_outline_node(nodes.Part, nodes.Element):
     pass
 
 
+class lily_transpose_node(nodes.Part, nodes.Element):
+    """
+    Container of :class:`lily_outline_node` of a score transposed to multiple
+    keys, one child per key.
+    """
+
+    pass
+
+
+# Node attributes that are required for rendering a score, see
+# :func:`_on_doctree_read` and :func:`render_to_builddir`.
+_RENDER_ATTRS = [
+    'docname',
+    'lilysrc',
+    'includes',
+    'crop',
+    'transpose',
+    'inline',
+]
+
+
 def lily_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
     env = inliner.document.settings.env  # type: ignore
 
@@ -66,13 +124,20 @@ def lily_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
     node['ids'] = [make_id(env, inliner.document, _CLS, None)]
     node['docname'] = env.docname
     node['rawtext'] = rawtext
-    node['lilysrc'] = r'\score{' + unescape(text, restore_backslashes=True) + '}'
+    node['lilysrc'] = get_inline_lilysrc(unescape(text, restore_backslashes=True))
+    note_includes(env, node)
     node['crop'] = True
+    node['inline'] = True
     node['audio'] = True
     node['controls'] = 'bottom'
     return [node], []
 
 
+def get_inline_lilysrc(text: str) -> str:
+    """Return LilyPond source of inline score of given text."""
+    return r'\score{' + text + '}'
+
+
 def jianpu_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
     try:
         text = jianpu.to_lilypond(unescape(text, restore_backslashes=True))
@@ -125,17 +190,59 @@ class BaseLilyDirective(SphinxDirective):
             node['docname'] = self.env.docname
             return [node]
 
+        try:
+            transposes = parse_transpose(self.options.get('transpose'))
+        except ValueError as e:
+            msg = str(e)
+            logger.warning(msg, location=self.state.parent)
+            sm = nodes.system_message(
+                msg, type='WARNING', level=2, backrefs=[], source=''
+            )
+            return [sm]
+
+        outlines = [self.create_node(lilysrc, x) for x in transposes]
+        tag_score(outlines[0], self.perf_key())
+        if len(outlines) == 1:
+            return outlines
+
+        # Transposed to multiple keys, see :func:`html_visit_lily_transpose_node`.
+        node = lily_transpose_node()
+        node['ids'] = [make_id(self.env, self.state.document, _CLS, None)]
+        node += outlines
+        return [node]
+
+    def create_node(self, lilysrc: str, transpose: str | None) -> lily_outline_node:
         node = lily_outline_node()
         node['ids'] = [make_id(self.env, self.state.document, _CLS, None)]
         node['docname'] = self.env.docname
         node['rawtext'] = self.block_text
         node['lilysrc'] = lilysrc
+        note_includes(self.env, node)
         node['audio'] = 'noaudio' not in self.options
         node['crop'] = 'nocrop' not in self.options
         node['loop'] = 'loop' in self.options
-        node['transpose'] = self.options.get('transpose')
+        node['transpose'] = transpose
         node['controls'] = self.options.get('controls', 'bottom')
-        return [node]
+        return node
+
+    def perf_key(self) -> str:
+        """Key of stages recorded before the node is created, see :mod:`.perf`."""
+        return '%s:%d' % (self.env.docname, self.lineno)
+
+
+def parse_transpose(option: str | None) -> list[str | None]:
+    """
+    Parse ``:transpose:`` option to list of "<from> <to>" pitches, one for
+    each target key, ``[None]`` if the score is not transposed.
+
+    :raise ValueError: when no target key is given.
+    """
+    if not option:
+        return [None]
+    from_pitch, *to_pitches = option.split()
+    if not to_pitches:
+        raise ValueError('invalid transpose option: %s' % option)
+    return ['%s %s' % (from_pitch, x) for x in to_pitches]
 
 
 class LilyDirective(BaseLilyDirective):
@@ -155,7 +262,9 @@ class LilyIncludeDirective(BaseLilyDirective):
 
 class BaseJianpuDirective(BaseLilyDirective):
     def read_lily_source(self) -> str:
-        return jianpu.to_lilypond(self.read_jianpu_source())
+        src = self.read_jianpu_source()
+        with perf.stage('jianpu', self.perf_key()):
+            return jianpu.to_lilypond(src)
 
     @abstractmethod
     def read_jianpu_source(self) -> str:
@@ -177,9 +286,122 @@ class JianpuIncludeDirective(BaseJianpuDirective):
         return read_source_file(self.env, self.arguments[0])
 
 
+def note_includes(
+    env: BuildEnvironment, node: lily_inline_node | lily_outline_node
+) -> None:
+    """
+    Note files included by the score as dependencies of current document, and
+    record digest of them to node.
+    """
+    files, node['includes'] = get_includes(node['lilysrc'])
+    for fn in files:
+        # Rebuild the current document if the file changes.
+        env.note_dependency(fn)
+
+
+def get_includes(lilysrc: str) -> tuple[list[str], str]:
+    """Return files included by the score, and digest of them."""
+    h = sha()
+    files = lilypond.Document(lilysrc).includes()
+    for fn in files:
+        h.update(fn.encode('utf-8'))
+        try:
+            with open(fn, 'rb') as f:
+                h.update(f.read())
+        except OSError:
+            pass
+    return files, h.hexdigest()
+
+
 def get_node_sig(node: lily_inline_node | lily_outline_node) -> str:
-    """Return signture of given node."""
-    return sha((node['lilysrc'] + node['rawtext']).encode('utf-8')).hexdigest()
+    """
+    Return signture of given node.
+
+    The signature covers the normalized token stream of (transposed) score
+    source (:func:`lilypond.source_digest`), digest of included files, the
+    flags that affect outputs, and the render config and toolchain versions
+    (:func:`lilypond.fingerprint`). Directive syntax, indentation and comments
+    are not covered, so semantically identical scores share one render.
+    """
+    return _get_sig(
+        lilypond.fingerprint(),
+        node.get('includes') or '',
+        node['lilysrc'],
+        node.get('transpose') or '',
+        bool(node.get('crop')),
+        bool(node.get('inline')),
+    )
+
+
+@lru_cache(maxsize=4096)
+def _get_sig(
+    fingerprint: str, includes: str, src: str, transpose: str, crop: bool, inline: bool
+) -> str:
+    digest = lilypond.source_digest(src)
+    if transpose:
+        from_pitch, to_pitch = transpose.split()
+        try:
+            digest = lilypond.source_digest(
+                lilypond.transpose_source(src, from_pitch, to_pitch)
+            )
+        except lilypond.Error:
+            # Error is reported when rendering, just keep signature distinct
+            # from the untransposed one.
+            digest += transpose
+    return sha(
+        '\0'.join(
+            [
+                fingerprint,
+                includes,
+                digest,
+                'crop' if crop else 'nocrop',
+                # Resolutions of PNG variants depend on it, see
+                # :func:`get_png_resolutions`.
+                'inline' if inline else 'block',
+            ]
+        ).encode('utf-8')
+    ).hexdigest()
+
+
+def get_builddir(builder) -> str:
+    """Return the path of Sphinx builder's outdir for LilyPond outputs."""
+    return path.join(builder.outdir, _LILYDIR)
+
+
+def get_used_sigs(env: BuildEnvironment) -> set[str]:
+    """
+    Return signatures of all scores (and their fragments) recorded in the
+    build environment.
+    """
+    sigs = set()
+    for scores in env.lilypond_scores.values():  # type: ignore
+        for score in scores:
+            sigs.add(get_node_sig(score))  # type: ignore
+            sigs.update(get_node_sig(x) for x in get_fragments(score) or [])  # type: ignore
+    return sigs
+
+
+def gc_builddir(
+    builder, used: set[str], dry_run: bool = False
+) -> list[tuple[str, int]]:
+    """
+    Remove the entries in builder's outdir that are not used by any score.
+
+    :return: path and size of the removed (or to be removed, when *dry_run*)
+             entries.
+    """
+    builddir = get_builddir(builder)
+    if not path.isdir(builddir):
+        return []
+    stale = []
+    for name in sorted(os.listdir(builddir)):
+        entry = path.join(builddir, name)
+        if name in used or not _SIG_RE.fullmatch(name) or not path.isdir(entry):
+            continue
+        stale.append((entry, cache.dirsize(entry)))
+        if not dry_run:
+            shutil.rmtree(entry, ignore_errors=True)
+    return stale
 
 
 def get_builddir_and_reldir(
@@ -189,7 +411,7 @@ def get_builddir_and_reldir(
     Return the path of Sphinx builder's outdir and its corrsponding relative
     path.
     """
-    builddir = path.join(builder.outdir, _LILYDIR)
+    builddir = get_builddir(builder)
     reluri = relative_uri(builder.get_target_uri(node['docname']), '.')
     reldir = posixpath.join(reluri, _LILYDIR)
     return (builddir, reldir)
@@ -206,13 +428,15 @@ def pick_from_builddir(
     builddir, reldir = get_builddir_and_reldir(builder, node)
     outfn = path.join(builddir, sig)
 
-    if not path.isdir(outfn):
-        # Not in cache
-        return None
     try:
-        out = lilypond.Output(outfn)
+        with perf.stage('lookup', sig):
+            if not path.isdir(outfn) and not pick_from_cache(sig, outfn):
+                # Not in cache
+                return None
+            out = lilypond.Output.load(outfn)
     except lilypond.Error:
         logger.warning('invalid lilypond cache in %s' % outfn, location=node)
+        shutil.rmtree(outfn, ignore_errors=True)  # so that it can be re-rendered
         return None
     else:
         relfn = posixpath.join(reldir, sig)
@@ -220,23 +444,322 @@ def pick_from_builddir(
         return out
 
 
+def pick_from_cache(sig: str, outfn: str) -> bool:
+    """
+    Try to publish the LilyPond outputted files of given signature from
+    global cache to *outfn*.
+    """
+    if _cache is None:
+        return False
+    entry = _cache.get(sig)
+    if entry is None:
+        return False
+    ensuredir(path.dirname(outfn))
+    try:
+        cache.publish(entry, outfn)
+    except OSError as e:  # for example, evicted by others meanwhile
+        logger.warning('failed to pick %s from lilypond cache: %s', sig, e)
+        return False
+    return True
+
+
 def move_to_builddir(
     builder, node: lily_inline_node | lily_outline_node, out: lilypond.Output
 ):
     """
     Move lilypond outputted files to builder's outdir, relocate the path of
-    :class:`lilypond.Output` to relative path.
+    :class:`lilypond.Output` to the new place.
     """
     sig = get_node_sig(node)
-    builddir, reldir = get_builddir_and_reldir(builder, node)
-    outfn = path.join(builddir, sig)
-    relfn = posixpath.join(reldir, sig)
+    outfn = path.join(get_builddir(builder), sig)
     ensuredir(path.dirname(outfn))
-    shutil.move(out.outdir, outfn)
-    out.relocate(relfn)
+    # Published atomically, readers never see partial directory. When it has
+    # been published by others, ours is discarded, they are the same anyway.
+    if cache.move(out.outdir, outfn) and _cache is not None:
+        _cache.put(sig, outfn)
+    out.relocate(outfn)
     return out
 
 
+def flush_cache() -> None:
+    """Upload pending entries of global cache, then evict stale ones."""
+    if _cache is not None:
+        _cache.flush()
+    if _local_cache is not None:
+        _local_cache.evict()
+    if _cache is not None:
+        logger.info('lilypond cache: %s' % _cache.stats())
+
+
+def get_lock(builder, sig: str) -> cache.Lock:
+    """
+    Return the lock of score of given signature, which should be held while
+    rendering and publishing the score, so that concurrent writers (for
+    example, ``sphinx-build -j``) never render the same score twice.
+    """
+    if _local_cache is not None:
+        # Also shared by other builds that use the same cache.
+        return _local_cache.lock(sig)
+    return cache.Lock(path.join(builder.doctreedir, 'lilypond-locks', sig))
+
+
+def create_document(node: lily_inline_node | lily_outline_node) -> lilypond.Document:
+    """Create LilyPond document from given node, transposed if needed."""
+    doc = lilypond.Document(node['lilysrc'])
+    if node.get('transpose'):
+        from_pitch, to_pitch = node['transpose'].split()
+        with perf.stage('transpose', get_node_sig(node)):
+            doc.transpose(from_pitch, to_pitch)
+    return doc
+
+
+def get_fragments(node: lily_inline_node | lily_outline_node) -> list[dict] | None:
+    """
+    Return render attributes (see :data:`_RENDER_ATTRS`) of fragments of the
+    score of given node, which are rendered and cached as independent scores
+    (see :func:`lilypond.split_movements`). Return None when
+    :confval:`lilypond_split_movements` is disabled or the score can not be
+    split.
+    """
+    if not lilypond.Config.split_movements or node.get('inline'):
+        return None
+    try:
+        fragments = lilypond.split_movements(create_document(node).plaintext())
+    except lilypond.Error:
+        return None
+    if fragments is None:
+        return None
+    return [
+        {
+            'docname': node['docname'],
+            'lilysrc': src,
+            'includes': node['includes'],
+            'crop': node.get('crop'),
+            'transpose': None,  # already transposed
+            'inline': False,
+        }
+        for src in fragments
+    ]
+
+
+def tag_score(node: lily_inline_node | lily_outline_node, *keys: str) -> None:
+    """Tag the recorded stages of given keys with the score, see :mod:`.perf`."""
+    if perf.recorder is None:
+        return
+    sig = get_node_sig(node)
+    for key in [sig, *keys]:
+        perf.tag(key, node['docname'], sig)
+
+
+def get_stagedir(builder) -> str:
+    """
+    Return the directory where scores are rendered before being published to
+    builder's outdir: :confval:`lilypond_builddir` if given, otherwise a
+    hidden directory in builder's outdir, so that publishing is a rename
+    rather than a copy across filesystems.
+    """
+    return builder.config.lilypond_builddir or path.join(
+        get_builddir(builder), _STAGEDIR
+    )
+
+
+def mkbuilddir(builder, sig: str) -> str:
+    """
+    Create a directory for rendering the score of given signature. Every job
+    has its own directory, named after signature and process ID, so the
+    staging directory can be shared by concurrent builds.
+    """
+    return cache.mkstagedir(get_stagedir(builder), '%s-%d-' % (sig[:12], os.getpid()))
+
+
+def clean_stagedir(builder) -> None:
+    """
+    Remove the directories left in staging directory by dead processes (for
+    example, killed builds), and the directory itself if it is empty.
+    """
+    stagedir = get_stagedir(builder)
+    try:
+        names = os.listdir(stagedir)
+    except OSError:
+        return
+    for name in names:
+        m = _JOB_RE.fullmatch(name)
+        if not m or os.name != 'posix':  # os.kill terminates process on Windows
+            continue
+        try:
+            os.kill(int(m[1]), 0)
+        except ProcessLookupError:
+            shutil.rmtree(path.join(stagedir, name), ignore_errors=True)
+        except OSError:
+            pass  # alive, but owned by others
+    if stagedir != builder.config.lilypond_builddir:
+        try:
+            os.rmdir(stagedir)
+        except OSError:
+            pass
+
+
+def render_to_builddir(
+    builder, node: lily_inline_node | lily_outline_node
+) -> lilypond.Output:
+    """
+    Render the score of given node and move the outputted files to builder's
+    outdir.
+
+    :raise lilypond.Error: when failed to render the score.
+    """
+    fragments = get_fragments(node)
+    if fragments is not None:
+        return stitch_to_builddir(builder, node, fragments)
+
+    builddir = mkbuilddir(builder, get_node_sig(node))
+    tag_score(node, builddir)
+    try:
+        doc = create_document(node)
+        out = doc.output(builddir, node.get('crop'))
+        out = doc.output_resolutions(
+            out, node.get('crop'), get_png_resolutions(node, out)
+        )
+    except lilypond.Error:
+        shutil.rmtree(builddir)  # cleanup lilypond builddir
+        raise
+    return move_to_builddir(builder, node, out)
+
+
+def get_fragment_output(builder, fragment: dict) -> lilypond.Output:
+    """
+    Return output of fragment (see :func:`get_fragments`) in builder's
+    outdir, picked from global cache or rendered if missing.
+
+    :raise lilypond.Error: when failed to render the fragment.
+    """
+    sig = get_node_sig(fragment)  # type: ignore
+    outfn = path.join(get_builddir(builder), sig)
+    with get_lock(builder, sig):
+        if not path.isdir(outfn) and not pick_from_cache(sig, outfn):
+            return render_to_builddir(builder, fragment)  # type: ignore
+    return lilypond.Output.load(outfn)
+
+
+def stitch_to_builddir(
+    builder, node: lily_inline_node | lily_outline_node, fragments: list[dict]
+) -> lilypond.Output:
+    """
+    Stitch outputs of fragments of node into the output of node (see
+    :func:`lilypond.stitch`), and move it to builder's outdir. Only the
+    fragments that are not rendered yet are rendered.
+
+    :raise lilypond.Error: when failed to render any fragment.
+    """
+    outs = [get_fragment_output(builder, x) for x in fragments]
+    builddir = mkbuilddir(builder, get_node_sig(node))
+    try:
+        out = lilypond.stitch(outs, create_document(node), builddir)
+    except (lilypond.Error, OSError):
+        shutil.rmtree(builddir)
+        raise
+    return move_to_builddir(builder, node, out)
+
+
+def render_batch_to_builddir(
+    builder, nodes: list[lily_inline_node | lily_outline_node]
+) -> list[lilypond.Output | lilypond.Error]:
+    """
+    Like :func:`render_to_builddir`, but render scores of nodes in batch
+    (see :func:`lilypond.output_batch`). Errors are returned rather than raised.
+    """
+    results: list[lilypond.Output | lilypond.Error | None] = [None] * len(nodes)
+    jobs = {}  # index of node -> batch job
+    for i, node in enumerate(nodes):
+        try:
+            doc = create_document(node)
+        except lilypond.Error as e:
+            results[i] = e
+            continue
+        jobs[i] = (doc, mkbuilddir(builder, get_node_sig(node)), node.get('crop'))
+        tag_score(node, jobs[i][1])
+
+    outs = dict(zip(jobs, lilypond.output_batch(list(jobs.values()))))
+    # Extra resolutions of all scores are rendered in batch too.
+    resolution_jobs = {}
+    for i, out in outs.items():
+        if isinstance(out, lilypond.Output):
+            doc, _, crop = jobs[i]
+            resolutions = get_png_resolutions(nodes[i], out)
+            resolution_jobs[i] = (doc, out, crop, resolutions)
+    outs.update(
+        zip(
+            resolution_jobs,
+            lilypond.output_resolutions_batch(list(resolution_jobs.values())),
+        )
+    )
+
+    for i, out in outs.items():
+        if isinstance(out, lilypond.Error):
+            shutil.rmtree(jobs[i][1])  # cleanup lilypond builddir
+            results[i] = out
+        else:
+            results[i] = move_to_builddir(builder, nodes[i], out)
+    return results  # type: ignore
+
+
+def get_inline_score_height() -> float | None:
+    """
+    Return height of inline score in CSS pixels, or None if
+    :confval:`lilypond_inline_score_size` is not an absolute length.
+    """
+    size, unit = parse_html_size(lilypond.Config.inline_score_size)
+    if unit == 'px':
+        return size
+    if unit in ['em', 'rem']:
+        return size * 16  # default font size of browsers
+    return None
+
+
+def get_css_size(
+    node: lily_inline_node | lily_outline_node, out: lilypond.Output, name: str
+) -> tuple[float, float] | None:
+    """Return the displayed size of score in CSS pixels at 1x density."""
+    info = out.files.get(name, {})
+    if 'width' not in info:
+        return None
+    w, h = info['width'], info['height']
+    height = get_inline_score_height() if node.get('inline') else None
+    if height is not None and h:
+        return w * height / h, height
+    if name.endswith('.png'):
+        return (
+            w * 96 / lilypond.Config.png_resolution,
+            h * 96 / lilypond.Config.png_resolution,
+        )
+    return w, h  # SVG is already in CSS pixels
+
+
+def get_png_resolutions(
+    node: lily_inline_node | lily_outline_node, out: lilypond.Output
+) -> list[int]:
+    """
+    Return resolutions of PNG scores that should be outputted for
+    :confval:`lilypond_png_densities`.
+
+    1x of block score is 96 DPI, the CSS reference pixel density. For inline
+    score, the resolution is derived from :confval:`lilypond_inline_score_size`
+    so that the score has exactly the given pixel density at that height.
+    """
+    if 'png' not in lilypond.output_formats() or not lilypond.Config.png_densities:
+        return []
+    dpi = 96  # resolution of 1x
+    cropped_score = out.scores_of('png')[1]
+    if node.get('inline') and cropped_score:
+        name = path.basename(cropped_score)
+        size = get_css_size(node, out, name)
+        if size is not None:
+            dpi = size[1] * lilypond.Config.png_resolution / out.files[name]['height']
+    resolutions = {round(dpi * x) for x in lilypond.Config.png_densities}
+    resolutions.discard(lilypond.Config.png_resolution)
+    return sorted(resolutions)
+
+
 def get_lilypond_output(
     self, node: lily_inline_node | lily_outline_node
 ) -> lilypond.Output:
@@ -246,27 +769,27 @@ def get_lilypond_output(
     if cached:
         logger.debug('using cached result %s' % out.outdir, location=node)
     else:
-        logger.debug('creating a new lilypond document', location=node)
-        doc = lilypond.Document(node['lilysrc'])
-        builddir = self.builder.config.lilypond_builddir or tempfile.mkdtemp(
-            prefix='sphinxnotes-lilypond'
-        )
         try:
-            if node.get('transpose'):
-                from_pitch, to_pitch = node['transpose'].split(' ', maxsplit=1)
-                doc.transpose(from_pitch, to_pitch)
-            out = doc.output(builddir, node.get('crop'))
+            e = _failures.get(get_node_sig(node))
+            if e is not None:
+                raise e
+            with get_lock(self.builder, get_node_sig(node)):
+                # The score may be rendered by other writer while we are
+                # waiting for the lock.
+                out = pick_from_builddir(self.builder, node)
+                if out is None:
+                    logger.debug('creating a new lilypond document', location=node)
+                    out = render_to_builddir(self.builder, node)
+                    # Get relative path
+                    _, reldir = get_builddir_and_reldir(self.builder, node)
+                    out.relocate(posixpath.join(reldir, get_node_sig(node)))
         except lilypond.Error as e:
             logger.warning('failed to generate scores: %s' % e, location=node)
             sm = nodes.system_message(
                 e, type='WARNING', level=2, backrefs=[], source=node['lilysrc']
             )
             sm.walkabout(self)
-            shutil.rmtree(builddir)  # cleanup lilypond builddir
             raise nodes.SkipNode
-        else:
-            # Get relative path
-            move_to_builddir(self.builder, node, out)
     return out
 
 
@@ -288,9 +811,18 @@ def html_visit_lily_node(self, node: lily_inline_node | lily_outline_node):
                 )
             self.body.append('</select>')
 
+        # When preload is "none", audio is not fetched until played. Source is
+        # always given by "src", so that players work without JavaScript
+        # (for example, in EPUB readers).
         self.body.append(
-            '<audio controls class="%s" style="%s" src="%s" %s></audio>'
-            % (_CLS, style, out.audios[0], 'loop' if node.get('loop') else '')
+            '<audio controls class="%s" style="%s" preload="%s" src="%s" %s></audio>'
+            % (
+                _CLS,
+                style,
+                self.builder.config.lilypond_audio_preload,
+                out.audios[0],
+                'loop' if node.get('loop') else '',
+            )
         )
 
     out = get_lilypond_output(self, node)
@@ -315,11 +847,15 @@ def html_visit_lily_node(self, node: lily_inline_node | lily_outline_node):
     scores = []
     score_style = ''
     if isinstance(node, lily_inline_node):
-        score_style = 'height: %s;' % self.builder.config.lilypond_inline_score_size
+        # Width follows the height, rather than the width attribute.
+        score_style = (
+            'height: %s; width: auto;' % self.builder.config.lilypond_inline_score_size
+        )
         if out.cropped_score:  # inline node MUST use cropped score
             scores.append(out.cropped_score)
     else:
-        score_style = 'width: 100%;'
+        # Height follows the width, rather than the height attribute.
+        score_style = 'width: 100%; height: auto;'
         if out.cropped_score:
             scores.append(out.cropped_score)
         elif out.score:
@@ -329,11 +865,18 @@ def html_visit_lily_node(self, node: lily_inline_node | lily_outline_node):
     if not scores:
         raise_no_score_message_and_skip(self, node)
 
-    for score in scores:
-        self.body.append(
-            '<img class="%s" src="%s" alt="%s" style="%s"/>'
-            % (_CLS, score, self.encode(node['lilysrc']).strip(), score_style)
-        )
+    if not html_inline_svg_scores(self, node, out, scores, score_style):
+        for score in scores:
+            self.body.append(
+                '<img class="%s" src="%s" alt="%s" style="%s"%s loading="lazy"/>'
+                % (
+                    _CLS,
+                    score,
+                    self.encode(node['lilysrc']).strip(),
+                    score_style,
+                    get_img_attrs(node, out, score),
+                )
+            )
 
     if node.get('audio') and out.audios and node.get('controls') == 'bottom':
         append_audio()
@@ -347,6 +890,95 @@ def html_visit_lily_node(self, node: lily_inline_node | lily_outline_node):
     raise nodes.SkipNode
 
 
+def html_visit_lily_transpose_node(self, node: lily_transpose_node):
+    # Key selector, variants are switched by our JavaScript,
+    # see static/sphinxnotes-lilypond.js.
+    self.body.append(self.starttag(node, 'div', CLASS=_CLS + '-transpose'))
+    self.body.append('<select class="%s" aria-label="Key">' % _CLS)
+    for i, child in enumerate(node.children):
+        from_pitch, to_pitch = child['transpose'].split()
+        self.body.append(
+            '<option value="%d" %s>%s → %s</option>'
+            % (i, 'selected' if i == 0 else '', from_pitch, to_pitch)
+        )
+    self.body.append('</select>')
+
+
+def html_depart_lily_transpose_node(self, node: lily_transpose_node):
+    self.body.append('</div>')
+
+
+def get_img_attrs(
+    node: lily_inline_node | lily_outline_node, out: lilypond.Output, score: str
+) -> str:
+    """
+    Return the intrinsic size and srcset (see :confval:`lilypond_png_densities`)
+    attributes of ``<img>`` of the score.
+    """
+    name = posixpath.basename(score)
+    size = get_css_size(node, out, name)
+    if size is None:
+        return ''
+    attrs = ' width="%d" height="%d"' % (round(size[0]), round(size[1]))
+
+    variants = out.variants.get(name)
+    if variants:
+        srcset = {}
+        for fn in [name, *variants.values()]:
+            if fn in out.files:
+                density = out.files[fn]['height'] / size[1]
+                srcset.setdefault('%.3gx' % density, posixpath.join(out.outdir, fn))
+        attrs += ' srcset="%s"' % ', '.join(
+            '%s %s' % (uri, density)
+            for density, uri in sorted(srcset.items(), key=lambda x: float(x[0][:-1]))
+        )
+    return attrs
+
+
+def html_inline_svg_scores(
+    self,
+    node: lily_inline_node | lily_outline_node,
+    out: lilypond.Output,
+    scores: list[str],
+    score_style: str,
+) -> bool:
+    """
+    Inline SVG scores into HTML page when :confval:`lilypond_inline_svg` is
+    enabled, glyphs of scores are defined once per page
+    (see :func:`_on_html_page_context`).
+
+    :return: False if scores can not be inlined.
+    """
+    config = self.builder.config
+    if not config.lilypond_inline_svg or lilypond.Config.score_format != 'svg':
+        return False
+    outdir = path.join(get_builddir(self.builder), get_node_sig(node))
+    processed = svg.load(outdir)
+    if processed is None:
+        return False
+    svgs, glyphs = processed
+
+    names = [posixpath.basename(x) for x in scores]
+    if any(x not in svgs for x in names):
+        return False
+    page_glyphs, sizes = _svg_pages.setdefault(
+        self.builder.current_docname, ({}, [0, 0])
+    )
+    page_glyphs.update(glyphs)
+    attrs = 'class="%s" style="%s" role="img" aria-label="%s"' % (
+        _CLS,
+        score_style,
+        self.attval(node['lilysrc'].strip()),
+    )
+    for name in names:
+        html = svg.to_html(svgs[name], attrs)
+        self.body.append(html)
+        sizes[0] += out.files.get(name, {}).get('size', 0)
+        # Attributes are not counted, they are also needed by ``<img>``.
+        sizes[1] += len(html.encode('utf-8')) - len(attrs.encode('utf-8'))
+    return True
+
+
 def latex_visit_lily_node(self, node: lily_inline_node | lily_outline_node):
     """
     See sphinx/sphinx/writers/latex.py::visit_image().
@@ -357,9 +989,8 @@ def latex_visit_lily_node(self, node: lily_inline_node | lily_outline_node):
     options = ''
 
     scores = []
-    is_inline = False
-    if isinstance(node, lily_outline_node):
-        is_inline = True
+    is_inline = isinstance(node, lily_inline_node)
+    if is_inline:
         if out.cropped_score:  # inline node MUST use cropped score
             scores.append(out.cropped_score)
     else:
@@ -387,11 +1018,32 @@ def latex_visit_lily_node(self, node: lily_inline_node | lily_outline_node):
     raise nodes.SkipNode
 
 
+def latex_visit_lily_transpose_node(self, node: lily_transpose_node):
+    # All transposed scores are printed one by one.
+    pass
+
+
+def latex_depart_lily_transpose_node(self, node: lily_transpose_node):
+    pass
+
+
 def read_source_file(env: BuildEnvironment, fn: str) -> str:
     """
     Read the score source from a local file. Can be an absolute path
     (relative to the root of srcdir) or relative path (relative to the current document).
     """
+    fn = get_source_path(str(env.srcdir), str(env.doc2path(env.docname)), fn)
+    with open(fn, 'r') as f:
+        # Febuild the current document if the file changes.
+        env.note_dependency(fn)
+        return f.read()
+
+
+def get_source_path(srcdir: str, docpath: str, fn: str) -> str:
+    """
+    Return file system path of score source file *fn* referenced by document
+    at *docpath*, see :func:`read_source_file`.
+    """
     if path.isabs(fn):
         # Source dir absolute path to file system absolute path.
         #
@@ -402,14 +1054,9 @@ def read_source_file(env: BuildEnvironment, fn: str) -> str:
         #
         # NOTE: CANNOT use path.join because fn is absolute.
         # join('/foo', '/bar') finally get '/bar'.
-        fn = str(env.srcdir) + fn
-    else:
-        # Document relative path to file system absolute path.
-        fn = path.join(path.dirname(env.doc2path(env.docname)), fn)
-    with open(fn, 'r') as f:
-        # Febuild the current document if the file changes.
-        env.note_dependency(fn)
-        return f.read()
+        return srcdir + fn
+    # Document relative path to file system absolute path.
+    return path.join(path.dirname(docpath), fn)
 
 
 def parse_html_size(sz: str) -> tuple[float, str]:
@@ -433,13 +1080,38 @@ def raise_no_score_message_and_skip(self, node):
     raise nodes.SkipNode
 
 
+def get_score_formats(config: Config) -> list[str]:
+    """Return all formats of :confval:`lilypond_score_format`."""
+    fmt = config.lilypond_score_format
+    if isinstance(fmt, str):
+        return [fmt]
+    return sorted(set(fmt.values())) or ['png']
+
+
+def get_score_format(config: Config, builder) -> str:
+    """
+    Return format of :confval:`lilypond_score_format` for given builder,
+    looked up by builder's name then format.
+    """
+    fmt = config.lilypond_score_format
+    if isinstance(fmt, str):
+        return fmt
+    for key in [builder.name, builder.format]:
+        if key in fmt:
+            return fmt[key]
+    return get_score_formats(config)[0]
+
+
 def _config_inited(app: Sphinx, config: Config) -> None:
     lilypond.Config.lilypond_args = config.lilypond_lilypond_args
     lilypond.Config.timidity_args = config.lilypond_timidity_args
     lilypond.Config.ffmpeg_args = config.lilypond_ffmpeg_args
 
-    lilypond.Config.score_format = config.lilypond_score_format
+    lilypond.Config.score_formats = get_score_formats(config)
+    lilypond.Config.score_format = lilypond.Config.score_formats[0]
     lilypond.Config.png_resolution = config.lilypond_png_resolution
+    lilypond.Config.png_densities = config.lilypond_png_densities
+    lilypond.Config.inline_score_size = config.lilypond_inline_score_size
     lilypond.Config.include_paths = [
         # ./foo => ./foo; /foo => SRCDIR/foo
         p if not path.isabs(p) else str(app.srcdir) + p
@@ -448,25 +1120,366 @@ def _config_inited(app: Sphinx, config: Config) -> None:
 
     lilypond.Config.audio_format = config.lilypond_audio_format
     lilypond.Config.audio_volume = config.lilypond_audio_volume
+    lilypond.Config.audio_workers = config.lilypond_audio_workers
+    lilypond.Config.split_movements = config.lilypond_split_movements
+    lilypond.Config.inline_svg = config.lilypond_inline_svg
+    lilypond.fingerprint.cache_clear()
+
+    lilypond.Config.workers = config.lilypond_workers
+    lilypond.Config.worker_max_jobs = config.lilypond_worker_max_jobs
+    lilypond.Config.worker_max_rss = config.lilypond_worker_max_memory
+    lilypond.Config.worker_timeout = config.lilypond_worker_timeout
+    jianpu.Config.workers = config.lilypond_jianpu_workers
 
     app.config.html_static_path.append(str(static.dir()))
 
 
-def _on_html_page_context(
-    app: Sphinx, pagename: str, templatename: str, context, doctree: nodes.document
+def _on_builder_inited(app: Sphinx) -> None:
+    global _cache, _local_cache
+    lilypond.Config.score_format = get_score_format(app.config, app.builder)
+    if app.config.lilypond_perf:
+        perf.enable()
+    else:
+        perf.disable()
+    if app.config.lilypond_cache_dir:
+        cachedir = path.join(app.confdir, app.config.lilypond_cache_dir)
+    else:
+        # Scores are not cached here unless they are mirrored from
+        # :confval:`lilypond_cache_url`, but audios and Jianpu conversions are.
+        cachedir = path.join(app.doctreedir, 'lilypond-cache')
+    _local_cache = cache.Cache(cachedir, app.config.lilypond_cache_size)
+    if app.config.lilypond_cache_url:
+        _cache = cache.HTTPCache(app.config.lilypond_cache_url, _local_cache)
+    elif app.config.lilypond_cache_dir:
+        _cache = _local_cache
+    else:
+        _cache = None
+    # Evicted together with the score cache, see :attr:`cache.Cache.SUBDIRS`.
+    lilypond.Config.audio_cache = cache.Cache(path.join(cachedir, '.audio'))
+    jianpu.Config.cache_dir = path.join(cachedir, '.jianpu')
+
+    if not hasattr(app.env, 'lilypond_scores'):
+        # Mapping from docname to render attributes of its scores.
+        app.env.lilypond_scores = {}  # type: ignore
+
+
+def read_directive_blocks(source: str) -> list[tuple[int, str, str, dict, str]]:
+    """
+    Roughly extract directives of this extension from reStructuredText source,
+    the result may differ from what docutils parses.
+
+    :return: list of (line number, directive name, argument, options, content).
+    """
+    blocks = []
+    lines = source.splitlines()
+    i = 0
+    while i < len(lines):
+        m = _DIRECTIVE_RE.match(lines[i])
+        i += 1
+        if not m:
+            continue
+        lineno, indent = i, len(m.group(1))
+        block = []
+        while i < len(lines) and (
+            not lines[i].strip() or len(lines[i]) - len(lines[i].lstrip()) > indent
+        ):
+            block.append(lines[i])
+            i += 1
+        options = {}
+        while block and (opt := _OPTION_RE.match(block[0].strip())):
+            options[opt.group(1)] = opt.group(2)
+            block.pop(0)
+        content = textwrap.dedent('\n'.join(block)).strip('\n')
+        blocks.append((lineno, m.group(2), m.group(3) or '', options, content))
+    return blocks
+
+
+def read_jianpu_blocks(source: str) -> list[str]:
+    """Roughly extract contents of jianpu directives, see :func:`read_directive_blocks`."""
+    return [
+        content
+        for _, name, _, _, content in read_directive_blocks(source)
+        if name == 'jianpu' and content
+    ]
+
+
+def _on_source_read(app: Sphinx, docname: str, source: list[str]) -> None:
+    # Convert Jianpu scores of document in parallel before they are parsed,
+    # see :func:`jianpu.prefetch`.
+    for block in read_jianpu_blocks(source[0]):
+        jianpu.prefetch(block)
+
+
+def _on_env_purge_doc(app: Sphinx, env: BuildEnvironment, docname: str) -> None:
+    env.lilypond_scores.pop(docname, None)  # type: ignore
+
+
+def _on_env_merge_info(
+    app: Sphinx, env: BuildEnvironment, docnames: set[str], other: BuildEnvironment
 ) -> None:
-    if not doctree:
+    for docname in docnames:
+        if docname in other.lilypond_scores:  # type: ignore
+            env.lilypond_scores[docname] = other.lilypond_scores[docname]  # type: ignore
+
+
+def _on_doctree_read(app: Sphinx, doctree: nodes.document) -> None:
+    scores = []
+    for node in doctree.findall(
+        lambda x: isinstance(x, (lily_inline_node, lily_outline_node))
+    ):
+        scores.append({k: node.get(k) for k in _RENDER_ATTRS})
+    if scores:
+        app.env.lilypond_scores[app.env.docname] = scores  # type: ignore
+
+
+def _on_env_updated(app: Sphinx, env: BuildEnvironment) -> None:
+    """
+    Render all uncached scores concurrently before the writer runs, so that
+    visitors only need to pick outputs from builder's outdir.
+    """
+    if not isinstance(app.builder, (StandaloneHTMLBuilder, LaTeXBuilder)):
         return
-    if (
-        doctree.next_node(
-            lambda x: isinstance(x, (lily_inline_node, lily_outline_node))
+
+    scores = [
+        score
+        for docname in sorted(env.lilypond_scores)  # type: ignore
+        for score in env.lilypond_scores[docname]  # type: ignore
+    ]
+    _failures.clear()
+    for score, e in render_scores(app, get_uncached_scores(app.builder, scores)):
+        # Failure is reported by visitor with proper location.
+        _failures[get_node_sig(score)] = e  # type: ignore
+        logger.debug('failed to pre-render score: %s' % e, location=score['docname'])
+
+
+def get_uncached_scores(builder, scores: list[dict]) -> list[dict]:
+    """Return scores not in builder's outdir or global cache, deduplicated by signature."""
+    pending = {}
+    for score in scores:
+        sig = get_node_sig(score)  # type: ignore
+        if sig not in pending and not path.isdir(path.join(get_builddir(builder), sig)):
+            pending[sig] = score
+    if _cache is not None:
+        # Query backend in bulk rather than once per score.
+        for sig in _cache.query(pending):
+            pick_from_cache(sig, path.join(get_builddir(builder), sig))
+            del pending[sig]
+    return list(pending.values())
+
+
+def render_scores(app: Sphinx, scores: list[dict]) -> list[tuple[dict, lilypond.Error]]:
+    """
+    Render scores concurrently in batches to builder's outdir (and global
+    cache). Scores being rendered by others are skipped.
+
+    :return: the failed scores and their errors.
+    """
+    if not scores:
+        return []
+    failures = []
+
+    # Fragments of split scores are rendered in batches like other scores,
+    # and stitched together at the end.
+    split = []
+    fragment_of = {}  # signature of fragment -> the split score
+    expanded = []
+    for score in scores:
+        fragments = get_fragments(score)  # type: ignore
+        if fragments is None:
+            expanded.append(score)
+            continue
+        split.append((score, fragments))
+        for x in fragments:
+            fragment_of.setdefault(get_node_sig(x), score)  # type: ignore
+        expanded += fragments
+    scores = get_uncached_scores(app.builder, expanded) if split else scores
+
+    def render(scores):
+        locks = []
+        todo = []
+        for score in scores:
+            sig = get_node_sig(score)
+            lock = get_lock(app.builder, sig)
+            if not lock.acquire(blocking=False):
+                # Being rendered by others, visitor will wait for it.
+                continue
+            locks.append(lock)
+            outfn = path.join(get_builddir(app.builder), sig)
+            if path.isdir(outfn) or pick_from_cache(sig, outfn):
+                continue
+            todo.append(score)
+        try:
+            for score, res in zip(todo, render_batch_to_builddir(app.builder, todo)):
+                if isinstance(res, lilypond.Error):
+                    sig = get_node_sig(score)
+                    failures.append((fragment_of.get(sig, score), res))
+        finally:
+            for lock in locks:
+                lock.release()
+        return scores
+
+    # Split scores into batches, scores with same arguments are grouped
+    # together, and every worker gets at least one batch. Transposed variants
+    # of a score are never split across batches, so they are rendered by the
+    # same LilyPond run.
+    workers = app.config.lilypond_render_workers or os.cpu_count() or 1
+    scores = sorted(scores, key=lambda x: bool(x.get('crop')))
+    size = min(app.config.lilypond_batch_size, -(-len(scores) // workers))
+    variants: dict[tuple, list[dict]] = {}
+    for score in scores:
+        key = (score['docname'], score['lilysrc'], bool(score.get('crop')))
+        variants.setdefault(key, []).append(score)
+    batches: list[list[dict]] = []
+    for group in variants.values():
+        if batches and len(batches[-1]) + len(group) <= size:
+            batches[-1] += group
+        else:
+            batches.append(group.copy())
+
+    start = time.monotonic()
+    done = 0
+
+    def stringify(f) -> str:
+        nonlocal done
+        done += len(f.result())
+        eta = (time.monotonic() - start) / done * (len(scores) - done)
+        docnames = ' '.join(sorted({x['docname'] for x in f.result()}))
+        return '%s (ETA %ds)' % (docnames, eta) if eta >= 1 else docnames
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render, batch) for batch in batches]
+        for _ in status_iterator(
+            as_completed(futures),
+            'rendering lilypond scores... ',
+            'darkgreen',
+            len(futures),
+            app.verbosity,
+            stringify_func=stringify,
+        ):
+            pass
+
+    failed = {id(x) for x, _ in failures}
+    for score, fragments in split:
+        if id(score) in failed:
+            continue
+        try:
+            stitch_to_builddir(app.builder, score, fragments)  # type: ignore
+        except lilypond.Error as e:
+            failures.append((score, e))
+    return failures
+
+
+def report_perf(app: Sphinx, recorder: perf.Recorder) -> None:
+    """Print summary of :mod:`.perf` records and dump them to a JSON file."""
+    totals = recorder.totals()
+    if not totals:
+        return
+    logger.info(bold('lilypond perf: '))
+    for name, total in sorted(totals.items(), key=lambda x: -x[1]['time']):
+        logger.info(
+            '  %-20s %6d runs %9.2fs%s',
+            name,
+            total['count'],
+            total['time'],
+            ''
+            if total['maxrss'] is None
+            else ', largest child process RSS %s'
+            % cache.format_size(total['maxrss'] * 1024),
         )
-        is None
+    scores = recorder.scores()
+    top = app.config.lilypond_perf_top
+    if top and scores:
+        logger.info(bold('lilypond perf: top %d slowest scores: ') % top)
+        for score in scores[:top]:
+            logger.info(
+                '  %7.2fs %s %s (%s)',
+                score['time'],
+                score['docname'],
+                score['sig'][:12],
+                ', '.join(
+                    '%s %.2fs' % x
+                    for x in sorted(score['stages'].items(), key=lambda x: -x[1])
+                ),
+            )
+    fn = path.join(app.doctreedir, 'lilypond-perf.json')
+    with open(fn, 'w') as f:
+        json.dump(recorder.dump(), f, indent=1)
+    logger.info('lilypond perf: records are written to %s', fn)
+
+
+def _on_build_finished(app: Sphinx, exception) -> None:
+    if perf.recorder is not None:
+        report_perf(app, perf.recorder)
+    if isinstance(app.builder, (StandaloneHTMLBuilder, LaTeXBuilder)):
+        clean_stagedir(app.builder)
+    if (
+        exception is None
+        and app.config.lilypond_gc
+        and isinstance(app.builder, (StandaloneHTMLBuilder, LaTeXBuilder))
     ):
-        return  # no lilypond score, skip
+        dry_run = app.config.lilypond_gc == 'dry-run'
+        stale = gc_builddir(app.builder, get_used_sigs(app.env), dry_run)
+        action = 'would remove' if dry_run else 'removed'
+        for entry, size in stale:
+            logger.verbose(
+                'lilypond gc: %s %s (%s)', action, entry, cache.format_size(size)
+            )
+        if stale:
+            logger.info(
+                'lilypond gc: %s %d unreferenced entries (%s) in %s',
+                action,
+                len(stale),
+                cache.format_size(sum(x[1] for x in stale)),
+                get_builddir(app.builder),
+            )
+    flush_cache()
+    jianpu.discard_prefetches()
+    # Pages written by parallel processes are not counted, in which case the
+    # sizes of each page are only reported in verbose mode.
+    if _svg_sizes[0] and app.parallel <= 1:
+        logger.info(
+            'lilypond svg: %s of scores, %s after inlining',
+            cache.format_size(_svg_sizes[0]),
+            cache.format_size(_svg_sizes[1]),
+        )
+        _svg_sizes[:] = [0, 0]
+    audio_cache = lilypond.Config.audio_cache
+    if audio_cache is not None and audio_cache.hits + audio_cache.misses:
+        logger.info('lilypond audio cache: %s' % audio_cache.stats())
+
+
+def _on_html_page_context(
+    app: Sphinx, pagename: str, templatename: str, context, doctree: nodes.document
+) -> None:
+    if pagename not in app.env.lilypond_scores:  # type: ignore
+        # Scores of singlehtml builder come from the included sub-documents,
+        # look for them in the assembled doctree.
+        if (
+            not doctree
+            or pagename != app.config.root_doc
+            or doctree.next_node(
+                lambda x: isinstance(x, (lily_inline_node, lily_outline_node))
+            )
+            is None
+        ):
+            return  # no lilypond score, skip
     app.add_js_file('sphinxnotes-lilypond.js')
     app.add_css_file('sphinxnotes-lilypond.css')
 
+    if pagename in _svg_pages and 'body' in context:
+        glyphs, (before, after) = _svg_pages.pop(pagename)
+        sprite = svg.sprite(glyphs)
+        context['body'] = sprite + context['body']
+        after += len(sprite.encode('utf-8'))
+        _svg_sizes[0] += before
+        _svg_sizes[1] += after
+        logger.verbose(
+            'lilypond svg: %s: %s of scores, %s after inlining',
+            pagename,
+            cache.format_size(before),
+            cache.format_size(after),
+        )
+
 
 def setup(app: Sphinx):
     meta.pre_setup(app)
@@ -481,6 +1494,11 @@ def setup(app: Sphinx):
         html=(html_visit_lily_node, None),
         latex=(latex_visit_lily_node, None),
     )
+    app.add_node(
+        lily_transpose_node,
+        html=(html_visit_lily_transpose_node, html_depart_lily_transpose_node),
+        latex=(latex_visit_lily_transpose_node, latex_depart_lily_transpose_node),
+    )
     app.add_role('lily', lily_role)
     app.add_directive('lily', LilyDirective)
     app.add_directive('lilyinclude', LilyIncludeDirective)
@@ -493,17 +1511,46 @@ def setup(app: Sphinx):
     app.add_config_value('lilypond_timidity_args', ['timidity'], 'env')
     app.add_config_value('lilypond_ffmpeg_args', ['ffmpeg'], 'env')
     app.add_config_value('lilypond_builddir', None, 'env')
-
-    app.add_config_value('lilypond_score_format', 'png', 'env')
+    app.add_config_value('lilypond_render_workers', None, '')
+    app.add_config_value('lilypond_batch_size', 16, '')
+    app.add_config_value('lilypond_workers', 0, '')
+    app.add_config_value('lilypond_worker_max_jobs', 100, '')
+    app.add_config_value('lilypond_worker_max_memory', None, '')
+    app.add_config_value('lilypond_worker_timeout', 600, '')
+    app.add_config_value('lilypond_cache_dir', None, '')
+    app.add_config_value('lilypond_cache_size', None, '')
+    app.add_config_value('lilypond_cache_url', None, '')
+    app.add_config_value('lilypond_gc', True, '', types=[bool, str])
+    app.add_config_value('lilypond_perf', False, '')
+    app.add_config_value('lilypond_perf_top', 10, '')
+
+    app.add_config_value('lilypond_score_format', 'png', 'env', types=[str, dict])
     app.add_config_value('lilypond_png_resolution', 300, 'env')
+    app.add_config_value('lilypond_png_densities', [], 'env')
     app.add_config_value('lilypond_inline_score_size', '2.5em', 'env')
+    app.add_config_value('lilypond_inline_svg', False, 'env')
     app.add_config_value('lilypond_include_paths', [], 'env')
+    app.add_config_value('lilypond_split_movements', False, 'env')
     # TODO: Font size
 
     app.add_config_value('lilypond_audio_format', 'wav', 'env')
     app.add_config_value('lilypond_audio_volume', None, 'env')
+    app.add_config_value('lilypond_audio_preload', 'none', 'html')
+    app.add_config_value('lilypond_audio_workers', None, '')
+    app.add_config_value('lilypond_jianpu_workers', None, '')
 
     app.connect('config-inited', _config_inited)
+    app.connect('builder-inited', _on_builder_inited)
+    app.connect('source-read', _on_source_read)
+    app.connect('env-purge-doc', _on_env_purge_doc)
+    app.connect('env-merge-info', _on_env_merge_info)
+    app.connect('doctree-read', _on_doctree_read)
+    app.connect('env-updated', _on_env_updated)
     app.connect('html-page-context', _on_html_page_context)
+    app.connect('build-finished', _on_build_finished)
 
-    return meta.post_setup(app)
+    ext = meta.post_setup(app)
+    # Bump it when data stored in build environment changes, so that all
+    # documents are re-read, see :func:`_on_doctree_read`.
+    ext['env_version'] = 3
+    return ext
@@ -0,0 +1,216 @@
+"""
+sphinxnotes.lilypond.__main__
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Command line interface of the extension.
+
+``python -m sphinxnotes.lilypond prewarm <srcdir>`` scans reStructuredText
+documents of a Sphinx project for scores, and renders the uncached ones in
+parallel into the builder's outdir and the global score cache
+(:confval:`lilypond_cache_dir`), without reading and writing documents.
+It can run ahead of ``sphinx-build`` as a separate, cacheable CI step.
+
+``python -m sphinxnotes.lilypond export <cachedir> <archive>`` and
+``python -m sphinxnotes.lilypond import <archive> <cachedir>`` move the
+score cache between machines as a single compressed archive.
+
+:copyright: Copyright ©2025 by Shengyu Zhang.
+:license: BSD, see LICENSE for details.
+"""
+
+from __future__ import annotations
+import re
+import sys
+import argparse
+import tarfile
+from os import path
+
+from sphinx.application import Sphinx
+from sphinx.builders.html import StandaloneHTMLBuilder
+from sphinx.builders.latex import LaTeXBuilder
+
+from . import (
+    clean_stagedir,
+    flush_cache,
+    get_includes,
+    get_inline_lilysrc,
+    get_node_sig,
+    get_source_path,
+    get_uncached_scores,
+    parse_transpose,
+    read_directive_blocks,
+    render_scores,
+)
+from . import cache
+from . import jianpu
+from . import perf
+
+_ROLE_RE = re.compile(r':lily:`((?:[^`\\]|\\.)+?)`', re.DOTALL)
+
+
+def scan_document(app: Sphinx, docname: str) -> tuple[list[dict], list[str]]:
+    """
+    Return render attributes (see :data:`._RENDER_ATTRS`) of scores in
+    document, and errors of the scores that can not be read.
+    """
+    docpath = str(app.env.doc2path(docname))
+    with open(docpath, 'r', encoding='utf-8-sig') as f:
+        source = f.read()
+
+    scores = []
+    errors = []
+    for text in _ROLE_RE.findall(source):
+        scores.append(_score(docname, get_inline_lilysrc(text), True, None, True))
+    for lineno, name, arg, options, content in read_directive_blocks(source):
+        location = '%s:%d' % (docpath, lineno)
+        try:
+            if name.endswith('include'):
+                fn = get_source_path(str(app.srcdir), docpath, arg)
+                with open(fn, 'r') as f:
+                    src = f.read()
+            else:
+                src = content
+            if name.startswith('jianpu'):
+                src = jianpu.to_lilypond(src)
+            transposes = parse_transpose(options.get('transpose'))
+        except (OSError, ValueError, jianpu.Error) as e:
+            errors.append('%s: %s' % (location, e))
+            continue
+        for transpose in transposes:
+            crop = 'nocrop' not in options
+            scores.append(_score(docname, src, crop, transpose, False))
+    return scores, errors
+
+
+def _score(
+    docname: str, lilysrc: str, crop: bool, transpose: str | None, inline: bool
+) -> dict:
+    return {
+        'docname': docname,
+        'lilysrc': lilysrc,
+        'includes': get_includes(lilysrc)[1],
+        'crop': crop,
+        'transpose': transpose,
+        'inline': inline,
+    }
+
+
+def prewarm(args: argparse.Namespace) -> int:
+    outdir = args.outdir or path.join(args.srcdir, '_build', args.builder)
+    confoverrides = dict(x.split('=', maxsplit=1) for x in args.define)
+    if args.jobs:
+        confoverrides['lilypond_render_workers'] = args.jobs
+    app = Sphinx(
+        args.srcdir,
+        args.confdir or args.srcdir,
+        outdir,
+        args.doctreedir or path.join(outdir, '.doctrees'),
+        args.builder,
+        confoverrides,
+        status=sys.stdout if args.verbose else None,
+        warning=sys.stderr,
+        verbosity=args.verbose,
+    )
+    if not isinstance(app.builder, (StandaloneHTMLBuilder, LaTeXBuilder)):
+        print('builder %s is not supported' % args.builder, file=sys.stderr)
+        return 2
+    recorder = perf.enable()
+
+    app.env.find_files(app.config, app.builder)
+    scores = []
+    errors = []
+    for docname in sorted(app.env.found_docs):
+        s, e = scan_document(app, docname)
+        scores += s
+        errors += e
+    pending = get_uncached_scores(app.builder, scores)
+    print(
+        '%d scores (%d unique) found, %d uncached'
+        % (len(scores), len({get_node_sig(x) for x in scores}), len(pending))  # type: ignore
+    )
+
+    for score, e in render_scores(app, pending):
+        errors.append('%s: failed to render score: %s' % (score['docname'], e))
+
+    clean_stagedir(app.builder)
+    flush_cache()
+
+    for record in recorder.scores():
+        print(
+            '%8.2fs  %s  %s  (%s)'
+            % (
+                record['time'],
+                record['sig'][:12],
+                record['docname'],
+                ', '.join('%s %.2fs' % x for x in record['stages'].items()),
+            )
+        )
+    for e in errors:
+        print(e, file=sys.stderr)
+    return 1 if errors else 0
+
+
+def export(args: argparse.Namespace) -> int:
+    n = cache.export_archive(args.cachedir, args.archive)
+    print('%d entries exported to %s' % (n, args.archive))
+    return 0
+
+
+def import_(args: argparse.Namespace) -> int:
+    n = cache.import_archive(args.archive, args.cachedir)
+    print('%d entries imported to %s' % (n, args.cachedir))
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m sphinxnotes.lilypond',
+        description=__doc__.split('\n\n')[1],
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser(
+        'prewarm', help='render uncached scores of a Sphinx project'
+    )
+    p.add_argument('srcdir', help='source directory of Sphinx project')
+    p.add_argument(
+        'outdir', nargs='?', help='output directory, defaults to SRCDIR/_build/BUILDER'
+    )
+    p.add_argument('-b', '--builder', default='html', help='html (default) or latex')
+    p.add_argument('-c', '--confdir', help='directory of conf.py, defaults to SRCDIR')
+    p.add_argument(
+        '-d', '--doctreedir', help='doctree directory, defaults to OUTDIR/.doctrees'
+    )
+    p.add_argument('-j', '--jobs', type=int, help='override lilypond_render_workers')
+    p.add_argument(
+        '-D',
+        dest='define',
+        action='append',
+        default=[],
+        metavar='NAME=VALUE',
+        help='override a setting in conf.py',
+    )
+    p.add_argument('-v', '--verbose', action='count', default=0)
+
+    p.set_defaults(func=prewarm)
+
+    p = commands.add_parser('export', help='export score cache to an archive')
+    p.add_argument('cachedir', help='cache directory (lilypond_cache_dir)')
+    p.add_argument('archive', help='archive file to write (.tar.gz)')
+    p.set_defaults(func=export)
+
+    p = commands.add_parser('import', help='import score cache from an archive')
+    p.add_argument('archive', help='archive file written by export')
+    p.add_argument('cachedir', help='cache directory (lilypond_cache_dir)')
+    p.set_defaults(func=import_)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except (OSError, tarfile.TarError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
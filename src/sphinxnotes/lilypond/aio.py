@@ -0,0 +1,72 @@
+"""
+sphinxnotes.lilypond.aio
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Subprocess helpers of the asyncio API (:meth:`.lilypond.Document.output_async`
+and :func:`.midi.to_audio_async`), for using the binding outside Sphinx.
+
+All subprocesses started by the API share a semaphore per event loop, so that
+at most :data:`max_concurrency` of them run at the same time. Subprocesses are
+killed when they time out or their awaiting task is cancelled.
+
+:copyright: Copyright ©2025 by Shengyu Zhang.
+:license: BSD, see LICENSE for details.
+"""
+
+from __future__ import annotations
+import os
+import asyncio
+import weakref
+from asyncio.subprocess import PIPE, Process
+
+# Max number of concurrent subprocesses per event loop, defaults to number of
+# CPUs. Takes effect on event loops that have not used the API yet.
+max_concurrency: int | None = None
+
+_semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def semaphore() -> asyncio.Semaphore:
+    """Return the semaphore of running event loop."""
+    loop = asyncio.get_running_loop()
+    sem = _semaphores.get(loop)
+    if sem is None:
+        sem = _semaphores[loop] = asyncio.Semaphore(
+            max_concurrency or os.cpu_count() or 1
+        )
+    return sem
+
+
+async def kill(proc: Process) -> None:
+    """Kill the subprocess if it is still running, and reap it."""
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+    await proc.wait()
+
+
+async def run(
+    args: list[str], timeout: float | None = None, input: bytes | None = None
+) -> tuple[int, bytes, bytes]:
+    """
+    Run command and return its exit code, stdout and stderr. *input* is fed
+    to stdin of the command if given.
+
+    :raise TimeoutError: when command does not exit in *timeout* seconds.
+    :raise OSError: when command can not be run.
+    """
+    async with semaphore():
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdin=None if input is None else PIPE, stdout=PIPE, stderr=PIPE
+        )
+        try:
+            async with asyncio.timeout(timeout):
+                stdout, stderr = await proc.communicate(input)
+        except BaseException:  # including cancellation
+            await asyncio.shield(kill(proc))
+            raise
+    return proc.returncode, stdout, stderr  # type: ignore
@@ -0,0 +1,661 @@
+"""
+sphinxnotes.lilypond.cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Content-addressed cache of LilyPond outputs, which can be shared across
+builders and build trees (:class:`Cache`), and across machines
+(:class:`HTTPCache`, and :func:`export_archive` / :func:`import_archive`).
+
+:copyright: Copyright ©2025 by Shengyu Zhang.
+:license: BSD, see LICENSE for details.
+"""
+
+from __future__ import annotations
+import os
+from os import path
+import errno
+import io
+import tarfile
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable
+
+from sphinx.util import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+
+# Read once, os.umask can only be read by setting it, which is not thread-safe.
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+def mkstagedir(dir: str, prefix: str = '.tmp-') -> str:
+    """
+    Create a uniquely named directory in *dir* for staging files that will be
+    published by renaming it. Unlike :func:`tempfile.mkdtemp`, the directory
+    is created with the mode allowed by umask rather than 0700, so that the
+    published directory is readable by others (for example, web servers).
+    """
+    os.makedirs(dir, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(prefix=prefix, dir=dir)
+    os.chmod(tmpdir, 0o777 & ~_UMASK)
+    return tmpdir
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """Hard link file if possible, fallback to copy."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def publish(src: str, dst: str) -> None:
+    """
+    Publish directory *src* to *dst* atomically, files are hard linked if
+    possible.
+    """
+    tmpdir = mkstagedir(path.dirname(dst))
+    try:
+        shutil.copytree(src, tmpdir, copy_function=link_or_copy, dirs_exist_ok=True)
+        # Mode of *src* is copied, which is 0700 when it is published by old
+        # version.
+        os.chmod(tmpdir, 0o777 & ~_UMASK)
+        os.rename(tmpdir, dst)
+    except OSError:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if not path.isdir(dst):
+            raise
+        # Otherwise someone has published it, that's fine.
+
+
+def move(src: str, dst: str) -> bool:
+    """
+    Move directory *src* to *dst* atomically. *src* should be staged on the
+    same filesystem as *dst* (see :func:`mkstagedir`), otherwise it is copied
+    to a temporary directory next to *dst* then renamed.
+
+    :return: False if *dst* already exists (published by someone else), in
+             which case *src* is discarded.
+    """
+    if path.isdir(dst):
+        shutil.rmtree(src, ignore_errors=True)
+        return False
+    try:
+        os.rename(src, dst)
+        return True
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            if not path.isdir(dst):
+                raise
+            shutil.rmtree(src, ignore_errors=True)
+            return False
+    tmpdir = mkstagedir(path.dirname(dst))
+    try:
+        shutil.copytree(src, tmpdir, dirs_exist_ok=True)
+        os.chmod(tmpdir, 0o777 & ~_UMASK)
+        os.rename(tmpdir, dst)
+    except OSError:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if not path.isdir(dst):
+            raise
+        return False
+    finally:
+        shutil.rmtree(src, ignore_errors=True)
+    return True
+
+
+class Lock(object):
+    """
+    Exclusive advisory lock on file *fn*, works across processes and threads.
+
+    Can be used as a context manager, which blocks until lock is acquired.
+    """
+
+    fn: str
+
+    _fd: int | None
+
+    def __init__(self, fn: str):
+        self.fn = fn
+        self._fd = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Acquire the lock, return False if not *blocking* and lock is held."""
+        os.makedirs(path.dirname(self.fn), exist_ok=True)
+        fd = os.open(self.fn, os.O_RDWR | os.O_CREAT)
+        try:
+            if _lock_fd(fd, blocking):
+                self._fd = fd
+                return True
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+        return False
+
+    def release(self) -> None:
+        if self._fd is None:
+            return
+        _unlock_fd(self._fd)
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self) -> Lock:
+        self.acquire()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.release()
+
+
+def _lock_fd(fd: int, blocking: bool) -> bool:
+    if fcntl is not None:
+        # flock(2) rather than fcntl(2) locks, so that the lock is also
+        # exclusive between threads of the same process.
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+        return True
+    while True:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            if not blocking:
+                return False
+            time.sleep(0.1)
+
+
+def _unlock_fd(fd: int) -> None:
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def touch(fn: str) -> None:
+    """Update modification time of file, so that it is evicted later."""
+    try:
+        os.utime(fn)
+    except OSError:
+        pass
+
+
+def dirsize(dir: str) -> int:
+    """Return total size of files under the directory, in bytes."""
+    size = 0
+    for root, _, files in os.walk(dir):
+        for f in files:
+            try:
+                size += path.getsize(path.join(root, f))
+            except OSError:
+                pass
+    return size
+
+
+def format_size(size: int) -> str:
+    for unit in ['B', 'KiB', 'MiB']:
+        if size < 1024:
+            return '%d %s' % (size, unit)
+        size //= 1024
+    return '%d GiB' % size
+
+
+class Backend(object):
+    """
+    Interface of cache backends. Entries are directories keyed by signature,
+    which are available as local directories once got.
+    """
+
+    hits: int
+    misses: int
+    stored: int  # bytes
+    evicted: int  # bytes
+
+    def get(self, sig: str) -> str | None:
+        """Return path of local directory of entry, or None if not cached."""
+        raise NotImplementedError()
+
+    def put(self, sig: str, src: str) -> None:
+        """Store the directory *src* as entry of *sig*."""
+        raise NotImplementedError()
+
+    def query(self, sigs: Iterable[str]) -> set[str]:
+        """
+        Return the cached ones of given signatures. Backend is queried in
+        bulk, so following :meth:`get` calls of them are cheap.
+        """
+        raise NotImplementedError()
+
+    def lock(self, sig: str) -> Lock:
+        """Return the lock of entry of *sig*, shared by all users of cache."""
+        raise NotImplementedError()
+
+    def flush(self) -> None:
+        """Write back the stored entries if backend defers writes."""
+        pass
+
+    def evict(self) -> None:
+        """Evict entries when the cache exceeds its size limit."""
+        pass
+
+    def stats(self) -> str:
+        """Return a human readable summary of cache usage."""
+        raise NotImplementedError()
+
+
+class Cache(Backend):
+    """
+    A directory that stores LilyPond outputs keyed by signature.
+
+    Each entry is a sub-directory named after its signature. Modification
+    time of entry is updated on every access, so that least recently used
+    entries are evicted first when the cache exceeds its size limit.
+
+    Entries of auxiliary caches kept in sub-directories (see :attr:`SUBDIRS`)
+    are evicted under the same size limit.
+    """
+
+    #: Hidden sub-directories whose entries (files or directories) count
+    #: towards size of the cache.
+    SUBDIRS = ['.audio', '.jianpu']
+
+    dir: str
+    max_size: int | None
+
+    hits: int
+    misses: int
+    stored: int  # bytes
+    evicted: int  # bytes
+
+    def __init__(self, dir: str, max_size: int | None = None):
+        self.dir = dir
+        self.max_size = max_size
+        self.hits = self.misses = self.stored = self.evicted = 0
+        os.makedirs(dir, exist_ok=True)
+
+    def entry(self, sig: str) -> str:
+        return path.join(self.dir, sig)
+
+    def lock(self, sig: str) -> Lock:
+        return Lock(path.join(self.dir, '.locks', sig))
+
+    def get(self, sig: str) -> str | None:
+        entry = self.entry(sig)
+        if not path.isdir(entry):
+            self.misses += 1
+            return None
+        self.hits += 1
+        touch(entry)
+        return entry
+
+    def put(self, sig: str, src: str) -> None:
+        entry = self.entry(sig)
+        if path.isdir(entry):
+            return
+        publish(src, entry)
+        self.stored += dirsize(entry)
+
+    def query(self, sigs: Iterable[str]) -> set[str]:
+        return {x for x in sigs if path.isdir(self.entry(x))}
+
+    def put_file(self, sig: str, fn: str, name: str) -> None:
+        """Store the file *fn* as *name* in entry of *sig*."""
+        entry = self.entry(sig)
+        if path.isdir(entry):
+            return
+        tmpdir = mkstagedir(self.dir)
+        try:
+            link_or_copy(fn, path.join(tmpdir, name))
+            os.rename(tmpdir, entry)
+        except OSError:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            if not path.isdir(entry):
+                raise
+            return
+        self.stored += dirsize(entry)
+
+    def entries(self) -> list[tuple[str, float, int]]:
+        """Return (path, mtime, size) of all entries, least recently used first."""
+        entries = []
+        for dir in [self.dir] + [path.join(self.dir, x) for x in self.SUBDIRS]:
+            try:
+                names = os.listdir(dir)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                entry = path.join(dir, name)
+                if name.startswith('.'):
+                    continue
+                try:
+                    if path.isdir(entry):
+                        size = dirsize(entry)
+                    elif dir != self.dir:
+                        size = path.getsize(entry)
+                    else:
+                        continue
+                    entries.append((entry, path.getmtime(entry), size))
+                except OSError:  # evicted by others
+                    pass
+        return sorted(entries, key=lambda x: x[1])
+
+    def evict(self) -> None:
+        # Least recently used entries are evicted first.
+        if self.max_size is not None:
+            entries = self.entries()
+            total = sum(e[2] for e in entries)
+            for entry, _, size in entries:
+                if total <= self.max_size:
+                    break
+                if path.isdir(entry):
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(entry)
+                    except OSError:
+                        pass
+                total -= size
+                self.evicted += size
+        self.clean_locks()
+
+    def clean_locks(self) -> None:
+        """Remove lock files that are not held by anyone."""
+        lockdir = path.join(self.dir, '.locks')
+        try:
+            names = os.listdir(lockdir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            lock = Lock(path.join(lockdir, name))
+            if not lock.acquire(blocking=False):
+                continue
+            # Someone may have opened the file and be waiting for it, then
+            # holds a lock that is no longer shared, the worst case is that
+            # the score is rendered twice, which is harmless as entries are
+            # published atomically.
+            try:
+                os.remove(lock.fn)
+            except OSError:
+                pass
+            finally:
+                lock.release()
+
+    def stats(self) -> str:
+        return '%d hits, %d misses, %s' % (self.hits, self.misses, self.usage())
+
+    def usage(self) -> str:
+        """Return a human readable summary of stored and evicted entries."""
+        entries = self.entries()
+        return '%s stored, %s evicted, %d entries (%s) in %s' % (
+            format_size(self.stored),
+            format_size(self.evicted),
+            len(entries),
+            format_size(sum(e[2] for e in entries)),
+            self.dir,
+        )
+
+
+class HTTPCache(Backend):
+    """
+    Cache on a plain HTTP server, entry of signature is stored as gzip
+    compressed tar archive (see :func:`pack`) at ``<url>/<sig>.tar.gz``,
+    fetched by GET and uploaded by PUT.
+
+    Entries are mirrored to the *local* cache. Fetches are done in bulk by
+    :meth:`query`, and uploads are deferred to :meth:`flush`, only the
+    entries that are missing from the other side are transferred.
+    """
+
+    url: str
+    local: Cache
+    workers: int
+    timeout: float
+
+    downloaded: int  # bytes
+    uploaded: int  # bytes
+
+    _remote: set[str]  # signatures known to exist on server
+    _missing: set[str]  # signatures known to be missing from server
+    _pending: set[str]  # signatures waiting for upload
+    _lock: threading.Lock
+
+    def __init__(self, url: str, local: Cache, workers: int = 8, timeout: float = 30):
+        self.url = url.rstrip('/')
+        self.local = local
+        self.workers = workers
+        self.timeout = timeout
+        self.hits = self.misses = self.stored = self.evicted = 0
+        self.downloaded = self.uploaded = 0
+        self._remote = set()
+        self._missing = set()
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _entry_url(self, sig: str) -> str:
+        return '%s/%s.tar.gz' % (self.url, sig)
+
+    def _fetch(self, sig: str) -> bool:
+        """Download entry to local cache, return False if it is not on server."""
+        try:
+            with urllib.request.urlopen(
+                self._entry_url(sig), timeout=self.timeout
+            ) as resp:
+                data = resp.read()
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                logger.warning('failed to fetch %s: %s', self._entry_url(sig), e)
+            return False
+        except OSError as e:
+            logger.warning('failed to fetch %s: %s', self._entry_url(sig), e)
+            return False
+        try:
+            unpack(io.BytesIO(data), self.local.dir, [sig])
+        except (OSError, tarfile.TarError) as e:
+            logger.warning('invalid cache entry %s: %s', self._entry_url(sig), e)
+            return False
+        if not path.isdir(self.local.entry(sig)):
+            logger.warning(
+                'invalid cache entry %s: no entry of %s', self._entry_url(sig), sig
+            )
+            return False
+        with self._lock:
+            self.downloaded += len(data)
+        return True
+
+    def query(self, sigs: Iterable[str]) -> set[str]:
+        sigs = set(sigs)
+        found = self.local.query(sigs)
+        with self._lock:
+            todo = sorted(sigs - found - self._missing)
+        if todo:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for sig, ok in zip(todo, executor.map(self._fetch, todo)):
+                    with self._lock:
+                        (self._remote if ok else self._missing).add(sig)
+                    if ok:
+                        found.add(sig)
+        return found
+
+    def get(self, sig: str) -> str | None:
+        with self._lock:
+            known_missing = sig in self._missing
+        entry = self.local.entry(sig)
+        if not path.isdir(entry) and not known_missing:
+            self.query([sig])
+        if not path.isdir(entry):
+            self.misses += 1
+            return None
+        # Hits are counted here rather than by local cache.
+        self.hits += 1
+        touch(entry)
+        return entry
+
+    def put(self, sig: str, src: str) -> None:
+        self.local.put(sig, src)
+        with self._lock:
+            if sig not in self._remote:
+                self._pending.add(sig)
+
+    def _upload(self, sig: str) -> None:
+        buf = io.BytesIO()
+        pack({sig: self.local.entry(sig)}, buf)
+        req = urllib.request.Request(
+            self._entry_url(sig),
+            data=buf.getvalue(),
+            method='PUT',
+            headers={'Content-Type': 'application/gzip'},
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout):
+                pass
+        except OSError as e:
+            logger.warning('failed to upload %s: %s', self._entry_url(sig), e)
+            return
+        with self._lock:
+            self.uploaded += len(buf.getvalue())
+            self._remote.add(sig)
+
+    def flush(self) -> None:
+        with self._lock:
+            # Scores missing from server may be rendered by other processes
+            # (for example, writers of ``sphinx-build -j``), upload them too.
+            todo = sorted(
+                x
+                for x in self._pending | self._missing
+                if path.isdir(self.local.entry(x))
+            )
+            self._pending.clear()
+            self._missing.difference_update(todo)
+        if not todo:
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self._upload, todo))
+
+    def lock(self, sig: str) -> Lock:
+        return self.local.lock(sig)
+
+    def evict(self) -> None:
+        self.local.evict()
+
+    def stats(self) -> str:
+        return (
+            '%d hits, %d misses, %s downloaded, %s uploaded from/to %s; local: %s'
+            % (
+                self.hits,
+                self.misses,
+                format_size(self.downloaded),
+                format_size(self.uploaded),
+                self.url,
+                self.local.usage(),
+            )
+        )
+
+
+# Sub-directories of cache that are also content-addressed, entries of them
+# are named as "<subdir>/<key>" in archive.
+_ARCHIVED_SUBDIRS = ['.audio']
+
+
+def _entry_name(member: str) -> str | None:
+    """Return name of entry that archive member belongs to."""
+    parts = member.split('/')
+    n = 2 if parts[0] in _ARCHIVED_SUBDIRS else 1
+    if len(parts) < n or any(x in ('', '.', '..') for x in parts[:n]):
+        return None
+    return '/'.join(parts[:n])
+
+
+def pack(entries: dict[str, str], fileobj: BinaryIO) -> None:
+    """
+    Write directories to a gzip compressed tar archive, *entries* maps names
+    of entries in archive to their directories.
+    """
+    with tarfile.open(fileobj=fileobj, mode='w:gz') as tar:
+        for name, dir in sorted(entries.items()):
+            tar.add(dir, arcname=name)
+
+
+def unpack(
+    fileobj: BinaryIO, dir: str, names: Iterable[str] | None = None
+) -> list[str]:
+    """
+    Extract entries of archive written by :func:`pack` to *dir*, every entry
+    is published atomically, entries that already exist are skipped.
+
+    :param names: names of entries to extract, defaults to all.
+    :return: names of extracted entries.
+    """
+    wanted = None if names is None else set(names)
+    extracted = []
+    with tarfile.open(fileobj=fileobj, mode='r:*') as tar:
+        members: dict[str, list[tarfile.TarInfo]] = {}
+        for m in tar.getmembers():
+            name = _entry_name(m.name)
+            if name is not None and (wanted is None or name in wanted):
+                members.setdefault(name, []).append(m)
+        for name, ms in sorted(members.items()):
+            dst = path.join(dir, *name.split('/'))
+            if path.isdir(dst):
+                continue
+            os.makedirs(path.dirname(dst), exist_ok=True)
+            tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=path.dirname(dst))
+            try:
+                tar.extractall(tmpdir, members=ms, filter='data')
+                os.rename(path.join(tmpdir, *name.split('/')), dst)
+                extracted.append(name)
+            except OSError:
+                if not path.isdir(dst):
+                    raise
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+    return extracted
+
+
+def export_archive(dir: str, fn: str) -> int:
+    """
+    Export all entries of cache directory *dir* (:confval:`lilypond_cache_dir`,
+    or the ``_lilypond`` directory of builder's outdir) to a compressed
+    archive.
+
+    :return: number of exported entries.
+    """
+    entries = {}
+    for sub in ['', *_ARCHIVED_SUBDIRS]:
+        subdir = path.join(dir, sub)
+        if not path.isdir(subdir):
+            continue
+        for name in os.listdir(subdir):
+            if not name.startswith('.') and path.isdir(path.join(subdir, name)):
+                entries[sub + '/' + name if sub else name] = path.join(subdir, name)
+    tmpfn = fn + '.tmp'
+    with open(tmpfn, 'wb') as f:
+        pack(entries, f)
+    os.replace(tmpfn, fn)
+    return len(entries)
+
+
+def import_archive(fn: str, dir: str) -> int:
+    """
+    Import entries from archive written by :func:`export_archive` to cache
+    directory *dir*, only the missing entries are extracted.
+
+    :return: number of imported entries.
+    """
+    os.makedirs(dir, exist_ok=True)
+    with open(fn, 'rb') as f:
+        return len(unpack(f, dir))
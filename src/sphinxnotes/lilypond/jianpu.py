@@ -5,24 +5,177 @@ sphinxnotes.lilypond.jianpu
 Jianpu to Lilypond transformer.
 This module wraps https://github.com/ssb22/jianpu-ly
 
+Conversions are memoized on disk (keyed by Jianpu source and version of
+jianpu-ly), and run in a process pool, which also isolates the module-level
+state of jianpu-ly.
+
 .. seealso:: https://github.com/ssb22/jianpu-ly/issues/15
 
 :copyright: Copyright ©2020 by Shengyu Zhang.
 :license: BSD, see LICENSE for details.
 """
 
+from __future__ import annotations
+import os
+from os import path
+import tempfile
+import textwrap
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import cache
+from hashlib import sha1 as sha
+from importlib import metadata
+import multiprocessing
+
 import jianpu_ly
 
 
+class Config(object):
+    # Directory of conversion cache, None means disabled.
+    cache_dir: str | None = None
+    # Number of worker processes, None means number of CPUs, 0 means
+    # converting in current process.
+    workers: int | None = None
+
+
 class Error(Exception):
     pass
 
 
-def to_lilypond(jp: str) -> str:
+@cache
+def version() -> str:
+    try:
+        return metadata.version('jianpu-ly')
+    except metadata.PackageNotFoundError:
+        return getattr(jianpu_ly, '__version__', '')
+
+
+def digest(jp: str) -> str:
+    return sha((version() + '\0' + jp).encode('utf-8')).hexdigest()
+
+
+def _normalize(jp: str) -> tuple[str, str]:
     """
-    Convert Jianpu source to Lilypond source.
+    Normalize Jianpu source like docutils does for directive content (tabs
+    expanded, trailing whitespaces stripped, dedented), so that source
+    extracted by :func:`prefetch` callers and the one parsed by directive
+    have the same key. Return the normalized source and its key.
+    """
+    lines = [x.rstrip() for x in jp.expandtabs(8).splitlines()]
+    jp = textwrap.dedent('\n'.join(lines)).strip('\n')
+    return jp, digest(jp)
+
+
+def _convert(jp: str) -> tuple[str | None, str | None]:
+    """
+    Convert in worker process, errors are returned as message because
+    exceptions raised by jianpu-ly are not always picklable.
     """
     try:
-        return jianpu_ly.process_input(jp)
+        return jianpu_ly.process_input(jp), None
     except Exception as e:
-        raise Error(e) from e
+        return None, str(e)
+
+
+_pool: ProcessPoolExecutor | None = None
+_pool_pid: int | None = None
+_pending: dict[str, Future] = {}  # digest -> conversion in progress
+_lock = threading.Lock()
+
+
+def _submit(key: str, jp: str) -> Future | None:
+    """Submit conversion to process pool, return None if pool is disabled."""
+    global _pool, _pool_pid
+    if Config.workers == 0 or multiprocessing.parent_process() is not None:
+        # Documents are already read in parallel by Sphinx (``-j``), a process
+        # pool in reader process would hang it at exit.
+        return None
+    with _lock:
+        if _pool_pid != os.getpid():
+            # Pool of parent process is not usable after fork.
+            _pool = None
+            _pending.clear()
+        if key in _pending:
+            return _pending[key]
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=Config.workers)
+            _pool_pid = os.getpid()
+        f = _pending[key] = _pool.submit(_convert, jp)
+        return f
+
+
+def _cache_get(key: str) -> str | None:
+    if Config.cache_dir is None:
+        return None
+    fn = path.join(Config.cache_dir, key + '.ly')
+    try:
+        with open(fn, 'r', encoding='utf-8') as f:
+            ly = f.read()
+        # Touched so that it is evicted in LRU order, see :meth:`Cache.evict`.
+        os.utime(fn)
+    except OSError:
+        return None
+    return ly
+
+
+def _cache_put(key: str, ly: str) -> None:
+    if Config.cache_dir is None:
+        return
+    os.makedirs(Config.cache_dir, exist_ok=True)
+    fd, tmpfn = tempfile.mkstemp(prefix='.tmp-', dir=Config.cache_dir)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(ly)
+        os.replace(tmpfn, path.join(Config.cache_dir, key + '.ly'))
+    except OSError:
+        try:
+            os.remove(tmpfn)
+        except OSError:
+            pass
+
+
+def prefetch(jp: str) -> None:
+    """
+    Start converting Jianpu source in background if it is not cached, so that
+    the following :func:`to_lilypond` call returns immediately.
+    """
+    jp, key = _normalize(jp)
+    if _cache_get(key) is None:
+        _submit(key, jp)
+
+
+def discard_prefetches() -> None:
+    """
+    Forget conversions started by :func:`prefetch` but never picked up by
+    :func:`to_lilypond`, the not yet started ones are cancelled.
+    """
+    with _lock:
+        for f in _pending.values():
+            f.cancel()
+        _pending.clear()
+
+
+def to_lilypond(jp: str) -> str:
+    """
+    Convert Jianpu source to Lilypond source.
+    """
+    jp, key = _normalize(jp)
+    ly = _cache_get(key)
+    if ly is not None:
+        return ly
+
+    f = _submit(key, jp)
+    if f is None:
+        ly, err = _convert(jp)
+    else:
+        try:
+            ly, err = f.result()
+        except Exception as e:  # worker process died
+            ly, err = None, str(e)
+        finally:
+            with _lock:
+                _pending.pop(key, None)
+    if err is not None:
+        raise Error(err)
+    _cache_put(key, ly)  # type: ignore
+    return ly  # type: ignore
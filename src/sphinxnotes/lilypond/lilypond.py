@@ -12,18 +12,35 @@ Lilypond binding for Sphinx extension.
 from __future__ import annotations
 import os
 from os import path
+import asyncio
+import re
+import shutil
+import struct
 import subprocess
+import tempfile
+import threading
 from packaging import version
 import itertools
+import json
 from pathlib import Path
+from functools import cache, lru_cache
+from hashlib import sha1 as sha
 
 from ly import pitch
 from ly import document
 from ly import docinfo
 from ly import pkginfo
+from ly import lex
+from ly import music
+from ly.music import items
 from ly.pitch import transpose
 
+from . import aio
 from . import midi
+from . import perf
+from . import svg
+from . import worker
+from .cache import Cache, link_or_copy
 
 
 # Golbal bining config
@@ -32,91 +49,328 @@ class Config(object):
     timidity_args: list[str]
     ffmpeg_args: list[str]
 
+    # Format of scores picked by :attr:`Output.score` and etc.
     score_format: str
+    # Formats outputted by every LilyPond run, empty means only
+    # :attr:`score_format`. Scores of all formats are stored in the same
+    # cache entry, so builders that use different formats can share it.
+    score_formats: list[str] = []
     png_resolution: int
     include_paths: list[str]
+    # Pixel densities of extra PNG scores for high/low density displays, and
+    # the height of inline scores, see :meth:`Document.output_resolutions`.
+    png_densities: list[float] = []
+    inline_score_size: str = '2.5em'
+    # Whether SVG scores are inlined into HTML, glyphs of them are
+    # deduplicated (see :mod:`.svg`) only when enabled.
+    inline_svg: bool = False
 
     audio_format: str
     audio_volume: list[str]
+    # Max number of MIDI files of a score converted concurrently.
+    audio_workers: int | None = None
+    # Cache of audios, keyed by content of MIDI file and audio settings.
+    audio_cache: Cache | None = None
+
+    # Whether to render movements of document as independent fragments, see
+    # :func:`split_movements`.
+    split_movements: bool = False
+
+    # Number of warm LilyPond workers (see :mod:`.worker`), 0 means disabled.
+    workers: int = 0
+    worker_max_jobs: int | None = None
+    worker_max_rss: int | None = None
+    # Seconds to wait for a worker rendering a score, None means forever.
+    worker_timeout: float | None = None
 
 
 class Error(Exception):
     pass
 
 
+def _tool_version(args: list[str], flag: str = '--version') -> str:
+    """Return the first line of version information of given tool."""
+    try:
+        p = subprocess.run(
+            [args[0], flag],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            encoding='utf-8',
+            errors='replace',
+        )
+    except OSError:
+        return ''
+    return p.stdout.strip().split('\n', maxsplit=1)[0]
+
+
+def output_formats() -> list[str]:
+    """Return formats of scores outputted by every LilyPond run."""
+    return Config.score_formats or [Config.score_format]
+
+
+@cache
+def fingerprint() -> str:
+    """
+    Return digest of the effective render config and versions of toolchain.
+
+    Versions are probed only once, call ``fingerprint.cache_clear()`` after
+    :class:`Config` changes.
+    """
+    h = sha()
+    for k in [
+        'lilypond_args',
+        'timidity_args',
+        'ffmpeg_args',
+        'png_resolution',
+        'png_densities',
+        'inline_score_size',
+        'include_paths',
+        'audio_format',
+        'audio_volume',
+        'split_movements',
+        'inline_svg',
+    ]:
+        h.update(repr((k, getattr(Config, k, None))).encode('utf-8'))
+    h.update(repr(output_formats()).encode('utf-8'))
+    h.update(_tool_version(Config.lilypond_args).encode('utf-8'))
+    h.update(_tool_version(Config.timidity_args).encode('utf-8'))
+    if Config.audio_format == 'mp3':
+        h.update(_tool_version(Config.ffmpeg_args, '-version').encode('utf-8'))
+    return h.hexdigest()
+
+
 class Output(object):
     """
-    Helper for collecting LilyPond outputed files outputed by :class:`Document`.
+    Record of LilyPond outputed files outputed by :class:`Document`.
+
+    The record is saved as a manifest file in outdir when the document is
+    outputted (see :meth:`collect`), so that it can be loaded later
+    (see :meth:`load`) without scanning the directory or parsing MIDI files.
+
+    File names are stored relative to :attr:`outdir`, the path attributes
+    (:attr:`score`, :attr:`audios` and etc.) are joined on access.
+
+    Scores of every outputted format are recorded, :attr:`score`,
+    :attr:`cropped_score` and :attr:`paged_scores` are the ones of
+    :attr:`format`, other formats can be picked by :meth:`scores_of`.
     """
 
     # TODO: Deal with custom output file name?
     # https://lilypond.org/doc/v2.24/Documentation/notation/output-file-names
     BASENAME: str = 'music'
+    MANIFEST: str = 'manifest.json'
+    MANIFEST_VERSION: int = 3
+
+    __slots__ = (
+        'outdir',
+        'format',
+        '_source',
+        '_scores',
+        '_midis',
+        '_audios',
+        'tracks',
+        'files',
+        'variants',
+    )
 
     outdir: str
+    format: str  # format of :attr:`score` and etc.
 
-    source: str
-    score: str | None
-    paged_scores: list[str]
-    cropped_score: str | None
-    midis: list[str]
-    tracks: list[str]  # MIDI track names, used as audio title
-    audios: list[str]
+    _source: str
+    # Format -> {'score': ..., 'cropped_score': ..., 'paged_scores': [...]}
+    _scores: dict[str, dict]
+    _midis: tuple[str, ...]
+    _audios: tuple[str, ...]
+    tracks: tuple[str, ...]  # MIDI track names, used as audio title
+    # File name -> {'size': ..., 'sha1': ...}, images also have 'width' and
+    # 'height' (pixels for PNG, CSS pixels for SVG).
+    files: dict[str, dict]
+    # Score name -> {resolution: file name}, see :meth:`Document.output_resolutions`.
+    variants: dict[str, dict[str, str]]
 
-    def __init__(self, outdir: str):
+    def __init__(
+        self,
+        outdir: str,
+        source: str,
+        scores: dict[str, dict],
+        midis: list[str],
+        audios: list[str],
+        tracks: list[str],
+        files: dict[str, dict],
+        variants: dict[str, dict[str, str]] | None = None,
+    ):
         self.outdir = outdir
+        self._source = source
+        self._scores = scores
+        self.format = (
+            Config.score_format
+            if Config.score_format in scores or not scores
+            else next(iter(scores))
+        )
+        self._midis = tuple(midis)
+        self._audios = tuple(audios)
+        self.tracks = tuple(tracks)
+        self.files = files
+        self.variants = variants or {}
+
+    def _join(self, name: str) -> str:
+        return self.outdir + '/' + name
+
+    @property
+    def source(self) -> str:
+        return self._join(self._source)
+
+    @property
+    def formats(self) -> list[str]:
+        return list(self._scores)
+
+    def scores_of(self, fmt: str) -> tuple[str | None, str | None, list[str]]:
+        """Return (score, cropped score, paged scores) of given format."""
+        names = self._scores.get(fmt, {})
+        return (
+            self._join(names['score']) if names.get('score') else None,
+            self._join(names['cropped_score']) if names.get('cropped_score') else None,
+            [self._join(x) for x in names.get('paged_scores', [])],
+        )
+
+    def score_names(self) -> list[str]:
+        """Return names of score files of all formats."""
+        names = []
+        for x in self._scores.values():
+            names += [y for y in [x['score'], x['cropped_score']] if y]
+            names += x['paged_scores']
+        return names
+
+    @property
+    def score(self) -> str | None:
+        return self.scores_of(self.format)[0]
+
+    @property
+    def cropped_score(self) -> str | None:
+        return self.scores_of(self.format)[1]
+
+    @property
+    def paged_scores(self) -> list[str]:
+        return self.scores_of(self.format)[2]
+
+    @property
+    def midis(self) -> list[str]:
+        return [self._join(x) for x in self._midis]
 
-        prefix = path.join(outdir, self.BASENAME)
+    @property
+    def audios(self) -> list[str]:
+        return [self._join(x) for x in self._audios]
+
+    @classmethod
+    def collect(cls, outdir: str) -> Output:
+        """Collect outputted files by scanning the outdir."""
+        names = set(os.listdir(outdir))
+        prefix = cls.BASENAME
 
         srcfn = prefix + '.ly'
-        if not path.isfile(srcfn):
-            raise Error('Lilypond source is not a file: %s' % srcfn)
-        self.source = srcfn
-
-        scorefn = prefix + '.' + Config.score_format
-        self.score = scorefn if path.isfile(scorefn) else None
-
-        croppedfn = prefix + '.cropped.' + Config.score_format
-        self.cropped_score = croppedfn if path.isfile(croppedfn) else None
-
-        # May multiple scores generated
-        self.paged_scores = []
-        if Config.score_format in ['png', 'svg']:
-            if Config.score_format == 'png':
-                pattern = prefix + '-page%d.png'
-            elif Config.score_format == 'svg':
-                pattern = prefix + '-%d.svg'
-            else:
-                raise Error('Unknown score format: %s' % Config.score_format)
-            self.paged_scores += self._collect_by_index(pattern)
+        if srcfn not in names:
+            raise Error('Lilypond source is not a file: %s' % path.join(outdir, srcfn))
 
-        if not any([self.score, self.cropped_score, self.paged_scores]):
-            raise Error(
-                'No score generated, please check "*.%s" files under "%s"'
-                % (self.BASENAME, outdir)
-            )
+        scores = {}
+        for fmt in output_formats():
+            scorefn = prefix + '.' + fmt
+            croppedfn = prefix + '.cropped.' + fmt
+
+            # May multiple scores generated
+            paged_scores = []
+            if fmt == 'png':
+                paged_scores += cls._collect_by_index(names, prefix + '-page%d.png')
+            elif fmt == 'svg':
+                paged_scores += cls._collect_by_index(names, prefix + '-%d.' + fmt)
+
+            scores[fmt] = {
+                'score': scorefn if scorefn in names else None,
+                'cropped_score': croppedfn if croppedfn in names else None,
+                'paged_scores': paged_scores,
+            }
+
+        out = cls(
+            outdir,
+            source=srcfn,
+            scores=scores,
+            midis=cls._collect_by_ext(names, '.midi'),
+            audios=cls._collect_by_ext(names, '.' + Config.audio_format),
+            tracks=[],
+            files={},
+        )
+        for fmt in scores:
+            if not any(out.scores_of(fmt)):
+                raise Error(
+                    'No %s score generated, please check "%s.*" files under "%s"'
+                    % (fmt, cls.BASENAME, outdir)
+                )
+        out.tracks = tuple(midi.get_track_name(m) or Path(m).stem for m in out.midis)
+        for name in sorted(names):
+            out.add_file(name)
+        return out
+
+    def add_file(self, name: str) -> None:
+        """Record size, checksum and dimensions (for images) of the file."""
+        fn = path.join(self.outdir, name)
+        if not path.isfile(fn):
+            return
+        with open(fn, 'rb') as f:
+            data = f.read()
+        info: dict = {'size': len(data), 'sha1': sha(data).hexdigest()}
+        size = _image_size(name, data)
+        if size is not None:
+            info['width'], info['height'] = size
+        self.files[name] = info
+
+    @classmethod
+    def load(cls, outdir: str) -> Output:
+        """
+        Load outputted files from manifest in the outdir. If there is no
+        manifest (created by old version), fallback to :meth:`collect`.
+        """
+        try:
+            with open(path.join(outdir, cls.MANIFEST), 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return cls.collect(outdir)
+        except (OSError, ValueError) as e:
+            raise Error('Invalid manifest in %s: %s' % (outdir, e)) from e
+        if manifest.get('version') != cls.MANIFEST_VERSION:
+            return cls.collect(outdir)
+        try:
+            return cls(outdir, **manifest['output'])
+        except (KeyError, TypeError) as e:
+            raise Error('Invalid manifest in %s: %s' % (outdir, e)) from e
 
-        self.midis = self._collect_by_ext(outdir, '.midi')
-        self.audios = self._collect_by_ext(outdir, '.' + Config.audio_format)
-        self.tracks = [midi.get_track_name(m) or Path(m).stem for m in self.midis]
+    def save(self):
+        """Save the record as manifest file in outdir."""
+        manifest = {
+            'version': self.MANIFEST_VERSION,
+            'output': {
+                'source': self._source,
+                'scores': self._scores,
+                'midis': self._midis,
+                'audios': self._audios,
+                'tracks': self.tracks,
+                'files': self.files,
+                'variants': self.variants,
+            },
+        }
+        with open(path.join(self.outdir, self.MANIFEST), 'w') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
 
     @staticmethod
-    def _collect_by_index(pattern: str, start: int = 1) -> list[str]:
+    def _collect_by_index(names: set[str], pattern: str, start: int = 1) -> list[str]:
         files = []
         for i in itertools.count(start=start):
-            if not path.isfile(pattern % i):
+            if pattern % i not in names:
                 break
             files.append(pattern % i)
         return files
 
     @staticmethod
-    def _collect_by_ext(dir: str, ext: str) -> list[str]:
-        files = []
-        for f in os.listdir(dir):
-            fullpath = path.join(dir, f)
-            if fullpath.endswith(ext) and path.isfile(fullpath):
-                files.append(fullpath)
-        return sorted(files)
+    def _collect_by_ext(names: set[str], ext: str) -> list[str]:
+        return sorted(n for n in names if n.endswith(ext))
 
     def relocate(self, newdir: str):
         """
@@ -124,18 +378,7 @@ class Output(object):
 
         .. note:: This method does not actually move the files.
         """
-        l = len(self.outdir)
-        self.source = newdir + self.source[l:]
-        if self.score:
-            self.score = newdir + self.score[l:]
-        if self.cropped_score:
-            self.cropped_score = newdir + self.cropped_score[l:]
-        for i, p in enumerate(self.paged_scores):
-            self.paged_scores[i] = newdir + p[l:]
-        for i, p in enumerate(self.midis):
-            self.midis[i] = newdir + p[l:]
-        for i, p in enumerate(self.audios):
-            self.audios[i] = newdir + p[l:]
+        self.outdir = newdir
 
 
 class Document(object):
@@ -147,84 +390,796 @@ class Document(object):
     def plaintext(self):
         return self._document.plaintext()
 
-    def transpose(self, from_pitch: str, to_pitch: str):
-        fp = pitch.Pitch(
-            *pitch.pitchReader('nederlands')(from_pitch[0]),  # type: ignore
-            octave=pitch.octaveToNum(from_pitch[1:]),
+    _INCLUDE_RE = re.compile(r'\\include\s+"([^"]+)"')
+
+    def includes(self) -> list[str]:
+        """
+        Return path of files included by ``\\include`` command, transitively.
+        Files are resolved against :attr:`Config.include_paths`, and the
+        directory of including file for nested inclusions.
+        Unresolvable files are ignored.
+        """
+        files = []
+        pending = [(None, self.plaintext())]
+        while pending:
+            curdir, src = pending.pop(0)
+            for name in self._INCLUDE_RE.findall(src):
+                fn = self._resolve_include(curdir, name)
+                if fn is None or fn in files:
+                    continue
+                files.append(fn)
+                try:
+                    with open(fn, 'r') as f:
+                        pending.append((path.dirname(fn), f.read()))
+                except OSError:
+                    pass
+        return files
+
+    @staticmethod
+    def _resolve_include(curdir: str | None, name: str) -> str | None:
+        if path.isabs(name):
+            return name if path.isfile(name) else None
+        dirs = (
+            Config.include_paths if curdir is None else [curdir, *Config.include_paths]
         )
-        tp = pitch.Pitch(
-            *pitch.pitchReader('nederlands')(to_pitch[0]),  # type: ignore
-            octave=pitch.octaveToNum(to_pitch[1:]),
+        for d in dirs:
+            fn = path.join(d, name)
+            if path.isfile(fn):
+                return path.abspath(fn)
+        return None
+
+    def transpose(self, from_pitch: str, to_pitch: str):
+        self._document = document.Document(
+            transpose_source(self.plaintext(), from_pitch, to_pitch)
         )
-        transposer = transpose.Transposer(fp, tp)
-        cursor = document.Cursor(self._document)
+
+    def output_resolutions(
+        self, out: Output, crop: bool, resolutions: list[int]
+    ) -> Output:
+        """
+        Output PNG scores of the document (already outputted as *out*) at
+        extra resolutions. Files are named as "<name>.<resolution>dpi.png"
+        and recorded in :attr:`Output.variants`.
+        """
+        result = output_resolutions_batch([(self, out, crop, resolutions)])[0]
+        if isinstance(result, Error):
+            raise result
+        return result
+
+    def save(self, outdir: str) -> str:
+        """Save source as :attr:`Output.source` in outdir, return its path."""
+        srcfn = path.join(outdir, Output.BASENAME + '.ly')
+        with open(srcfn, 'w') as f:
+            f.write(self.plaintext())
+        return srcfn
+
+    def output(self, outdir: str, crop: bool) -> Output:
+        """
+        Output scores and related files from LilyPond Document.
+
+        Source is fed to LilyPond via stdin, and saved to outdir only when
+        the rendering succeeds.
+        """
+        if Config.workers:
+            # Warm workers read source from file.
+            srcfn = self.save(outdir)
+            pool = worker.get_pool(
+                Config.workers, Config.worker_max_jobs, Config.worker_max_rss
+            )
+            try:
+                with perf.stage('lilypond', outdir):
+                    ok, log = pool.render(
+                        _lilypond_args(False),
+                        srcfn,
+                        outdir,
+                        crop,
+                        timeout=Config.worker_timeout,
+                    )
+            except worker.Error as e:
+                raise Error(str(e)) from e
+            if not ok:
+                raise Error('LilyPond exited with error:\n[stderr]\n%s' % log)
+            return _finish_output(outdir)
+
+        args = _lilypond_args(crop)
+        args += ['-o', path.join(outdir, Output.BASENAME), '-']
+
+        with perf.stage('lilypond', outdir):
+            p = _run_lilypond(
+                args, self._document.encoding or 'utf-8', self.plaintext()
+            )
+        if p.returncode != 0:
+            raise Error(
+                'LilyPond exited with error:\n[stderr]\n%s\n[stdout]\n%s'
+                % (p.stderr, p.stdout)
+            )
+
+        self.save(outdir)
+        return _finish_output(outdir)
+
+    async def output_async(
+        self, outdir: str, crop: bool, timeout: float | None = None
+    ) -> Output:
+        """
+        Like :meth:`output`, but awaitable, for using the binding in asyncio
+        applications. Every subprocess (LilyPond, and TiMidity++ for each MIDI
+        track) is killed when it doesn't exit in *timeout* seconds or the
+        awaiting task is cancelled. Concurrency of subprocesses is bounded,
+        see :mod:`.aio`.
+
+        :attr:`Config.workers` is not used, LilyPond always runs as a
+        subprocess.
+        """
+        args = _lilypond_args(crop) + ['-o', path.join(outdir, Output.BASENAME), '-']
+        encoding = self._document.encoding or 'utf-8'
         try:
-            if version.parse(pkginfo.version) > version.parse('0.9'):
-                # Only consider lilypond >= 2.18 for now.
-                transpose.transpose(
-                    cursor, transposer, relative_first_pitch_absolute=True
-                )  # type: ignore
-            else:
-                transpose.transpose(cursor, transposer)
-        except pitch.PitchNameNotAvailable:
-            language = docinfo.DocInfo(cursor.document).language()
+            with perf.stage('lilypond', outdir):
+                code, stdout, stderr = await aio.run(
+                    args, timeout, self.plaintext().encode(encoding)
+                )
+        except TimeoutError as e:
+            raise Error('LilyPond timed out after %ss' % timeout) from e
+        except OSError as e:
+            raise Error('LilyPond cannot be run') from e
+        if code != 0:
             raise Error(
-                'Pitch names not available in "%s", skipping file: %s'
-                % (language, cursor.document.filename)
+                'LilyPond exited with error:\n[stderr]\n%s\n[stdout]\n%s'
+                % (
+                    stderr.decode(encoding, errors='replace'),
+                    stdout.decode(encoding, errors='replace'),
+                )
             )
 
-    def output(self, outdir: str, crop: bool) -> Output:
-        """Output scores and related files from LilyPond Document."""
-        args = Config.lilypond_args.copy()
-        args += ['-o', outdir]
-
-        for i in Config.include_paths:
-            args += ['--include', i]
-
-        if Config.score_format in ['png', 'pdf', 'ps', 'eps']:
-            args += ['--formats', Config.score_format]
-            if Config.score_format == 'png':
-                args += ['-dresolution=%d' % Config.png_resolution]
-        elif Config.score_format == 'svg':
-            args += ['-dbackend=svg']
+        self.save(outdir)
+        return await _finish_output_async(outdir, timeout)
+
+
+@lru_cache(maxsize=4096)
+def source_digest(src: str) -> str:
+    """
+    Return digest of the token stream of LilyPond source. Comments are
+    ignored and runs of whitespace are treated as a single space, so
+    differently indented or commented sources of the same music have the
+    same digest.
+    """
+    h = sha()
+    doc = document.Document(src)
+    space = False
+    for block in doc:
+        space = True  # line break
+        for token in doc.tokens(block):
+            if isinstance(token, (lex.Space, lex.Comment)):
+                space = True
+                continue
+            if space:
+                h.update(b' ')
+                space = False
+            h.update(token.encode('utf-8'))
+    return h.hexdigest()
+
+
+_PITCH_RE = re.compile(r"^([a-z]+)('*|,*)$")
+
+
+def parse_pitch(s: str) -> pitch.Pitch:
+    """Parse pitch written in LilyPond notation (Dutch names), like ``bes,``."""
+    m = _PITCH_RE.match(s)
+    note = m and _pitch_reader()(m.group(1))
+    if not note:
+        raise Error('Invalid pitch: %s' % s)
+    return pitch.Pitch(*note, octave=pitch.octaveToNum(m.group(2)))  # type: ignore
+
+
+@cache
+def _pitch_reader():
+    return pitch.pitchReader('nederlands')
+
+
+@cache
+def _relative_first_pitch_absolute() -> bool:
+    # Only consider lilypond >= 2.18 for now.
+    return version.parse(pkginfo.version) > version.parse('0.9')
+
+
+# Transposed sources keyed by (digest of source, from pitch, to pitch),
+# see :func:`transpose_source`.
+_transposed: dict[tuple[str, str, str], str] = {}
+_transposed_lock = threading.Lock()
+_TRANSPOSED_MAX = 256
+
+
+def transpose_source(src: str, from_pitch: str, to_pitch: str) -> str:
+    """
+    Return LilyPond source transposed from *from_pitch* to *to_pitch*.
+    Results are memoized, so a source transposed to several keys is only
+    parsed once per key.
+    """
+    key = (sha(src.encode('utf-8')).hexdigest(), from_pitch, to_pitch)
+    with _transposed_lock:
+        if key in _transposed:
+            return _transposed[key]
+
+    transposer = transpose.Transposer(parse_pitch(from_pitch), parse_pitch(to_pitch))
+    cursor = document.Cursor(document.Document(src))
+    try:
+        if _relative_first_pitch_absolute():
+            transpose.transpose(cursor, transposer, relative_first_pitch_absolute=True)  # type: ignore
         else:
-            raise Error('Unknown score format: %s' % Config.score_format)
+            transpose.transpose(cursor, transposer)
+    except pitch.PitchNameNotAvailable:
+        language = docinfo.DocInfo(cursor.document).language()
+        raise Error(
+            'Pitch names not available in "%s", skipping file: %s'
+            % (language, cursor.document.filename)
+        )
 
-        if crop:
-            args += ['-dcrop=#t']
+    result = cursor.document.plaintext()
+    with _transposed_lock:
+        if len(_transposed) >= _TRANSPOSED_MAX:
+            _transposed.pop(next(iter(_transposed)))  # evict the oldest
+        _transposed[key] = result
+    return result
 
-        prefix = path.join(outdir, Output.BASENAME)
-        srcfn = prefix + '.ly'
-        with open(srcfn, 'w') as f:
-            f.write(self.plaintext())
-        args += [srcfn]
 
+@lru_cache(maxsize=256)
+def split_movements(src: str) -> tuple[str, ...] | None:
+    """
+    Split LilyPond source into fragments, one per top-level ``\\score`` or
+    ``\\bookpart`` block (movement), so that they can be rendered and cached
+    independently. A fragment consists of its movement and the other
+    top-level statements (version, header, paper, variable definitions and
+    etc.) in their original order, and comments are dropped. Book titles are
+    blanked except in the first fragment, and tagline except in the last.
+
+    :return: None if source has less than 2 movements, or has top-level
+             statements that output by themselves (``\\book``, ``\\markup``,
+             music expressions, or included files that have them).
+    """
+    nodes = list(music.document(document.Document(src)))
+    # Indexes of movements of every fragment, a movement that outputs no
+    # score (for example, the MIDI-only one generated by jianpu-ly) is kept
+    # together with its previous movement.
+    groups: list[list[int]] = []
+    printed: list[bool] = []
+    for i, n in enumerate(nodes):
+        if not _is_movement(n):
+            continue
+        if groups and (not _is_printed(n) or not printed[-1]):
+            groups[-1].append(i)
+            printed[-1] = printed[-1] or _is_printed(n)
+        else:
+            groups.append([i])
+            printed.append(_is_printed(n))
+    if len(groups) < 2:
+        return None
+    if not all(_is_movement(n) or _is_definition(n, set()) for n in nodes):
+        return None
+    texts = [src[n.position : n.end_position()] for n in nodes]
+    fragments = []
+    for k, group in enumerate(groups):
+        fragment = '\n'.join(
+            t for j, t in enumerate(texts) if j in group or not _is_movement(nodes[j])
+        )
+        # Like an unsplit render, titles (and copyright) of book are only
+        # printed on the first page, and tagline on the last page.
+        blanks = (_BOOK_TITLES if k > 0 else []) + (
+            ['tagline'] if k < len(groups) - 1 else []
+        )
+        fragment += '\n\\header { %s }' % ' '.join('%s = ##f' % x for x in blanks)
+        fragments.append(fragment)
+    return tuple(fragments)
+
+
+# Header fields printed by bookTitleMarkup and the footer of first page.
+_BOOK_TITLES = [
+    'dedication',
+    'title',
+    'subtitle',
+    'subsubtitle',
+    'instrument',
+    'poet',
+    'composer',
+    'meter',
+    'arranger',
+    'copyright',
+]
+
+
+def _is_movement(node: items.Item) -> bool:
+    return isinstance(node, (items.Score, items.BookPart))
+
+
+def _is_printed(node: items.Item) -> bool:
+    """Whether movement outputs score, ``\\score`` with only ``\\midi`` does not."""
+    if not isinstance(node, items.Score):
+        return True
+    blocks = [x for x in node if isinstance(x, (items.Layout, items.Midi))]
+    return not blocks or any(isinstance(x, items.Layout) for x in blocks)
+
+
+def _is_definition(node: items.Item, seen: set[str]) -> bool:
+    """Whether top-level node outputs nothing by itself."""
+    if _is_movement(node) or isinstance(
+        node, (items.Book, items.Markup, items.MarkupList, items.Music)
+    ):
+        return False
+    if not isinstance(node, items.Include):
+        return True
+    # Included file is also checked, unresolvable file is treated as output.
+    fn = Document._resolve_include(None, node.filename() or '')
+    if fn is None:
+        return False
+    if fn in seen:
+        return True
+    seen.add(fn)
+    try:
+        with open(fn, 'r') as f:
+            src = f.read()
+    except OSError:
+        return False
+    return all(_is_definition(n, seen) for n in music.document(document.Document(src)))
+
+
+def stitch(outs: list[Output], doc: Document, outdir: str) -> Output:
+    """
+    Stitch outputs of fragments (see :func:`split_movements`) of document
+    into *outdir* in order. Files of the N-th fragment are linked as
+    "music-partN<suffix>", scores of every fragment are recorded as paged
+    scores of the stitched output.
+    """
+    scores: dict[str, dict] = {
+        fmt: {'score': None, 'cropped_score': None, 'paged_scores': []}
+        for fmt in output_formats()
+    }
+    midis = []
+    audios = []
+    tracks = []
+    files = {}
+    variants = {}
+    for i, out in enumerate(outs, start=1):
+        prefix = '%s-part%d' % (Output.BASENAME, i)
+
+        def rename(name: str) -> str:
+            return prefix + name[len(Output.BASENAME) :]
+
+        for name, info in out.files.items():
+            if name.startswith(Output.BASENAME) and name != out._source:
+                link_or_copy(
+                    path.join(out.outdir, name), path.join(outdir, rename(name))
+                )
+                files[rename(name)] = info
+        for fmt in scores:
+            score, cropped_score, paged_scores = out.scores_of(fmt)
+            pages = (
+                [cropped_score] if cropped_score else [score] if score else paged_scores
+            )
+            scores[fmt]['paged_scores'] += [rename(path.basename(x)) for x in pages]
+        midis += [rename(path.basename(x)) for x in out.midis]
+        audios += [rename(path.basename(x)) for x in out.audios]
+        tracks += out.tracks
+        for name, variant in out.variants.items():
+            variants[rename(name)] = {k: rename(v) for k, v in variant.items()}
+
+    srcfn = path.basename(doc.save(outdir))
+    if Config.inline_svg and 'svg' in output_formats():
+        svg.process(outdir)
+    stitched = Output(
+        outdir,
+        source=srcfn,
+        scores=scores,
+        midis=midis,
+        audios=audios,
+        tracks=tracks,
+        files=files,
+        variants=variants,
+    )
+    stitched.add_file(srcfn)
+    stitched.save()
+    return stitched
+
+
+def output_batch(jobs: list[tuple[Document, str, bool]]) -> list[Output | Error]:
+    """
+    Output scores of many documents with as few LilyPond invocations as
+    possible, to amortize the startup cost of LilyPond.
+
+    Each job is a tuple of (document, outdir, crop), jobs with identical
+    arguments are rendered in a single invocation. Result of each job is
+    either an :class:`Output` or an :class:`Error` that belongs to the job.
+    """
+    if Config.workers:
+        # Warm workers have no startup cost, no need to batch.
+        results = []
+        for doc, outdir, crop in jobs:
+            try:
+                results.append(doc.output(outdir, crop))
+            except Error as e:
+                results.append(e)
+        return results
+
+    results: list[Output | Error | None] = [None] * len(jobs)
+
+    groups: dict[tuple[str, ...], list[int]] = {}
+    for i, (_, _, crop) in enumerate(jobs):
+        try:
+            args = _lilypond_args(crop)
+        except Error as e:
+            results[i] = e
+            continue
+        groups.setdefault(tuple(args), []).append(i)
+
+    for args, indexes in groups.items():
+        # Files are rendered in a shared directory with unique basenames, and
+        # moved to their own outdir later. The directory is named after the
+        # process ID, so that it can be cleaned up if the process is killed.
+        batchdir = tempfile.mkdtemp(
+            prefix='batch-%d-' % os.getpid(),
+            dir=path.dirname(path.abspath(jobs[indexes[0]][1])),
+        )
         try:
-            p = subprocess.run(
-                args,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                encoding=self._document.encoding or 'utf-8',
+            errors = _run_batch(
+                list(args),
+                [jobs[i][0] for i in indexes],
+                [jobs[i][1] for i in indexes],
+                batchdir,
+                'lilypond',
             )
-        except OSError as e:
-            raise Error('LilyPond cannot be run') from e
-        if p.returncode != 0:
+            for n, i in enumerate(indexes):
+                doc, outdir, _ = jobs[i]
+                for name, fn in _batch_files(batchdir, n):
+                    os.rename(fn, path.join(outdir, name))
+                if errors[n] is not None:
+                    results[i] = errors[n]
+                    continue
+                try:
+                    results[i] = _finish_output(outdir)
+                except Error as e:
+                    results[i] = e
+        finally:
+            # Removed even if a job raises unexpectedly.
+            shutil.rmtree(batchdir, ignore_errors=True)
+
+    return results  # type: ignore
+
+
+def output_resolutions_batch(
+    jobs: list[tuple[Document, Output, bool, list[int]]],
+) -> list[Output | Error]:
+    """
+    Like :meth:`Document.output_resolutions`, but for many documents. Each job
+    is a tuple of (document, output, crop, resolutions), jobs of the same
+    resolution are rendered in a single LilyPond invocation (or by warm
+    workers when :attr:`Config.workers` is set).
+    """
+    results: list[Output | Error] = [out for _, out, _, _ in jobs]
+    if 'png' not in output_formats():
+        return results
+
+    groups: dict[tuple[str, ...], list[tuple[int, int]]] = {}
+    for i, (_, _, crop, resolutions) in enumerate(jobs):
+        for res in resolutions:
+            try:
+                # Workers are shared with :meth:`Document.output`, crop and
+                # resolution are set per job.
+                args = (
+                    _lilypond_args(False)
+                    if Config.workers
+                    else _lilypond_args(crop, res)
+                )
+            except Error as e:
+                results[i] = e
+                break
+            groups.setdefault(tuple(args), []).append((i, res))
+
+    for args, subjobs in groups.items():
+        subjobs = [(i, res) for i, res in subjobs if isinstance(results[i], Output)]
+        if not subjobs:
+            continue
+        batchdir = tempfile.mkdtemp(
+            prefix='batch-%d-' % os.getpid(),
+            dir=path.dirname(path.abspath(jobs[subjobs[0][0]][1].outdir)),
+        )
+        try:
+            if Config.workers:
+                errors = _run_workers(
+                    list(args),
+                    [(jobs[i][0], jobs[i][2], res) for i, res in subjobs],
+                    batchdir,
+                )
+            else:
+                errors = _run_batch(
+                    list(args),
+                    [jobs[i][0] for i, _ in subjobs],
+                    [jobs[i][1].outdir for i, _ in subjobs],
+                    batchdir,
+                    'lilypond-resolution',
+                )
+            for n, (i, res) in enumerate(subjobs):
+                out = results[i]
+                if not isinstance(out, Output):
+                    continue  # failed at other resolution
+                if errors[n] is not None:
+                    results[i] = errors[n]  # type: ignore
+                    continue
+                files = dict(_batch_files(batchdir, n))
+                for name in out.score_names():
+                    if not name.endswith('.png') or name not in files:
+                        continue
+                    variant = '%s.%ddpi.png' % (name[: -len('.png')], res)
+                    os.replace(files[name], path.join(out.outdir, variant))
+                    out.variants.setdefault(name, {})[str(res)] = variant
+                    out.add_file(variant)
+        finally:
+            shutil.rmtree(batchdir, ignore_errors=True)
+
+    for (_, _, _, resolutions), out in zip(jobs, results):
+        if resolutions and isinstance(out, Output):
+            out.save()
+    return results
+
+
+def _run_batch(
+    args: list[str], docs: list[Document], keys: list[str], batchdir: str, stage: str
+) -> list[Error | None]:
+    """
+    Render documents in a single LilyPond invocation, files (including the
+    source) of the N-th document are outputted as "jobN<suffix>" in
+    *batchdir* (see :func:`_batch_files`).
+
+    :param keys: keys of documents in records of :mod:`.perf`.
+    :return: error of each document, or None if succeeded.
+    """
+    srcfns = []
+    for n, doc in enumerate(docs):
+        srcfns.append(path.join(batchdir, 'job%04d.ly' % n))
+        with open(srcfns[-1], 'w') as f:
+            f.write(doc.plaintext())
+    return _run_files(args, srcfns, keys, batchdir, stage)
+
+
+def _run_files(
+    args: list[str], srcfns: list[str], keys: list[str], batchdir: str, stage: str
+) -> list[Error | None]:
+    """Render source files of :func:`_run_batch` in a single invocation."""
+    try:
+        with perf.stage(stage, *keys):
+            p = _run_lilypond(args + ['-o', batchdir] + srcfns, 'utf-8')
+    except Error as e:
+        return [e] * len(srcfns)
+
+    failed = _failed_files(p.stderr)
+    if p.returncode != 0 and not failed:
+        if len(srcfns) > 1:
+            # Can not attribute the error (for example, LilyPond crashed),
+            # render files one by one so that only the culprit fails.
+            errors = []
+            for srcfn, key in zip(srcfns, keys):
+                stem = path.basename(srcfn)[: -len('.ly')]
+                for fn in os.listdir(batchdir):
+                    if fn != path.basename(srcfn) and fn.startswith(
+                        (stem + '.', stem + '-')
+                    ):
+                        os.remove(path.join(batchdir, fn))
+                errors += _run_files(args, [srcfn], [key], batchdir, stage)
+            return errors
+        failed = set(srcfns)
+    errors: list[Error | None] = []
+    for srcfn in srcfns:
+        if srcfn in failed or path.basename(srcfn) in failed:
+            errors.append(
+                Error(
+                    'LilyPond exited with error:\n[stderr]\n%s\n[stdout]\n%s'
+                    % (
+                        _stderr_of(p.stderr, srcfn) if len(srcfns) > 1 else p.stderr,
+                        p.stdout,
+                    )
+                )
+            )
+        else:
+            errors.append(None)
+    return errors
+
+
+def _run_workers(
+    args: list[str], jobs: list[tuple[Document, bool, int]], batchdir: str
+) -> list[Error | None]:
+    """
+    Like :func:`_run_batch`, but render documents by warm workers, each job is
+    a tuple of (document, crop, resolution).
+    """
+    pool = worker.get_pool(
+        Config.workers, Config.worker_max_jobs, Config.worker_max_rss
+    )
+    errors: list[Error | None] = []
+    for n, (doc, crop, res) in enumerate(jobs):
+        srcfn = path.join(batchdir, 'job%04d.ly' % n)
+        with open(srcfn, 'w') as f:
+            f.write(doc.plaintext())
+        try:
+            with perf.stage('lilypond-resolution', batchdir):
+                ok, log = pool.render(
+                    args, srcfn, batchdir, crop, res, Config.worker_timeout
+                )
+        except worker.Error as e:
+            errors.append(Error(str(e)))
+            continue
+        errors.append(
+            None if ok else Error('LilyPond exited with error:\n[stderr]\n%s' % log)
+        )
+    return errors
+
+
+def _batch_files(batchdir: str, n: int) -> list[tuple[str, str]]:
+    """
+    Return files outputted for the N-th document by :func:`_run_batch`, as
+    (name in :class:`Output`, path) pairs.
+    """
+    prefix = 'job%04d' % n
+    return [
+        (Output.BASENAME + fn[len(prefix) :], path.join(batchdir, fn))
+        for fn in sorted(os.listdir(batchdir))
+        if fn.startswith(prefix + '.') or fn.startswith(prefix + '-')
+    ]
+
+
+_FAILED_FILES_RE = re.compile(r'failed files: (.*)$', re.MULTILINE)
+_PROCESSING_RE = re.compile(r"^Processing `(.+)'$", re.MULTILINE)
+
+
+def _failed_files(stderr: str) -> set[str]:
+    """Parse the "failed files" message printed by LilyPond at exit."""
+    match = _FAILED_FILES_RE.search(stderr)
+    return set(re.findall(r'"([^"]+)"', match.group(1))) if match else set()
+
+
+def _stderr_of(stderr: str, srcfn: str) -> str:
+    """Pick the stderr outputs related to given file from a batch."""
+    # LilyPond prints "Processing `<file>'" before processing each file.
+    sections = _PROCESSING_RE.split(stderr)
+    for i in range(1, len(sections) - 1, 2):
+        if sections[i] == srcfn:
+            return sections[i + 1].strip()
+    # Fallback to lines mentioning the file.
+    return '\n'.join(l for l in stderr.splitlines() if srcfn in l)
+
+
+def _lilypond_args(crop: bool, resolution: int | None = None) -> list[str]:
+    """
+    Return LilyPond arguments except output path and input files.
+
+    :param resolution: resolution of PNG, defaults to
+                       :attr:`Config.png_resolution`.
+    """
+    args = Config.lilypond_args.copy()
+
+    # Absolute paths, warm workers change their working directory to the
+    # outdir of each score (see :mod:`.worker`).
+    for i in Config.include_paths:
+        args += ['--include', path.abspath(i)]
+
+    formats = output_formats()
+    for fmt in formats:
+        if fmt not in ['png', 'svg', 'pdf', 'ps', 'eps']:
+            raise Error('Unknown score format: %s' % fmt)
+    if formats == ['svg']:
+        args += ['-dbackend=svg']
+    elif 'svg' in formats:
+        # Only the Cairo backend outputs SVG along with other formats.
+        if not _has_cairo_backend():
             raise Error(
-                'LilyPond exited with error:\n[stderr]\n%s\n[stdout]\n%s'
-                % (p.stderr, p.stdout)
+                'Outputting SVG along with other formats requires LilyPond 2.24 '
+                'or later: %s' % ', '.join(formats)
             )
+        args += ['-dbackend=cairo', '--formats', ','.join(formats)]
+    else:
+        args += ['--formats', ','.join(formats)]
+    if 'png' in formats:
+        args += ['-dresolution=%d' % (resolution or Config.png_resolution)]
+
+    if crop:
+        args += ['-dcrop=#t']
+
+    return args
+
+
+@cache
+def _has_cairo_backend() -> bool:
+    m = re.search(r'LilyPond (\d+)\.(\d+)', _tool_version(Config.lilypond_args))
+    return m is not None and (int(m[1]), int(m[2])) >= (2, 24)
+
+
+def _run_lilypond(
+    args: list[str], encoding: str, input: str | None = None
+) -> subprocess.CompletedProcess:
+    try:
+        return subprocess.run(
+            args,
+            input=input,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding=encoding,
+        )
+    except OSError as e:
+        raise Error('LilyPond cannot be run') from e
+
+
+# Lengths of SVG units in CSS pixels.
+_SVG_UNITS = {'': 1, 'px': 1, 'pt': 96 / 72, 'in': 96, 'cm': 96 / 2.54, 'mm': 96 / 25.4}
+_SVG_ROOT_RE = re.compile(r'<svg\b[^>]*>')
+_SVG_LENGTH_RE = r'\s%s="\s*([\d.]+)\s*(px|pt|in|cm|mm|)\s*"'
+
 
-        # Generate audios.
-        for fn in Output._collect_by_ext(outdir, '.midi'):
-            self._midi_to_audio(fn)
+def _image_size(name: str, data: bytes) -> tuple[int, int] | None:
+    """
+    Return size of PNG (in pixels) or SVG (in CSS pixels) image read from its
+    header, or None if unknown.
+    """
+    if name.endswith('.png'):
+        if data[:8] != b'\x89PNG\r\n\x1a\n' or data[12:16] != b'IHDR':
+            return None
+        w, h = struct.unpack('>II', data[16:24])
+        return w, h
+    if name.endswith('.svg'):
+        m = _SVG_ROOT_RE.search(data[:4096].decode('utf-8', errors='replace'))
+        if not m:
+            return None
+        size = []
+        for attr in ['width', 'height']:
+            length = re.search(_SVG_LENGTH_RE % attr, m.group(0))
+            if not length:
+                return None
+            size.append(round(float(length[1]) * _SVG_UNITS[length[2]]))
+        return size[0], size[1]
+    return None
 
-        return Output(outdir)
 
-    def _midi_to_audio(self, midifn: str):
-        midi.to_audio(
+def _finish_output(outdir: str) -> Output:
+    """
+    Generate audios from MIDI outputs, deduplicate glyphs of SVG scores when
+    they are inlined, collect outputted files and save the manifest.
+    """
+    midis = Output._collect_by_ext(set(os.listdir(outdir)), '.midi')
+    try:
+        midi.to_audios(
             Config.timidity_args,
             Config.ffmpeg_args,
             Config.audio_format,
             Config.audio_volume,
-            midifn,
+            [path.join(outdir, m) for m in midis],
+            Config.audio_workers,
+            Config.audio_cache,
         )
+    except midi.Error as e:
+        raise Error(str(e)) from e
+    if Config.inline_svg and 'svg' in output_formats():
+        svg.process(outdir)
+    out = Output.collect(outdir)
+    out.save()
+    return out
+
+
+async def _finish_output_async(outdir: str, timeout: float | None) -> Output:
+    """Like :func:`_finish_output`, MIDI files are converted concurrently."""
+    midis = Output._collect_by_ext(set(os.listdir(outdir)), '.midi')
+    try:
+        await midi.to_audios_async(
+            Config.timidity_args,
+            Config.ffmpeg_args,
+            Config.audio_format,
+            Config.audio_volume,
+            [path.join(outdir, m) for m in midis],
+            Config.audio_cache,
+            timeout,
+        )
+    except midi.Error as e:
+        raise Error(str(e)) from e
+
+    def finish() -> Output:
+        if Config.inline_svg and 'svg' in output_formats():
+            svg.process(outdir)
+        out = Output.collect(outdir)
+        out.save()
+        return out
+
+    # Files are read and hashed, don't block the event loop.
+    return await asyncio.to_thread(finish)
@@ -8,13 +8,29 @@ MIDI related code.
 :license: BSD, see LICENSE for details.
 """
 
+from __future__ import annotations
 import os
+from os import path
+import asyncio
+import mmap
+import struct
 import subprocess
+import tempfile
+import threading
+from hashlib import sha1 as sha
+from concurrent.futures import ThreadPoolExecutor
 
-from mido import MidiFile
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 from sphinx.util import logging
 
+from . import aio
+from . import perf
+from .cache import Cache, link_or_copy
+
 logger = logging.getLogger(__name__)
 
 
@@ -22,75 +38,479 @@ class Error(Exception):
     pass
 
 
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+_executor_pid: int | None = None
+_executor_workers: int | None = None
+
+
+def _get_executor(workers: int) -> ThreadPoolExecutor:
+    """
+    Return the executor shared by all conversions of the process, so that
+    at most *workers* conversions run at the same time even when scores are
+    rendered concurrently.
+    """
+    global _executor, _executor_pid, _executor_workers
+    with _executor_lock:
+        if _executor_pid != os.getpid():
+            # We are forked, threads of executor are not inherited.
+            _executor = None
+        if _executor is not None and _executor_workers != workers:
+            _executor.shutdown(wait=False)
+            _executor = None
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='lilypond-audio'
+            )
+            _executor_pid = os.getpid()
+            _executor_workers = workers
+        return _executor
+
+
 def to_audio(
     timidity_args: list[str],
     ffmpeg_args: list[str],
     audio_format: str,
     audio_volume: list[str],
     fn: str,
+    cache: Cache | None = None,
 ):
+    """
+    Convert MIDI file to audio file with same basename.
+
+    If *cache* is given, audio is reused when there is one converted from MIDI
+    file of the same content with the same arguments. Errors of cache are
+    logged, and the audio is converted without cache.
+    """
+    key = None
+    if cache is not None:
+        key = _audio_key(timidity_args, ffmpeg_args, audio_format, audio_volume, fn)
+        if key is not None and _pick_audio(cache, key, audio_format, fn):
+            return
+    _to_audio(timidity_args, ffmpeg_args, audio_format, audio_volume, fn)
+    if cache is not None and key is not None:
+        _store_audio(cache, key, audio_format, fn)
+
+
+def _audio_fn(fn: str, audio_format: str) -> str:
+    return fn[: -len('midi')] + audio_format
+
+
+def _audio_key(
+    timidity_args: list[str],
+    ffmpeg_args: list[str],
+    audio_format: str,
+    audio_volume: list[str],
+    fn: str,
+) -> str | None:
+    """Return key of audio in cache, or None if the MIDI file can't be read."""
+    h = sha()
     try:
-        timidity_args = timidity_args.copy()
-        if audio_format == 'ogg':
-            timidity_args += ['-Ov']
-        elif audio_format in ['wav', 'mp3']:
-            timidity_args += ['-Ow']
-        else:
-            raise Error('Unsupported audio format "%s"' % audio_format)
-        if audio_volume:
-            timidity_args += ['--volume=%d' % audio_volume]
-        timidity_args += [fn]
-        p = subprocess.run(
-            timidity_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        with open(fn, 'rb') as f:
+            h.update(f.read())
+    except OSError as e:
+        logger.warning('failed to read MIDI file %s: %s', fn, e)
+        return None
+    h.update(repr((timidity_args, audio_format, audio_volume)).encode('utf-8'))
+    if audio_format == 'mp3':
+        h.update(repr(ffmpeg_args).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _pick_audio(cache: Cache, key: str, audio_format: str, fn: str) -> bool:
+    """Link cached audio next to MIDI file, return False if not cached."""
+    try:
+        entry = cache.get(key)
+        if entry is None:
+            return False
+        link_or_copy(
+            path.join(entry, 'audio.' + audio_format), _audio_fn(fn, audio_format)
         )
+    except OSError as e:
+        logger.warning('failed to pick audio of %s from cache: %s', fn, e)
+        return False
+    return True
+
+
+def _store_audio(cache: Cache, key: str, audio_format: str, fn: str):
+    """Store audio converted from MIDI file to cache."""
+    try:
+        cache.put_file(key, _audio_fn(fn, audio_format), 'audio.' + audio_format)
+    except OSError as e:
+        logger.warning('failed to store audio of %s to cache: %s', fn, e)
+
+
+def _timidity_args(
+    timidity_args: list[str], audio_format: str, audio_volume: list[str]
+) -> list[str]:
+    timidity_args = timidity_args.copy()
+    if audio_format == 'ogg':
+        timidity_args += ['-Ov']
+    elif audio_format in ['wav', 'mp3']:
+        timidity_args += ['-Ow']
+    else:
+        raise Error('Unsupported audio format "%s"' % audio_format)
+    if audio_volume:
+        timidity_args += ['--volume=%d' % audio_volume]
+    return timidity_args
+
+
+def _to_audio(
+    timidity_args: list[str],
+    ffmpeg_args: list[str],
+    audio_format: str,
+    audio_volume: list[str],
+    fn: str,
+):
+    timidity_args = _timidity_args(timidity_args, audio_format, audio_volume)
+
+    if audio_format == 'mp3':
+        with perf.stage('timidity+ffmpeg', path.dirname(fn)):
+            _to_mp3(timidity_args, ffmpeg_args, fn)
+        return
+
+    timidity_args += [fn]
+    try:
+        with perf.stage('timidity', path.dirname(fn)):
+            p = subprocess.run(
+                timidity_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
     except OSError as e:
         raise Error('TiMidity++ cannot be run') from e
-    except Exception as e:
-        raise e
     if p.returncode != 0:
         raise Error(
             'TiMidity++ exited with error:\n[stderr]\n%s\n[stdout]\n%s'
             % (p.stderr, p.stdout)
         )
 
-    # Convert wav to mp3
-    if audio_format == 'mp3':
-        ffmpeg_args = ffmpeg_args.copy()
-        wavfn = fn[: -len('midi')] + 'wav'
-        mp3fn = fn[: -len('midi')] + 'mp3'
-        ffmpeg_args += ['-i', wavfn, mp3fn]
+
+def _to_mp3(timidity_args: list[str], ffmpeg_args: list[str], fn: str):
+    """
+    Convert MIDI to mp3, WAV outputted by TiMidity++ is piped to FFmpeg
+    directly without touching disk.
+    """
+    mp3fn = fn[: -len('midi')] + 'mp3'
+    timidity_args = timidity_args + ['-o', '-', fn]
+    ffmpeg_args = ffmpeg_args + ['-y', '-i', 'pipe:0', mp3fn]
+
+    # Stderr of TiMidity++ is redirected to a file, in case of pipe is full
+    # and blocks the whole pipeline.
+    with tempfile.TemporaryFile() as timidity_stderr:
         try:
-            p = subprocess.run(
-                ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            tp = subprocess.Popen(
+                timidity_args, stdout=subprocess.PIPE, stderr=timidity_stderr
+            )
+        except OSError as e:
+            raise Error('TiMidity++ cannot be run') from e
+        try:
+            fp = subprocess.Popen(
+                ffmpeg_args,
+                stdin=tp.stdout,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
             )
         except OSError as e:
+            tp.kill()
+            tp.wait()
             raise Error('FFmpeg cannot be run') from e
-        except Exception as e:
-            raise e
         finally:
-            # Remove unused wav file
-            os.remove(wavfn)
-        if p.returncode != 0:
+            # Only FFmpeg holds the read end of pipe now, so TiMidity++ gets
+            # SIGPIPE when FFmpeg exits early.
+            tp.stdout.close()  # type: ignore
+
+        ffmpeg_stdout, ffmpeg_stderr = fp.communicate()
+        tp.wait()
+        if tp.returncode != 0:
+            timidity_stderr.seek(0)
             raise Error(
-                'FFmpeg exited with error:\n[stderr]\n%s\n[stdout]\n%s'
-                % (p.stderr, p.stdout)
+                'TiMidity++ exited with error:\n[stderr]\n%s'
+                % timidity_stderr.read().decode('utf-8', errors='replace')
             )
+    if fp.returncode != 0:
+        raise Error(
+            'FFmpeg exited with error:\n[stderr]\n%s\n[stdout]\n%s'
+            % (ffmpeg_stderr, ffmpeg_stdout)
+        )
+
+
+def to_audios(
+    timidity_args: list[str],
+    ffmpeg_args: list[str],
+    audio_format: str,
+    audio_volume: list[str],
+    fns: list[str],
+    workers: int | None = None,
+    cache: Cache | None = None,
+):
+    """
+    Convert MIDI files to audios concurrently, at most *workers* conversions
+    (defaults to number of CPUs) run at the same time in the process, shared
+    by all callers.
+    """
+    if not fns:
+        return
+    workers = workers or os.cpu_count() or 1
+    executor = _get_executor(workers)
+    futures = [
+        executor.submit(
+            to_audio,
+            timidity_args,
+            ffmpeg_args,
+            audio_format,
+            audio_volume,
+            fn,
+            cache,
+        )
+        for fn in fns
+    ]
+    for f in futures:
+        f.result()  # raise the first error
+
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        logger.debug(
+            'converted %d MIDI files with %d workers, '
+            'largest RSS of a single child process so far: %d KiB',
+            len(fns),
+            workers,
+            maxrss,
+        )
+
+
+async def to_audio_async(
+    timidity_args: list[str],
+    ffmpeg_args: list[str],
+    audio_format: str,
+    audio_volume: list[str],
+    fn: str,
+    cache: Cache | None = None,
+    timeout: float | None = None,
+):
+    """
+    Like :func:`to_audio`, but awaitable. Subprocesses are killed when they
+    don't exit in *timeout* seconds or the awaiting task is cancelled, see
+    :mod:`.aio`.
+    """
+    key = None
+    if cache is not None:
+        key = _audio_key(timidity_args, ffmpeg_args, audio_format, audio_volume, fn)
+        if key is not None and _pick_audio(cache, key, audio_format, fn):
+            return
+
+    timidity_args = _timidity_args(timidity_args, audio_format, audio_volume)
+    try:
+        if audio_format == 'mp3':
+            with perf.stage('timidity+ffmpeg', path.dirname(fn)):
+                await _to_mp3_async(timidity_args, ffmpeg_args, fn, timeout)
+        else:
+            with perf.stage('timidity', path.dirname(fn)):
+                code, stdout, stderr = await aio.run(timidity_args + [fn], timeout)
+            if code != 0:
+                raise Error(
+                    'TiMidity++ exited with error:\n[stderr]\n%s\n[stdout]\n%s'
+                    % (stderr, stdout)
+                )
+    except TimeoutError as e:
+        raise Error('Converting %s timed out after %ss' % (fn, timeout)) from e
+    except OSError as e:
+        raise Error('TiMidity++ or FFmpeg cannot be run') from e
+
+    if cache is not None and key is not None:
+        _store_audio(cache, key, audio_format, fn)
+
+
+async def _to_mp3_async(
+    timidity_args: list[str],
+    ffmpeg_args: list[str],
+    fn: str,
+    timeout: float | None,
+):
+    """Like :func:`_to_mp3`, the pipeline takes one slot of semaphore."""
+    timidity_args = timidity_args + ['-o', '-', fn]
+    ffmpeg_args = ffmpeg_args + ['-y', '-i', 'pipe:0', _audio_fn(fn, 'mp3')]
+
+    async with aio.semaphore():
+        rfd, wfd = os.pipe()
+        try:
+            tp = await asyncio.create_subprocess_exec(
+                *timidity_args, stdout=wfd, stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                fp = await asyncio.create_subprocess_exec(
+                    *ffmpeg_args,
+                    stdin=rfd,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            except BaseException:
+                await aio.kill(tp)
+                raise
+        finally:
+            # Only subprocesses hold the pipe now, so TiMidity++ gets SIGPIPE
+            # when FFmpeg exits early.
+            os.close(rfd)
+            os.close(wfd)
+
+        try:
+            async with asyncio.timeout(timeout):
+                (
+                    (_, timidity_stderr),
+                    (ffmpeg_stdout, ffmpeg_stderr),
+                ) = await asyncio.gather(tp.communicate(), fp.communicate())
+        except BaseException:  # including cancellation
+            await asyncio.shield(asyncio.gather(aio.kill(tp), aio.kill(fp)))
+            raise
+
+    if tp.returncode != 0:
+        raise Error(
+            'TiMidity++ exited with error:\n[stderr]\n%s'
+            % timidity_stderr.decode('utf-8', errors='replace')
+        )
+    if fp.returncode != 0:
+        raise Error(
+            'FFmpeg exited with error:\n[stderr]\n%s\n[stdout]\n%s'
+            % (ffmpeg_stderr, ffmpeg_stdout)
+        )
+
+
+async def to_audios_async(
+    timidity_args: list[str],
+    ffmpeg_args: list[str],
+    audio_format: str,
+    audio_volume: list[str],
+    fns: list[str],
+    cache: Cache | None = None,
+    timeout: float | None = None,
+):
+    """
+    Convert MIDI files to audios concurrently, concurrency is bounded by
+    :func:`.aio.semaphore`. When a conversion fails, the others are
+    cancelled and the error is raised.
+    """
+    try:
+        async with asyncio.TaskGroup() as tg:
+            for fn in fns:
+                tg.create_task(
+                    to_audio_async(
+                        timidity_args,
+                        ffmpeg_args,
+                        audio_format,
+                        audio_volume,
+                        fn,
+                        cache,
+                        timeout,
+                    )
+                )
+    except* Error as eg:
+        raise eg.exceptions[0] from None
 
 
 def get_track_name(fn: str) -> str | None:
+    """
+    Return the first track name (meta event ``FF 03``) of the MIDI file, or
+    None if there is no one.
+
+    Only the bytes needed are read: the file is memory-mapped, track chunks are
+    walked event by event and the walk stops at the first track name.
+    """
     try:
-        midi = MidiFile(fn)
-    except Exception as e:
+        with open(fn, 'rb') as f:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file can not be mapped
+                raise Error('empty file')
+            with buf:
+                name = _read_track_name(buf)
+    except (OSError, Error) as e:
         logger.warning('failed to get title of MIDI file %s: %s', fn, e)
         return None
-    for track in midi.tracks:
-        for msg in track:
-            if msg.type != 'track_name':
-                continue
-            # FIXME: It seems that in LilyPond 2.23+, the encoding of MIDI title
-            # is UTF-8 rather that UTF-16. But we still found that 2.24.4
-            # produces UTF-16 output.
-            #
-            # See also: https://gitlab.com/lilypond/lilypond/-/issues/6389
-            return msg.name.encode('latin-1').decode('utf-8')
+    if name is None:
+        return None
+    # FIXME: It seems that in LilyPond 2.23+, the encoding of MIDI title
+    # is UTF-8 rather that UTF-16. But we still found that 2.24.4
+    # produces UTF-16 output.
+    #
+    # See also: https://gitlab.com/lilypond/lilypond/-/issues/6389
+    return name.decode('utf-8', errors='replace')
+
+
+# Length of data bytes of channel messages, indexed by high nibble of status.
+_CHANNEL_DATA_LEN = {0x8: 2, 0x9: 2, 0xA: 2, 0xB: 2, 0xC: 1, 0xD: 1, 0xE: 2}
+
+
+def _read_track_name(buf) -> bytes | None:
+    """Walk chunks of Standard MIDI File in *buf*, see :func:`get_track_name`."""
+    size = len(buf)
+    if size < 14 or buf[0:4] != b'MThd':
+        raise Error('not a standard MIDI file')
+    (hdrlen,) = struct.unpack_from('>I', buf, 4)
+    ntracks = struct.unpack_from('>H', buf, 10)[0]
+    pos = 8 + hdrlen
+
+    track = 0
+    while track < ntracks and pos + 8 <= size:
+        chunk_type = buf[pos : pos + 4]
+        (chunk_len,) = struct.unpack_from('>I', buf, pos + 4)
+        pos += 8
+        end = pos + chunk_len
+        if end > size:
+            raise Error('truncated chunk at offset %d' % (pos - 8))
+        if chunk_type != b'MTrk':
+            pos = end  # skip unknown chunks
+            continue
+        name = _read_track_chunk(buf, pos, end)
+        if name is not None:
+            return name
+        pos = end
+        track += 1
+    return None
+
+
+def _read_vlq(buf, pos: int, end: int) -> tuple[int, int]:
+    """Read a variable-length quantity, return (value, new position)."""
+    value = 0
+    for _ in range(4):
+        if pos >= end:
+            raise Error('truncated variable-length quantity at offset %d' % pos)
+        byte = buf[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+    raise Error('variable-length quantity too long at offset %d' % pos)
+
+
+def _read_track_chunk(buf, pos: int, end: int) -> bytes | None:
+    running = None  # running status
+    while pos < end:
+        _, pos = _read_vlq(buf, pos, end)  # delta time
+        if pos >= end:
+            raise Error('truncated event at offset %d' % pos)
+        status = buf[pos]
+        if status == 0xFF:  # meta event
+            if pos + 2 > end:
+                raise Error('truncated meta event at offset %d' % pos)
+            meta_type = buf[pos + 1]
+            length, pos = _read_vlq(buf, pos + 2, end)
+            if pos + length > end:
+                raise Error('truncated meta event at offset %d' % pos)
+            if meta_type == 0x03:
+                return buf[pos : pos + length]
+            if meta_type == 0x2F:  # end of track
+                return None
+            pos += length
+        elif status in (0xF0, 0xF7):  # sysex event
+            length, pos = _read_vlq(buf, pos + 1, end)
+            pos += length
+            running = None
+        else:
+            if status & 0x80:
+                running = status
+                pos += 1
+            elif running is None:
+                raise Error('unexpected data byte at offset %d' % pos)
+            datalen = _CHANNEL_DATA_LEN.get(running >> 4)
+            if datalen is None:
+                raise Error('unexpected status 0x%02X at offset %d' % (running, pos))
+            pos += datalen
     return None
@@ -0,0 +1,143 @@
+"""
+sphinxnotes.lilypond.perf
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Per-stage instrumentation of score rendering.
+
+Stages (LilyPond subprocess, TiMidity++ and etc.) are recorded with keys
+(signature of score, or outdir of render), keys are mapped to the scores they
+belong to by :meth:`Recorder.tag`. Recording is disabled until
+:func:`enable` is called.
+
+:copyright: Copyright ©2025 by Shengyu Zhang.
+:license: BSD, see LICENSE for details.
+"""
+
+from __future__ import annotations
+import sys
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Iterator
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def children_maxrss() -> int | None:
+    """
+    Return the largest RSS of a single waited child process so far, in KiB.
+    It is not the sum of concurrent children, which is not tracked by OS.
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss  # bytes on macOS
+
+
+class Recorder(object):
+    """Records of stages, thread-safe."""
+
+    stages: list[dict]
+    tags: dict[str, tuple[str, str]]  # key -> (docname, signature)
+
+    _lock: threading.Lock
+
+    def __init__(self):
+        self.stages = []
+        self.tags = {}
+        self._lock = threading.Lock()
+
+    def tag(self, key: str, docname: str, sig: str) -> None:
+        with self._lock:
+            self.tags[key] = (docname, sig)
+
+    @contextmanager
+    def stage(self, name: str, *keys: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            maxrss = children_maxrss()
+            with self._lock:
+                self.stages.append(
+                    {'stage': name, 'keys': keys, 'time': elapsed, 'maxrss': maxrss}
+                )
+
+    def scores(self) -> list[dict]:
+        """
+        Return per-score summary, slowest first. Time of stage shared by many
+        scores (for example, batch rendering) is split evenly.
+        """
+        scores: dict[str, dict] = {}
+        for s in self.stages:
+            tagged = [self.tags[k] for k in s['keys'] if k in self.tags]
+            for docname, sig in tagged:
+                score = scores.setdefault(
+                    sig, {'sig': sig, 'docname': docname, 'time': 0.0, 'stages': {}}
+                )
+                t = s['time'] / len(tagged)
+                score['time'] += t
+                score['stages'][s['stage']] = score['stages'].get(s['stage'], 0) + t
+        return sorted(scores.values(), key=lambda x: x['time'], reverse=True)
+
+    def totals(self) -> dict[str, dict]:
+        """
+        Return count, total time and the largest RSS of a single child
+        process by stage.
+        """
+        totals: dict[str, dict] = {}
+        for s in self.stages:
+            total = totals.setdefault(
+                s['stage'], {'count': 0, 'time': 0.0, 'maxrss': None}
+            )
+            total['count'] += 1
+            total['time'] += s['time']
+            if s['maxrss'] is not None:
+                total['maxrss'] = max(total['maxrss'] or 0, s['maxrss'])
+        return totals
+
+    def dump(self) -> dict:
+        """Return all records in a JSON serializable form."""
+        return {
+            'totals': self.totals(),
+            'scores': self.scores(),
+            'stages': [
+                {
+                    **s,
+                    'keys': list(s['keys']),
+                    'scores': [self.tags[k][1] for k in s['keys'] if k in self.tags],
+                }
+                for s in self.stages
+            ],
+        }
+
+
+# Recorder of current build, None when disabled.
+recorder: Recorder | None = None
+
+
+def enable() -> Recorder:
+    global recorder
+    recorder = Recorder()
+    return recorder
+
+
+def disable() -> None:
+    global recorder
+    recorder = None
+
+
+def stage(name: str, *keys: str):
+    """Context manager that records a stage, no-op when disabled."""
+    if recorder is None:
+        return nullcontext()
+    return recorder.stage(name, *keys)
+
+
+def tag(key: str, docname: str, sig: str) -> None:
+    if recorder is not None:
+        recorder.tag(key, docname, sig)
@@ -1,19 +1,34 @@
 document.addEventListener('DOMContentLoaded', function() {
-    const players = document.querySelectorAll('div.sphinxnotes-lilypond');
-    
+    // Block scores are wrapped by div, inline scores are wrapped by span.
+    const players = document.querySelectorAll('div.sphinxnotes-lilypond, span.sphinxnotes-lilypond');
+
     players.forEach(player => {
         const select = player.querySelector('select');
         const audio = player.querySelector('audio');
         if (!select || !audio) {
             return
         }
-        
+
         select.addEventListener('change', function() {
-            if (this.value) {
-                audio.src = this.value;
-            } else {
-                audio.src = this.options[0];
-            }
+            audio.src = this.value || this.options[0].value;
         });
     });
+
+    // Scores transposed to multiple keys, only the selected one is shown.
+    document.querySelectorAll('div.sphinxnotes-lilypond-transpose').forEach(wrapper => {
+        const select = wrapper.querySelector(':scope > select');
+        const variants = wrapper.querySelectorAll(':scope > div.sphinxnotes-lilypond');
+
+        function show(index) {
+            variants.forEach((variant, i) => {
+                variant.hidden = i !== index;
+                if (variant.hidden) {
+                    variant.querySelectorAll('audio').forEach(audio => audio.pause());
+                }
+            });
+        }
+
+        select.addEventListener('change', () => show(select.selectedIndex));
+        show(select.selectedIndex);
+    });
 });
@@ -0,0 +1,112 @@
+"""
+sphinxnotes.lilypond.svg
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Post-processing of SVG scores outputted by LilyPond.
+
+Every SVG score repeats the outlines of music font glyphs (noteheads, clefs,
+accidentals and etc.) it uses. Glyph paths are pulled out and replaced by
+``<use>`` elements that reference them by content-hashed ids, so that scores
+inlined into the same HTML page can share a single definition of every glyph.
+
+:copyright: Copyright ©2025 by Shengyu Zhang.
+:license: BSD, see LICENSE for details.
+"""
+
+from __future__ import annotations
+import os
+from os import path
+import re
+import json
+from hashlib import sha1 as sha
+
+# Name of file that stores the deduplicated scores and glyphs of an outdir.
+GLYPHS = 'glyphs.json'
+
+# Paths shorter than this are not worth deduplicating.
+MIN_GLYPH_LEN = 64
+
+_PATH_RE = re.compile(r'<path\b([^>]*?)\s+d="([^"]*)"([^>]*?)\s*/>')
+_XMLDECL_RE = re.compile(r'^\s*<\?xml[^>]*\?>\s*')
+_SVG_RE = re.compile(r'<svg\b([^>]*)>')
+_SIZE_ATTR_RE = re.compile(r'\s+(?:width|height)="[^"]*"')
+
+
+def glyph_id(d: str) -> str:
+    return 'lily-' + sha(d.encode('utf-8')).hexdigest()[:12]
+
+
+def dedupe(svg: str) -> tuple[str, dict[str, str]]:
+    """
+    Replace glyph paths of the SVG by ``<use>`` elements.
+
+    :return: the new SVG, and mapping from glyph ids to their path data.
+    """
+    glyphs = {}
+
+    def repl(m: re.Match) -> str:
+        before, d, after = m.groups()
+        if len(d) < MIN_GLYPH_LEN:
+            return m.group(0)
+        gid = glyph_id(d)
+        glyphs[gid] = d
+        return '<use%s href="#%s"%s/>' % (before, gid, after)
+
+    return _PATH_RE.sub(repl, svg), glyphs
+
+
+def process(outdir: str) -> None:
+    """
+    Deduplicate glyphs of all SVG files under outdir, the results are saved
+    to :data:`GLYPHS` file.
+    """
+    scores = {}
+    glyphs = {}
+    for name in sorted(os.listdir(outdir)):
+        if not name.endswith('.svg'):
+            continue
+        with open(path.join(outdir, name), 'r', encoding='utf-8') as f:
+            scores[name], g = dedupe(f.read())
+        glyphs.update(g)
+    if not scores:
+        return
+    with open(path.join(outdir, GLYPHS), 'w', encoding='utf-8') as f:
+        json.dump({'scores': scores, 'glyphs': glyphs}, f, ensure_ascii=False)
+
+
+def load(outdir: str) -> tuple[dict[str, str], dict[str, str]] | None:
+    """
+    Load deduplicated scores and glyphs saved by :func:`process`.
+
+    :return: None if the outdir is not processed.
+    """
+    try:
+        with open(path.join(outdir, GLYPHS), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data['scores'], data['glyphs']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def to_html(svg: str, attrs: str) -> str:
+    """
+    Convert SVG document to an element that can be inlined into HTML.
+
+    The size attributes of the root element are removed, so that it can be
+    sized by CSS as ``<img>``. *attrs* is appended to the root element.
+    """
+    svg = _XMLDECL_RE.sub('', svg, count=1)
+    return _SVG_RE.sub(
+        lambda m: '<svg%s %s>' % (_SIZE_ATTR_RE.sub('', m.group(1)), attrs),
+        svg,
+        count=1,
+    ).strip()
+
+
+def sprite(glyphs: dict[str, str]) -> str:
+    """Return a hidden SVG element that defines the glyphs."""
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" style="display: none;" '
+        'aria-hidden="true"><defs>%s</defs></svg>'
+        % ''.join('<path id="%s" d="%s"/>' % x for x in sorted(glyphs.items()))
+    )
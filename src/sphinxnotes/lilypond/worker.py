@@ -0,0 +1,319 @@
+"""
+sphinxnotes.lilypond.worker
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Long-lived LilyPond processes that render documents without restarting,
+which saves the startup cost (Guile initialization, font loading) of
+LilyPond for every score.
+
+Each worker runs a Scheme driver loop (passed via ``-e``) that reads jobs
+from stdin, one per line, and replies "ok" or "error" to stdout. Replies are
+prefixed by :data:`REPLY_PREFIX` on their own lines, other lines of stdout
+are outputted by scores (for example, by ``#(display ...)``).
+
+:copyright: Copyright ©2025 by Shengyu Zhang.
+:license: BSD, see LICENSE for details.
+"""
+
+from __future__ import annotations
+import os
+import atexit
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+
+REPLY_PREFIX = 'sphinxnotes-lilypond:'
+
+# Scheme driver loop evaluated by LilyPond before processing input files.
+#
+# Every line of stdin is a job of "<outdir>\t<crop>\t<resolution>\t<file>".
+# The file is processed by ``lilypond-all``, the same function used by
+# LilyPond for processing files from command line, outputs are written to the
+# outdir. Resolution of PNG is set per job, 0 means the one of command line.
+DRIVER = r"""
+(use-modules (ice-9 rdelim))
+(define default-resolution (ly:get-option 'resolution))
+(let loop ((line (read-line)))
+  (if (eof-object? line) (exit 0))
+  (let* ((job (string-split line #\tab))
+         (outdir (list-ref job 0))
+         (crop (string=? (list-ref job 1) "1"))
+         (resolution (string->number (list-ref job 2)))
+         (file (list-ref job 3)))
+    (chdir outdir)
+    (ly:set-option 'crop crop)
+    (ly:set-option 'resolution
+                   (if (> resolution 0) resolution default-resolution))
+    (let ((failed ((@@ (lily) lilypond-all) (list file))))
+      ; Start a new line in case the score displays a partial line.
+      (newline)
+      (display (if (null? failed) "sphinxnotes-lilypond:ok" "sphinxnotes-lilypond:error"))
+      (newline)
+      (force-output)))
+  (loop (read-line)))
+"""
+
+
+class Error(Exception):
+    pass
+
+
+class Worker(object):
+    """A long-lived LilyPond process."""
+
+    args: list[str]
+    jobs: int  # number of processed jobs
+
+    _proc: subprocess.Popen
+    _tmpdir: str
+    _log: int  # fd of stderr log
+    _stdout: queue.Queue[str]  # lines of stdout, '' means EOF
+
+    def __init__(self, args: list[str]):
+        self.args = args
+        self.jobs = 0
+        self._tmpdir = tempfile.mkdtemp(prefix='sphinxnotes-lilypond-worker')
+
+        # LilyPond refuses to run without input file, but the file is never
+        # processed because the driver loop never returns.
+        dummyfn = os.path.join(self._tmpdir, 'dummy.ly')
+        open(dummyfn, 'w').close()
+
+        self._log = os.open(
+            os.path.join(self._tmpdir, 'stderr.log'), os.O_RDWR | os.O_CREAT
+        )
+        try:
+            self._proc = subprocess.Popen(
+                args + ['-e', DRIVER, dummyfn],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=self._log,
+                encoding='utf-8',
+            )
+        except OSError as e:
+            self.close()
+            raise Error('LilyPond cannot be run') from e
+        # Read stdout in background, so that replies can be waited with
+        # timeout.
+        self._stdout = queue.Queue()
+        threading.Thread(target=self._read_stdout, daemon=True).start()
+
+    def _read_stdout(self):
+        try:
+            for line in self._proc.stdout:  # type: ignore
+                self._stdout.put(line)
+        except (OSError, ValueError):
+            pass
+        self._stdout.put('')
+
+    def render(
+        self,
+        srcfn: str,
+        outdir: str,
+        crop: bool,
+        resolution: int | None = None,
+        timeout: float | None = None,
+    ) -> tuple[bool, str]:
+        """
+        Render LilyPond source file to outdir.
+
+        :param resolution: resolution of PNG, defaults to the one given by
+                           arguments of worker.
+        :param timeout: seconds to wait for the reply, the worker is killed
+                        when it is exceeded.
+        :return: whether rendering succeeded, and the log of LilyPond.
+        """
+        offset = os.lseek(self._log, 0, os.SEEK_END)
+        try:
+            self._proc.stdin.write(  # type: ignore
+                '%s\t%d\t%d\t%s\n'
+                % (
+                    os.path.abspath(outdir),
+                    crop,
+                    resolution or 0,
+                    os.path.abspath(srcfn),
+                )
+            )
+            self._proc.stdin.flush()  # type: ignore
+        except OSError as e:
+            raise Error('LilyPond worker is dead') from e
+        deadline = None if timeout is None else time.monotonic() + timeout
+        stdout = []
+        while True:
+            try:
+                line = self._stdout.get(
+                    timeout=None
+                    if deadline is None
+                    else max(0, deadline - time.monotonic())
+                )
+            except queue.Empty:
+                self._proc.kill()
+                self._proc.wait()
+                raise Error('LilyPond worker timed out after %ss' % timeout)
+            if not line or line.startswith(REPLY_PREFIX):
+                break
+            stdout.append(line)
+        reply = line.strip()
+        self.jobs += 1
+
+        os.lseek(self._log, offset, os.SEEK_SET)
+        chunks = []
+        while chunk := os.read(self._log, 65536):
+            chunks.append(chunk)
+        log = b''.join(chunks).decode('utf-8', errors='replace')
+        log += ''.join(x for x in stdout if x.strip())
+
+        if not reply:
+            raise Error('LilyPond worker is dead:\n%s' % log)
+        return reply.endswith(':ok'), log
+
+    def rss(self) -> int | None:
+        """Return resident set size of the process in bytes, if available."""
+        try:
+            with open('/proc/%d/statm' % self._proc.pid) as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError, AttributeError):
+            return None
+
+    def alive(self) -> bool:
+        return hasattr(self, '_proc') and self._proc.poll() is None
+
+    def close(self):
+        if hasattr(self, '_proc'):
+            try:
+                self._proc.stdin.close()  # type: ignore
+                self._proc.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self._proc.kill()
+                self._proc.wait()
+        if hasattr(self, '_log'):
+            os.close(self._log)
+        for fn in os.listdir(self._tmpdir):
+            os.remove(os.path.join(self._tmpdir, fn))
+        os.rmdir(self._tmpdir)
+
+
+class Pool(object):
+    """
+    A pool of :class:`Worker`. Workers are started lazily for each distinct
+    argument list, and recycled after *max_jobs* jobs or when their RSS exceeds
+    *max_rss* bytes.
+    """
+
+    size: int
+    max_jobs: int | None
+    max_rss: int | None
+    pid: int  # the process that owns the workers
+
+    _idle: list[Worker]
+    _busy: int
+    _cond: threading.Condition
+
+    def __init__(
+        self, size: int, max_jobs: int | None = None, max_rss: int | None = None
+    ):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.pid = os.getpid()
+        self._idle = []
+        self._busy = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self, args: list[str]) -> Worker:
+        with self._cond:
+            while True:
+                for w in self._idle:
+                    if w.args == args:
+                        self._idle.remove(w)
+                        self._busy += 1
+                        return w
+                if self._busy + len(self._idle) < self.size:
+                    break
+                if self._idle:
+                    # Replace a idle worker with different arguments.
+                    self._idle.pop(0).close()
+                    break
+                self._cond.wait()
+            self._busy += 1
+        try:
+            return Worker(args)
+        except Error:
+            with self._cond:
+                self._busy -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, w: Worker):
+        recycle = not w.alive()
+        if self.max_jobs is not None and w.jobs >= self.max_jobs:
+            recycle = True
+        if self.max_rss is not None and (w.rss() or 0) > self.max_rss:
+            recycle = True
+        if recycle:
+            w.close()
+        with self._cond:
+            self._busy -= 1
+            if not recycle:
+                self._idle.append(w)
+            self._cond.notify()
+
+    def render(
+        self,
+        args: list[str],
+        srcfn: str,
+        outdir: str,
+        crop: bool,
+        resolution: int | None = None,
+        timeout: float | None = None,
+    ) -> tuple[bool, str]:
+        """See :meth:`Worker.render`."""
+        w = self._acquire(args)
+        try:
+            return w.render(srcfn, outdir, crop, resolution, timeout)
+        finally:
+            self._release(w)
+
+    def close(self):
+        with self._cond:
+            for w in self._idle:
+                w.close()
+            self._idle = []
+
+
+_pool: Pool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(
+    size: int, max_jobs: int | None = None, max_rss: int | None = None
+) -> Pool:
+    """
+    Return the process-wide worker pool, so that workers keep warm across
+    builds in the same process. Builds in separated processes (for example,
+    rebuilds of sphinx-autobuild) don't share workers.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid != os.getpid():
+            # We are forked (for example, by parallel builds of Sphinx), pipes
+            # of workers are shared with parent, don't touch them.
+            _pool = None
+        if _pool is not None and (_pool.size, _pool.max_jobs, _pool.max_rss) != (
+            size,
+            max_jobs,
+            max_rss,
+        ):
+            _pool.close()
+            _pool = None
+        if _pool is None:
+            _pool = Pool(size, max_jobs, max_rss)
+        return _pool
+
+
+@atexit.register
+def _close_pool():
+    if _pool is not None and _pool.pid == os.getpid():
+        _pool.close()
@@ -0,0 +1,170 @@
+"""
+Tests of building documents with the extension, by the stub toolchain in
+``benchmarks/stubs``.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import subprocess
+import sys
+from os import path
+
+import pytest
+
+ROOTDIR = path.dirname(path.dirname(path.abspath(__file__)))
+STUBDIR = path.join(ROOTDIR, 'benchmarks', 'stubs')
+
+SUITE = r"""\version "2.24.0"
+\header { title = "Suite" composer = "X" tagline = "End" }
+melody = { c' d' e' f' }
+\score { \new Staff \melody \layout {} }
+\score { { g' a' b' c'' } \layout {} }
+"""
+
+
+def lily(src: str) -> str:
+    """Return reStructuredText of a block score."""
+    return '.. lily::\n   :noaudio:\n\n' + ''.join(
+        '   %s\n' % x for x in src.splitlines()
+    )
+
+
+def write_project(srcdir, pages: dict[str, str] | None = None):
+    """Write conf.py and pages (docname -> content) of a project."""
+    with open(path.join(srcdir, 'conf.py'), 'w') as f:
+        f.write("extensions = ['sphinxnotes.lilypond']\n")
+        f.write('lilypond_lilypond_args = [%r]\n' % path.join(STUBDIR, 'lilypond'))
+    if pages is None:
+        pages = {'index': 'Suite\n=====\n\n' + lily(SUITE)}
+    for docname, content in pages.items():
+        with open(path.join(srcdir, docname + '.rst'), 'w') as f:
+            f.write(content)
+
+
+def build(srcdir, builder: str, **confoverrides) -> tuple[str, str]:
+    """Build document, return the outdir and warnings."""
+    if not path.exists(path.join(srcdir, 'conf.py')):
+        write_project(srcdir)
+    outdir = path.join(srcdir, '_build', builder)
+    warnfn = path.join(srcdir, 'warnings.txt')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [path.join(ROOTDIR, 'src'), env.get('PYTHONPATH')])
+    )
+    args = [sys.executable, '-m', 'sphinx', '-q', '-b', builder, '-w', warnfn]
+    for k, v in confoverrides.items():
+        args += ['-D', '%s=%s' % (k, v)]
+    subprocess.run(args + [str(srcdir), outdir], env=env, check=True)
+    with open(warnfn) as f:
+        return outdir, f.read()
+
+
+def scores_of(outdir: str, builder: str) -> list[str]:
+    """Return paths of score images referenced by outputted document."""
+    if builder == 'html':
+        with open(path.join(outdir, 'index.html')) as f:
+            return re.findall(r'<img [^>]*src="\./([^"]+)"', f.read())
+    tex = [x for x in os.listdir(outdir) if x.endswith('.tex')]
+    with open(path.join(outdir, tex[0])) as f:
+        return [
+            x + y
+            for x, y in re.findall(
+                r'\\sphinxincludegraphics\{\{([^}]+)\}([^}]+)\}', f.read()
+            )
+        ]
+
+
+@pytest.mark.parametrize('builder', ['html', 'latex'])
+def test_split_movements(tmp_path, builder):
+    outdir, warnings = build(tmp_path, builder, lilypond_split_movements=1)
+    assert warnings == ''
+    scores = scores_of(outdir, builder)
+    # Block scores are cropped.
+    assert [path.basename(x) for x in scores] == [
+        'music-part1.cropped.png',
+        'music-part2.cropped.png',
+    ]
+    for x in scores:
+        assert path.isfile(path.join(outdir, x))
+
+
+@pytest.mark.parametrize('builder', ['html', 'latex'])
+def test_split_movements_consistency(tmp_path, builder):
+    (tmp_path / 'split').mkdir()
+    (tmp_path / 'unsplit').mkdir()
+    split, _ = build(tmp_path / 'split', builder, lilypond_split_movements=1)
+    unsplit, _ = build(tmp_path / 'unsplit', builder, lilypond_split_movements=0)
+
+    # Source of stitched output is the same as the unsplit one.
+    [stitched] = {path.dirname(x) for x in scores_of(split, builder)}
+    [whole] = {path.dirname(x) for x in scores_of(unsplit, builder)}
+    with open(path.join(split, stitched, 'music.ly')) as f1:
+        with open(path.join(unsplit, whole, 'music.ly')) as f2:
+            assert f1.read() == f2.read()
+
+    # Fragments are rendered as independent scores, book titles are only
+    # in the first one, and tagline only in the last one.
+    fragments = []
+    builddir = path.dirname(path.join(split, stitched))
+    for sig in sorted(os.listdir(builddir)):
+        if sig == path.basename(stitched) or sig.startswith('.'):
+            continue
+        with open(path.join(builddir, sig, 'music.ly')) as f:
+            fragments.append(f.read())
+    fragments.sort(key=lambda x: "g'" in x)
+    assert len(fragments) == 2
+    assert fragments[0].endswith('\\header { tagline = ##f }')
+    assert 'title = ##f' not in fragments[0]
+    assert 'tagline = ##f' not in fragments[1]
+    assert 'title = ##f' in fragments[1]
+    assert 'composer = ##f' in fragments[1]
+
+
+def test_unattributed_failure(tmp_path):
+    # LilyPond crashes without reporting the failed file, the other scores
+    # of the batch are still rendered.
+    write_project(
+        tmp_path,
+        {
+            'index': 'Index\n=====\n\n'
+            + '\n'.join(lily("{ %s' }" % x) for x in ['c', 'd CRASH', 'e'])
+        },
+    )
+    outdir, warnings = build(tmp_path, 'html')
+    assert warnings.count('failed to generate scores') == 1
+    assert 'Segmentation fault' in warnings
+    assert len(scores_of(outdir, 'html')) == 2
+
+
+def test_singlehtml(tmp_path):
+    # Scores are in a sub-document, the assembled page still needs the
+    # script and stylesheet.
+    write_project(
+        tmp_path,
+        {
+            'index': 'Index\n=====\n\n.. toctree::\n\n   suite\n',
+            'suite': 'Suite\n=====\n\n' + lily(SUITE),
+        },
+    )
+    outdir, warnings = build(tmp_path, 'singlehtml')
+    assert warnings == ''
+    with open(path.join(outdir, 'index.html')) as f:
+        html = f.read()
+    assert 'sphinxnotes-lilypond.js' in html
+    assert 'sphinxnotes-lilypond.css' in html
+    assert len(re.findall(r'<img [^>]*src="\./([^"]+)"', html)) == 1
+
+
+def test_clean_stagedir(tmp_path):
+    # Directories of jobs and batches left by dead processes are removed.
+    p = subprocess.Popen([sys.executable, '-c', ''])
+    p.wait()
+    stagedir = tmp_path / '_build' / 'html' / '_lilypond' / '.staging'
+    dead = ['0123456789ab-%d-x' % p.pid, 'batch-%d-x' % p.pid]
+    alive = ['batch-%d-x' % os.getpid()]
+    for name in dead + alive:
+        (stagedir / name).mkdir(parents=True)
+    build(tmp_path, 'html')
+    assert sorted(os.listdir(stagedir)) == alive
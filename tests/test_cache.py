@@ -0,0 +1,194 @@
+"""Tests of :mod:`sphinxnotes.lilypond.cache`."""
+
+from __future__ import annotations
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+import pytest
+
+from sphinxnotes.lilypond import cache
+
+FILES = ['music.ly', 'music.png', 'music.midi']
+
+
+def make_output(dir: str, content: bytes = b'x' * 100) -> str:
+    """Pretend to be LilyPond: write an output directory."""
+    outdir = cache.mkstagedir(dir, 'out-')
+    for name in FILES:
+        with open(path.join(outdir, name), 'wb') as f:
+            f.write(content)
+    return outdir
+
+
+def assert_complete(entry: str):
+    assert sorted(os.listdir(entry)) == sorted(FILES)
+
+
+def sig_of(i: int) -> str:
+    return '%040x' % i
+
+
+def test_put_get(tmp_path):
+    c = cache.Cache(str(tmp_path / 'cache'))
+    assert c.get(sig_of(0)) is None
+    c.put(sig_of(0), make_output(str(tmp_path)))
+    entry = c.get(sig_of(0))
+    assert entry == c.entry(sig_of(0))
+    assert_complete(entry)
+    assert (c.hits, c.misses) == (1, 1)
+    assert c.query([sig_of(0), sig_of(1)]) == {sig_of(0)}
+
+
+def test_concurrent_put_same_sig(tmp_path):
+    c = cache.Cache(str(tmp_path / 'cache'))
+    outdirs = [make_output(str(tmp_path)) for _ in range(16)]
+    barrier = threading.Barrier(len(outdirs))
+
+    def put(outdir: str):
+        barrier.wait()
+        c.put(sig_of(0), outdir)
+
+    with ThreadPoolExecutor(len(outdirs)) as executor:
+        list(executor.map(put, outdirs))
+
+    # Exactly one complete entry is published, staging directories of
+    # losers are cleaned up.
+    assert_complete(c.entry(sig_of(0)))
+    assert [x for x in os.listdir(c.dir) if not x.startswith('.locks')] == [sig_of(0)]
+
+
+def test_concurrent_put_get(tmp_path):
+    c = cache.Cache(str(tmp_path / 'cache'))
+    sigs = [sig_of(i) for i in range(50)]
+    errors = []
+
+    def writer():
+        for sig in sigs:
+            c.put(sig, make_output(str(tmp_path)))
+
+    def reader():
+        for _ in range(5):
+            for sig in sigs:
+                entry = c.get(sig)
+                # Readers never see partial entries.
+                if entry is not None and len(os.listdir(entry)) != len(FILES):
+                    errors.append(entry)
+
+    threads = [threading.Thread(target=writer) for _ in range(4)]
+    threads += [threading.Thread(target=reader) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert c.query(sigs) == set(sigs)
+    for sig in sigs:
+        assert_complete(c.entry(sig))
+
+
+def test_evict_lru(tmp_path):
+    c = cache.Cache(str(tmp_path / 'cache'), max_size=3 * 300)
+    for i in range(5):
+        c.put(sig_of(i), make_output(str(tmp_path)))
+        os.utime(c.entry(sig_of(i)), (i, i))
+    c.get(sig_of(0))  # the most recently used one now
+    c.evict()
+    assert c.query(sig_of(i) for i in range(5)) == {sig_of(0), sig_of(3), sig_of(4)}
+    assert c.evicted == 2 * 300
+
+
+def test_evict_subdirs(tmp_path):
+    c = cache.Cache(str(tmp_path / 'cache'), max_size=250)
+    c.put(sig_of(0), make_output(str(tmp_path), b'x' * 50))  # 150 bytes
+    audio = cache.Cache(path.join(c.dir, '.audio'))
+    audio.put_file('a' * 40, make_output(str(tmp_path)) + '/music.midi', 'x.mp3')
+    os.makedirs(path.join(c.dir, '.jianpu'))
+    with open(path.join(c.dir, '.jianpu', 'j.ly'), 'w') as f:
+        f.write('x' * 100)
+    os.utime(c.entry(sig_of(0)), (0, 0))
+
+    # Audio and Jianpu caches share the size limit.
+    c.evict()
+    assert c.query([sig_of(0)]) == set()
+    assert sum(x[2] for x in c.entries()) == 200
+
+
+def test_concurrent_evict_get(tmp_path):
+    c = cache.Cache(str(tmp_path / 'cache'), max_size=10 * 300)
+    sigs = [sig_of(i) for i in range(40)]
+    for sig in sigs:
+        c.put(sig, make_output(str(tmp_path)))
+    stop = threading.Event()
+    errors = []
+
+    def reader():
+        while not stop.is_set():
+            for sig in sigs:
+                try:
+                    c.get(sig)
+                except Exception as e:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    for t in threads:
+        t.start()
+    with ThreadPoolExecutor(4) as executor:
+        for f in [executor.submit(c.evict) for _ in range(8)]:
+            f.result()
+    stop.set()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert sum(x[2] for x in c.entries()) <= c.max_size
+    for entry, _, _ in c.entries():
+        assert_complete(entry)
+
+
+def test_clean_locks(tmp_path):
+    c = cache.Cache(str(tmp_path / 'cache'))
+    held = c.lock(sig_of(0))
+    held.acquire()
+    with c.lock(sig_of(1)):
+        pass
+    try:
+        c.evict()
+        assert os.listdir(path.join(c.dir, '.locks')) == [sig_of(0)]
+    finally:
+        held.release()
+
+
+def _lock_writer(dir: str, sigs: list[str], seed: int, queue):
+    c = cache.Cache(path.join(dir, 'cache'))
+    rendered = []
+    for sig in sigs[seed:] + sigs[:seed]:
+        with c.lock(sig):
+            if c.get(sig) is not None:
+                continue  # rendered by others while waiting
+            c.put(sig, make_output(dir))
+            rendered.append(sig)
+    queue.put(rendered)
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='fork is needed')
+def test_lock_across_processes(tmp_path):
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    sigs = [sig_of(i) for i in range(30)]
+    procs = [
+        ctx.Process(target=_lock_writer, args=(str(tmp_path), sigs, i, queue))
+        for i in range(4)
+    ]
+    for p in procs:
+        p.start()
+    rendered = [x for _ in procs for x in queue.get(timeout=60)]
+    for p in procs:
+        p.join()
+
+    # Every signature is rendered exactly once.
+    assert sorted(rendered) == sigs
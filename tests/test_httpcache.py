@@ -0,0 +1,195 @@
+"""
+Tests of :class:`sphinxnotes.lilypond.cache.HTTPCache` and cache archives,
+against a local HTTP server.
+"""
+
+from __future__ import annotations
+
+import functools
+import io
+import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+
+import pytest
+
+from sphinxnotes.lilypond import cache
+
+SIG = 'a' * 40
+
+
+class Handler(SimpleHTTPRequestHandler):
+    """Serves files of directory by GET and stores them by PUT."""
+
+    def do_PUT(self):
+        self.server.requests.append(('PUT', self.path))  # type: ignore
+        if self.server.fail_put:  # type: ignore
+            self.send_error(500)
+            return
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        with open(self.translate_path(self.path), 'wb') as f:
+            f.write(data)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path))  # type: ignore
+        super().do_GET()
+
+    def log_message(self, *_):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    dir = tmp_path / 'server'
+    dir.mkdir()
+    handler = functools.partial(Handler, directory=str(dir))
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    httpd.requests = []  # type: ignore
+    httpd.fail_put = False  # type: ignore
+    httpd.dir = dir  # type: ignore
+    httpd.url = 'http://127.0.0.1:%d/cache' % httpd.server_port  # type: ignore
+    (dir / 'cache').mkdir()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_entry(dir: str, files: dict[str, bytes]) -> str:
+    os.makedirs(dir)
+    for name, data in files.items():
+        with open(path.join(dir, name), 'wb') as f:
+            f.write(data)
+    return dir
+
+
+def read_tree(dir: str) -> dict[str, bytes]:
+    tree = {}
+    for root, _, files in os.walk(dir):
+        for fn in files:
+            with open(path.join(root, fn), 'rb') as f:
+                tree[path.relpath(path.join(root, fn), dir)] = f.read()
+    return tree
+
+
+def new_cache(tmp_path, server, name: str) -> cache.HTTPCache:
+    return cache.HTTPCache(server.url, cache.Cache(str(tmp_path / name)))
+
+
+def test_miss(tmp_path, server):
+    c = new_cache(tmp_path, server, 'local')
+    assert c.get(SIG) is None
+    # Known missing signatures are not requested again.
+    assert c.get(SIG) is None
+    assert server.requests == [('GET', '/cache/%s.tar.gz' % SIG)]
+    assert (c.hits, c.misses) == (0, 2)
+
+
+def test_upload_and_hit(tmp_path, server):
+    files = {'music.ly': b'{ c }', 'music.png': b'png'}
+    c = new_cache(tmp_path, server, 'local1')
+    c.put(SIG, make_entry(str(tmp_path / 'out'), files))
+    assert server.requests == []  # deferred
+    c.flush()
+    assert server.requests == [('PUT', '/cache/%s.tar.gz' % SIG)]
+    assert c.uploaded > 0
+
+    other = new_cache(tmp_path, server, 'local2')
+    assert other.query([SIG, 'b' * 40]) == {SIG}
+    entry = other.get(SIG)
+    assert entry == other.local.entry(SIG)
+    assert read_tree(entry) == files
+    assert other.downloaded == c.uploaded
+
+    # Hits and misses are counted once, by the HTTP cache only.
+    assert (other.hits, other.misses) == (1, 0)
+    assert (other.local.hits, other.local.misses) == (0, 0)
+
+    # Uploaded ones are not uploaded again.
+    other.put(SIG, entry)
+    other.flush()
+    assert [x for x in server.requests if x[0] == 'PUT'] == [
+        ('PUT', '/cache/%s.tar.gz' % SIG)
+    ]
+
+
+def test_put_failure(tmp_path, server, caplog):
+    server.fail_put = True
+    c = new_cache(tmp_path, server, 'local')
+    c.put(SIG, make_entry(str(tmp_path / 'out'), {'music.png': b'png'}))
+    c.flush()
+    assert 'failed to upload' in caplog.text
+    assert c.uploaded == 0
+    # The entry is still available locally.
+    assert c.get(SIG) == c.local.entry(SIG)
+
+
+def test_corrupt_download(tmp_path, server, caplog):
+    with open(server.dir / 'cache' / (SIG + '.tar.gz'), 'wb') as f:
+        f.write(b'not a tarball')
+    c = new_cache(tmp_path, server, 'local')
+    assert c.get(SIG) is None
+    assert 'invalid cache entry' in caplog.text
+    assert c.misses == 1
+    # Nothing is left in local cache, not even staging directories.
+    assert os.listdir(c.local.dir) == []
+
+
+def test_download_without_entry(tmp_path, server, caplog):
+    # Archive has entry of another signature only.
+    with open(server.dir / 'cache' / (SIG + '.tar.gz'), 'wb') as f:
+        cache.pack({'b' * 40: make_entry(str(tmp_path / 'out'), {'x': b'x'})}, f)
+    c = new_cache(tmp_path, server, 'local')
+    assert c.query([SIG]) == set()
+    assert c.get(SIG) is None
+    assert 'no entry of %s' % SIG in caplog.text
+    assert c.misses == 1
+    # Entries of other signatures are not extracted either.
+    assert os.listdir(c.local.dir) == []
+
+
+def test_unreachable_server(tmp_path, caplog):
+    c = cache.HTTPCache(
+        'http://127.0.0.1:9/cache', cache.Cache(str(tmp_path / 'local')), timeout=1
+    )
+    assert c.get(SIG) is None
+    assert 'failed to fetch' in caplog.text
+
+
+def test_unpack_rejects_unsafe_names(tmp_path):
+    buf = io.BytesIO()
+    cache.pack({'../escape': make_entry(str(tmp_path / 'out'), {'x': b'x'})}, buf)
+    buf.seek(0)
+    assert cache.unpack(buf, str(tmp_path / 'dst')) == []
+    assert not (tmp_path / 'escape').exists()
+
+
+def test_export_import(tmp_path):
+    src = tmp_path / 'src'
+    make_entry(str(src / SIG), {'music.ly': b'{ c }', 'music.midi': b'midi'})
+    make_entry(str(src / ('b' * 40)), {'music.png': b'png'})
+    make_entry(str(src / '.audio' / ('c' * 40)), {'music.mp3': b'mp3'})
+    # Locks and staging directories are not exported.
+    make_entry(str(src / '.locks'), {SIG: b''})
+    make_entry(str(src / '.tmp-xxx'), {'music.png': b'partial'})
+
+    fn = str(tmp_path / 'cache.tar.gz')
+    assert cache.export_archive(str(src), fn) == 3
+
+    dst = tmp_path / 'dst'
+    assert cache.import_archive(fn, str(dst)) == 3
+    tree = read_tree(str(src))
+    del tree[path.join('.locks', SIG)]
+    del tree[path.join('.tmp-xxx', 'music.png')]
+    assert read_tree(str(dst)) == tree
+
+    # Existing entries are kept.
+    with open(dst / SIG / 'music.ly', 'wb') as f:
+        f.write(b'{ d }')
+    assert cache.import_archive(fn, str(dst)) == 0
+    assert (dst / SIG / 'music.ly').read_bytes() == b'{ d }'
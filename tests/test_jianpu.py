@@ -0,0 +1,34 @@
+"""Tests of :mod:`sphinxnotes.lilypond.jianpu`."""
+
+from __future__ import annotations
+
+import pytest
+
+from sphinxnotes.lilypond import jianpu
+
+JP = '1=C\n4/4\n1 2 3 4'
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setattr(jianpu.Config, 'cache_dir', None)
+    monkeypatch.setattr(jianpu.Config, 'workers', 1)
+    yield
+    jianpu.discard_prefetches()
+
+
+def test_prefetch(config):
+    # Source roughly extracted from document, and the one parsed by docutils.
+    jianpu.prefetch('\n\t1=C\n\t4/4  \n\t1 2 3 4\n')
+    assert len(jianpu._pending) == 1
+    ly = jianpu.to_lilypond(JP)
+    assert not jianpu._pending
+    assert ly == jianpu._convert(JP)[0]
+
+
+def test_discard_prefetches(config):
+    jianpu.prefetch(JP)
+    jianpu.prefetch(JP + ' 5')
+    assert len(jianpu._pending) == 2
+    jianpu.discard_prefetches()
+    assert not jianpu._pending
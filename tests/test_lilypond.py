@@ -0,0 +1,143 @@
+"""Tests of :mod:`sphinxnotes.lilypond.lilypond`."""
+
+from __future__ import annotations
+
+from fractions import Fraction
+
+import pytest
+from ly.pitch import transpose
+
+from sphinxnotes.lilypond import lilypond
+
+
+@pytest.mark.parametrize(
+    'src,note,alter,octave',
+    [
+        ('c', 0, 0, 0),
+        ('d', 1, 0, 0),
+        ('fis', 3, Fraction(1, 2), 0),
+        ('bes', 6, Fraction(-1, 2), 0),
+        ('eses', 2, -1, 0),
+        ('ases', 5, -1, 0),
+        ('cisis', 0, 1, 0),
+        ('ceh', 0, Fraction(-1, 4), 0),
+        ("c'", 0, 0, 1),
+        ("fis''", 3, Fraction(1, 2), 2),
+        ('bes,', 6, Fraction(-1, 2), -1),
+        ('a,,,', 5, 0, -3),
+    ],
+)
+def test_parse_pitch(src, note, alter, octave):
+    p = lilypond.parse_pitch(src)
+    assert (p.note, p.alter, p.octave) == (note, alter, octave)
+
+
+@pytest.mark.parametrize(
+    'src',
+    [
+        '',
+        'x',
+        'h',  # not a Dutch name
+        'C',
+        'cis3',
+        ' c',
+        'c d',
+        "c',",  # mixed octave marks
+        "c'x",
+        "'",
+    ],
+)
+def test_parse_pitch_invalid(src):
+    with pytest.raises(lilypond.Error, match='Invalid pitch'):
+        lilypond.parse_pitch(src)
+
+
+@pytest.fixture
+def transposed(monkeypatch):
+    """Empty memo of transposed sources, and count the real transpositions."""
+    monkeypatch.setattr(lilypond, '_transposed', {})
+    calls = []
+    real = transpose.transpose
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(transpose, 'transpose', counted)
+    return calls
+
+
+def test_transpose_source(transposed):
+    assert lilypond.transpose_source("{ c' d' e' }", 'c', 'd') == "{ d' e' fis' }"
+    assert (
+        lilypond.transpose_source("\\relative c' { c d e }", 'c', 'bes,')
+        == "\\relative c' { bes c d }"
+    )
+
+
+def test_transpose_source_memo(transposed):
+    src = "{ c' d' e' }"
+    first = lilypond.transpose_source(src, 'c', 'd')
+    assert lilypond.transpose_source(src, 'c', 'd') == first
+    assert len(transposed) == 1
+
+    # Other keys and other sources are transposed again.
+    lilypond.transpose_source(src, 'c', 'es')
+    lilypond.transpose_source("{ c'' }", 'c', 'd')
+    assert len(transposed) == 3
+    assert lilypond.transpose_source(src, 'c', 'es') == "{ es' f' g' }"
+    assert len(transposed) == 3
+
+
+def test_transpose_source_memo_eviction(transposed, monkeypatch):
+    monkeypatch.setattr(lilypond, '_TRANSPOSED_MAX', 2)
+    for to_pitch in ['d', 'e', 'f']:
+        lilypond.transpose_source('{ c }', 'c', to_pitch)
+    assert len(lilypond._transposed) == 2
+
+    # The oldest one is evicted.
+    lilypond.transpose_source('{ c }', 'c', 'f')
+    assert len(transposed) == 3
+    lilypond.transpose_source('{ c }', 'c', 'd')
+    assert len(transposed) == 4
+
+
+def test_transpose_source_invalid_pitch(transposed):
+    with pytest.raises(lilypond.Error, match='Invalid pitch: x'):
+        lilypond.transpose_source('{ c }', 'c', 'x')
+    assert lilypond._transposed == {}
+
+
+def test_split_movements():
+    src = (
+        '\\header { title = "T" }\n'
+        "m = { c' }\n"
+        '\\score { \\m \\layout {} }\n'
+        "\\score { { d' } \\layout {} }\n"
+        "\\score { { e' } \\midi {} }\n"  # MIDI-only, kept with the previous one
+        "\\score { { f' } }\n"
+    )
+    fragments = lilypond.split_movements(src)
+    assert fragments is not None
+    assert len(fragments) == 3
+    for f in fragments:
+        assert f.startswith('\\header { title = "T" }\nm = { c\' }\n')
+    assert "{ d' }" in fragments[1] and "{ e' }" in fragments[1]
+
+    assert fragments[0].endswith('\\header { tagline = ##f }')
+    assert 'title = ##f' in fragments[1] and 'tagline = ##f' in fragments[1]
+    assert 'title = ##f' in fragments[2] and 'tagline' not in fragments[2]
+
+
+@pytest.mark.parametrize(
+    'src',
+    [
+        "\\score { { c' } }",
+        "\\score { { c' } }\n\\score { { d' } \\midi {} }",
+        "\\book { \\score { { c' } } \\score { { d' } } }",
+        "\\score { { c' } }\n\\markup { M }\n\\score { { d' } }",
+        "\\score { { c' } }\n{ d' }\n\\score { { e' } }",
+    ],
+)
+def test_split_movements_unsplittable(src):
+    assert lilypond.split_movements(src) is None
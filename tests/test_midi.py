@@ -0,0 +1,46 @@
+"""Tests of :mod:`sphinxnotes.lilypond.midi`."""
+
+from __future__ import annotations
+
+import os
+from os import path
+
+from sphinxnotes.lilypond import cache, midi
+
+ROOTDIR = path.dirname(path.dirname(path.abspath(__file__)))
+TIMIDITY = path.join(ROOTDIR, 'benchmarks', 'stubs', 'timidity')
+
+
+def write_midi(dir) -> str:
+    fn = path.join(dir, 'music.midi')
+    with open(fn, 'wb') as f:
+        f.write(b'MThd\0\0\0\6\0\1\0\0\0\x60')
+    return fn
+
+
+def test_to_audio_cache(tmp_path):
+    c = cache.Cache(str(tmp_path / 'cache'))
+    for i in range(2):
+        os.mkdir(tmp_path / str(i))
+        fn = write_midi(tmp_path / str(i))
+        midi.to_audio([TIMIDITY], ['ffmpeg'], 'wav', [], fn, c)
+        assert path.isfile(tmp_path / str(i) / 'music.wav')
+    assert c.hits == 1
+
+
+def test_to_audio_cache_error(tmp_path, monkeypatch):
+    # Errors of cache don't fail the conversion.
+    c = cache.Cache(str(tmp_path / 'cache'))
+
+    def fail(*args):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(c, 'put_file', fail)
+    fn = write_midi(tmp_path)
+    midi.to_audio([TIMIDITY], ['ffmpeg'], 'wav', [], fn, c)
+    assert path.isfile(tmp_path / 'music.wav')
+
+    monkeypatch.setattr(c, 'get', fail)
+    os.remove(tmp_path / 'music.wav')
+    midi.to_audio([TIMIDITY], ['ffmpeg'], 'wav', [], fn, c)
+    assert path.isfile(tmp_path / 'music.wav')
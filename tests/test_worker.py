@@ -0,0 +1,86 @@
+"""Tests of :mod:`sphinxnotes.lilypond.worker`."""
+
+from __future__ import annotations
+
+import os
+import shutil
+from os import path
+
+import pytest
+
+from sphinxnotes.lilypond import lilypond, worker
+
+ROOTDIR = path.dirname(path.dirname(path.abspath(__file__)))
+STUB = path.join(ROOTDIR, 'benchmarks', 'stubs', 'lilypond')
+
+
+def write(fn, content: str) -> str:
+    with open(fn, 'w') as f:
+        f.write(content)
+    return str(fn)
+
+
+def test_render(tmp_path):
+    w = worker.Worker([STUB])
+    try:
+        ok, _ = w.render(write(tmp_path / 'a.ly', "{ c' }"), str(tmp_path), False)
+        assert ok
+        assert path.isfile(tmp_path / 'a.pdf')
+        ok, log = w.render(write(tmp_path / 'b.ly', 'ERROR'), str(tmp_path), False)
+        assert not ok
+        assert 'syntax error' in log
+        assert w.jobs == 2
+    finally:
+        w.close()
+
+
+def test_render_timeout(tmp_path):
+    pool = worker.Pool(1)
+    try:
+        with pytest.raises(worker.Error, match='timed out'):
+            pool.render(
+                [STUB],
+                write(tmp_path / 'a.ly', 'HANG'),
+                str(tmp_path),
+                False,
+                timeout=1,
+            )
+        # The killed worker is replaced.
+        ok, _ = pool.render(
+            [STUB], write(tmp_path / 'b.ly', "{ c' }"), str(tmp_path), False, timeout=1
+        )
+        assert ok
+    finally:
+        pool.close()
+
+
+@pytest.mark.skipif(shutil.which('lilypond') is None, reason='requires LilyPond')
+def test_real_lilypond(tmp_path, monkeypatch):
+    # Run the Scheme driver loop under real LilyPond, with an include path
+    # relative to the working directory of Sphinx.
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('inc')
+    write('inc/melody.ly', "melody = { c' d' e' f' }\n")
+    for k, v in {
+        'lilypond_args': ['lilypond'],
+        'include_paths': ['inc'],
+        'score_format': 'png',
+        'score_formats': [],
+        'png_resolution': 101,
+        'timidity_args': ['timidity'],
+        'ffmpeg_args': ['ffmpeg'],
+        'audio_format': 'wav',
+        'audio_volume': None,
+        'workers': 1,
+        'worker_timeout': 60,
+    }.items():
+        monkeypatch.setattr(lilypond.Config, k, v, raising=False)
+
+    doc = lilypond.Document('\\include "melody.ly"\n{ \\melody }\n')
+    for crop in [False, True]:
+        outdir = tmp_path / ('out%d' % crop)
+        outdir.mkdir()
+        out = doc.output(str(outdir), crop)
+        assert (out.cropped_score if crop else out.score) is not None
+    with pytest.raises(lilypond.Error):
+        lilypond.Document('{ c\n').output(str(tmp_path), False)